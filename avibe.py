@@ -1,81 +1,295 @@
 import os
+import sys
+import json
+import time
+import argparse
+from itertools import islice
+
 import torch
 from transformers import AutoModelForCausalLM, AutoTokenizer
 
 # —————————————————————————————————————
-# Указываем свои директории для кешей / хранения
-root_cache_dir = "/home/zarina/Work/BakaiMarket/Avito/vibe"        # корневая папка кешей
-models_cache_dir = os.path.join(root_cache_dir, "models")     # для моделей
-tokenizer_cache_dir = os.path.join(root_cache_dir, "tokenizers")  # для токенизаторов
-os.makedirs(models_cache_dir, exist_ok=True)
-os.makedirs(tokenizer_cache_dir, exist_ok=True)
-
-# Устанавливаем переменные окружения, чтобы библиотека использовала наши директории
-os.environ["HF_HOME"] = root_cache_dir
-os.environ["TRANSFORMERS_CACHE"] = models_cache_dir
-os.environ["HF_TOKENIZERS_CACHE"] = tokenizer_cache_dir
+# Значения по умолчанию
+
+DEFAULT_CACHE_DIR = "/home/zarina/Work/BakaiMarket/Avito/vibe"
+DEFAULT_PROMPT = "Привет, подскажи рецепт борща"
+MODEL_NAME = "AvitoTech/avibe"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Пакетная генерация текстов моделью Avibe (JSONL -> JSONL)"
+    )
+    parser.add_argument(
+        "--input",
+        help='JSONL с промптами ({"id": ..., "prompt": ..., "max_tokens": ...} на строку); "-" — stdin'
+    )
+    parser.add_argument("--output", help="Файл результатов JSONL (обязателен вместе с --input)")
+    parser.add_argument("--text", action="store_true", help="Вход — по одному промпту на строку, а не JSONL")
+    parser.add_argument("--prompt", default=DEFAULT_PROMPT, help="Один промпт (если не задан --input)")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR, help="Корневая папка кешей HF")
+    parser.add_argument("--batch-size", type=int, default=16, help="Промптов на один вызов generate()")
+    parser.add_argument(
+        "--window", type=int, default=1024,
+        help="Сколько промптов читать и сортировать за раз (ограничивает память)"
+    )
+    parser.add_argument("--max-new-tokens", type=int, default=1024)
+    parser.add_argument("--temperature", type=float, default=0.7)
+    parser.add_argument("--resume", action="store_true", help="Продолжить с последнего чекпоинта")
+    args = parser.parse_args()
+    if args.input and not args.output:
+        parser.error("--output обязателен вместе с --input")
+    return args
+
+
+# —————————————————————————————————————
+# Чтение входа
+
+def iter_prompts(args):
+    """Построчное чтение входа: память не зависит от размера файла"""
+    stream = sys.stdin if args.input == "-" else open(args.input, encoding="utf-8")
+    try:
+        for line_no, line in enumerate(stream, 1):
+            line = line.rstrip("\n")
+            if not line.strip():
+                continue
+            if args.text:
+                yield {"id": line_no, "prompt": line}
+            else:
+                record = json.loads(line)
+                if "prompt" not in record:
+                    raise ValueError(f"{args.input}:{line_no}: нет поля 'prompt'")
+                record.setdefault("id", line_no)
+                yield record
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+
 
 # —————————————————————————————————————
-# 1. Определение названия модели
-model_name = "AvitoTech/avibe"
-
-# 2. Загрузка токенизатора (с указанием cache_dir)
-print(f"Загрузка токенизатора {model_name} в {tokenizer_cache_dir} ...")
-tokenizer = AutoTokenizer.from_pretrained(
-    model_name,
-    cache_dir=tokenizer_cache_dir,
-    local_files_only=False  # если есть локально, будет использовано; иначе скачивает
-)
-print("Токенизатор загружен.")
-
-# 3. Загрузка модели
-print(f"Загрузка модели {model_name} в {models_cache_dir} ...")
-model = AutoModelForCausalLM.from_pretrained(
-    model_name,
-    cache_dir=models_cache_dir,
-    torch_dtype="auto",
-    device_map="auto",
-    local_files_only=False
-)
-print("Модель загружена.")
-
-# 4. Подготовка запроса
-prompt = "Привет, подскажи рецепт борща"
-
-# Формирование сообщений / чат-формата
-messages = [
-    {"role": "user", "content": prompt}
-]
-
-text = tokenizer.apply_chat_template(
-    messages,
-    tokenize=False,
-    add_generation_prompt=True
-)
-
-# 5. Токенизация и генерация
-model_inputs = tokenizer([text], return_tensors="pt").to(model.device)
-
-generated_ids = model.generate(
-    **model_inputs,
-    max_new_tokens=1024,
-    do_sample=True,
-    temperature=0.7
-)
-
-input_ids_len = model_inputs.input_ids.shape[1]
-generated_text_ids = generated_ids[:, input_ids_len:]
-response = tokenizer.decode(generated_text_ids[0], skip_special_tokens=True)
-
-# 6. Вывод результата
-print("\n--- Запрос ---")
-print(prompt)
-print("\n--- Ответ A-vibe ---")
-print(response)
-
-# Очистка памяти
-del model
-del tokenizer
-if torch.cuda.is_available():
-    torch.cuda.empty_cache()
+# Чекпоинт: сколько записей входа обработано и где кончается валидная часть вывода
+
+def checkpoint_path(output_path):
+    return output_path + ".ckpt"
+
+
+def load_checkpoint(output_path):
+    path = checkpoint_path(output_path)
+    if not os.path.exists(path):
+        return {"processed": 0, "output_offset": 0}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_checkpoint(output_path, processed, output_offset):
+    path = checkpoint_path(output_path)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"processed": processed, "output_offset": output_offset}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)  # атомарная замена: чекпоинт никогда не бывает наполовину записан
+
+
+# —————————————————————————————————————
+# Модель
+
+def load_model(cache_dir):
+    models_cache_dir = os.path.join(cache_dir, "models")
+    tokenizer_cache_dir = os.path.join(cache_dir, "tokenizers")
+    os.makedirs(models_cache_dir, exist_ok=True)
+    os.makedirs(tokenizer_cache_dir, exist_ok=True)
+
+    # Устанавливаем переменные окружения, чтобы библиотека использовала наши директории
+    os.environ["HF_HOME"] = cache_dir
+    os.environ["TRANSFORMERS_CACHE"] = models_cache_dir
+    os.environ["HF_TOKENIZERS_CACHE"] = tokenizer_cache_dir
+
+    print(f"Загрузка токенизатора {MODEL_NAME} в {tokenizer_cache_dir} ...", file=sys.stderr)
+    tokenizer = AutoTokenizer.from_pretrained(
+        MODEL_NAME,
+        cache_dir=tokenizer_cache_dir,
+        local_files_only=False  # если есть локально, будет использовано; иначе скачивает
+    )
+    print(f"Загрузка модели {MODEL_NAME} в {models_cache_dir} ...", file=sys.stderr)
+    model = AutoModelForCausalLM.from_pretrained(
+        MODEL_NAME,
+        cache_dir=models_cache_dir,
+        torch_dtype="auto",
+        device_map="auto",
+        local_files_only=False
+    )
+    model.eval()
+    print("Модель загружена.", file=sys.stderr)
+    return tokenizer, model
+
+
+def tokenize_prompt(tokenizer, prompt):
+    """Чат-шаблон + токенизация одного промпта; длина нужна для сортировки по корзинам"""
+    messages = [
+        {"role": "user", "content": prompt}
+    ]
+    text = tokenizer.apply_chat_template(
+        messages,
+        tokenize=False,
+        add_generation_prompt=True
+    )
+    return tokenizer(text)["input_ids"]
+
+
+def generate_batch(tokenizer, model, batch_ids, max_new_tokens, temperature):
+    """
+    Один вызов generate() для пачки промптов близкой длины
+    Паддинг слева, чтобы все строки заканчивались в позиции генерации
+    Возвращает сгенерированные токены каждой строки
+    """
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    width = max(len(ids) for ids in batch_ids)
+    input_ids = torch.full((len(batch_ids), width), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(batch_ids), width), dtype=torch.long)
+    for row, ids in enumerate(batch_ids):
+        input_ids[row, width - len(ids):] = torch.tensor(ids, dtype=torch.long)
+        attention_mask[row, width - len(ids):] = 1
+
+    with torch.inference_mode():
+        generated_ids = model.generate(
+            input_ids=input_ids.to(model.device),
+            attention_mask=attention_mask.to(model.device),
+            max_new_tokens=max_new_tokens,
+            do_sample=temperature > 0,
+            temperature=temperature if temperature > 0 else None,
+            pad_token_id=pad_token_id,
+        )
+
+    results = []
+    for row in generated_ids[:, width:].cpu().tolist():
+        # Строки пачки заканчиваются в разное время: всё после EOS — паддинг
+        if tokenizer.eos_token_id in row:
+            row = row[:row.index(tokenizer.eos_token_id) + 1]
+        results.append(row)
+    return results
+
+
+def process_window(tokenizer, model, records, args):
+    """
+    Генерация для окна записей: сортировка по длине в токенах, пачки, возврат в исходном порядке
+    """
+    tokenized = []
+    outputs = [None] * len(records)
+    for i, record in enumerate(records):
+        try:
+            tokenized.append((i, tokenize_prompt(tokenizer, record["prompt"])))
+        except Exception as e:
+            outputs[i] = {"error": f"{type(e).__name__}: {e}"}
+
+    # Корзины по длине: соседние после сортировки промпты почти не требуют паддинга
+    def limit(i):
+        return records[i].get("max_tokens", args.max_new_tokens)
+
+    tokenized.sort(key=lambda item: (len(item[1]), limit(item[0])))
+    for start in range(0, len(tokenized), args.batch_size):
+        batch = tokenized[start:start + args.batch_size]
+        try:
+            generated = generate_batch(
+                tokenizer, model, [ids for _, ids in batch],
+                max(limit(i) for i, _ in batch), args.temperature
+            )
+            for (i, ids), row in zip(batch, generated):
+                # Запись могла просить меньше токенов, чем соседи по пачке
+                row = row[:limit(i)]
+                outputs[i] = {
+                    "response": tokenizer.decode(row, skip_special_tokens=True),
+                    "generated_tokens": len(row),
+                    "input_tokens": len(ids),
+                }
+        except Exception as e:
+            for i, _ in batch:
+                outputs[i] = {"error": f"{type(e).__name__}: {e}"}
+    return outputs
+
+
+# —————————————————————————————————————
+# Режимы работы
+
+def run_single(args, tokenizer, model):
+    """Исходное поведение скрипта: один промпт"""
+    row, = generate_batch(
+        tokenizer, model, [tokenize_prompt(tokenizer, args.prompt)], args.max_new_tokens, args.temperature
+    )
+    response = tokenizer.decode(row, skip_special_tokens=True)
+    print("\n--- Запрос ---")
+    print(args.prompt)
+    print("\n--- Ответ A-vibe ---")
+    print(response)
+
+
+def run_bulk(args, tokenizer, model):
+    """Пакетный режим: JSONL/stdin -> JSONL в исходном порядке, с чекпоинтами по окнам"""
+    records = iter_prompts(args)
+
+    start_index = 0
+    if args.resume:
+        ckpt = load_checkpoint(args.output)
+        start_index = ckpt["processed"]
+        if os.path.exists(args.output):
+            # Отрезаем строки, записанные после последнего чекпоинта (могли оборваться на середине)
+            with open(args.output, "r+b") as f:
+                f.truncate(ckpt["output_offset"])
+        print(f"↩️  Продолжаем с записи #{start_index}", file=sys.stderr)
+        for _ in islice(records, start_index):
+            pass
+    elif os.path.exists(checkpoint_path(args.output)):
+        os.remove(checkpoint_path(args.output))
+
+    processed = start_index
+    done_this_run = 0
+    tokens_this_run = 0
+    started = time.time()
+
+    with open(args.output, "ab" if args.resume else "wb") as out:
+        while True:
+            window = list(islice(records, args.window))
+            if not window:
+                break
+            outputs = process_window(tokenizer, model, window, args)
+            for record, result in zip(window, outputs):
+                line = {"id": record["id"], **result}
+                tokens_this_run += result.get("generated_tokens", 0)
+                out.write((json.dumps(line, ensure_ascii=False) + "\n").encode("utf-8"))
+
+            out.flush()
+            os.fsync(out.fileno())
+            processed += len(window)
+            done_this_run += len(window)
+            save_checkpoint(args.output, processed, out.tell())
+
+            elapsed = time.time() - started
+            print(
+                f"📊 обработано {processed} | {done_this_run / elapsed:.2f} промптов/сек, "
+                f"{tokens_this_run / elapsed:.1f} токенов/сек",
+                file=sys.stderr
+            )
+
+    print(f"✅ Готово: {done_this_run} промптов за {time.time() - started:.1f} сек -> {args.output}", file=sys.stderr)
+
+
+def main():
+    args = parse_args()
+    tokenizer, model = load_model(args.cache_dir)
+    # Пачки выравниваются по правому краю (паддинг слева)
+    tokenizer.padding_side = "left"
+    try:
+        if args.input:
+            run_bulk(args, tokenizer, model)
+        else:
+            run_single(args, tokenizer, model)
+    finally:
+        # Очистка памяти
+        del model
+        del tokenizer
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
 
+if __name__ == "__main__":
+    main()
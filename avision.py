@@ -1,109 +1,310 @@
 import os
+import sys
+import json
+import time
+import argparse
+import warnings
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
 import torch
 from PIL import Image
 from transformers import AutoProcessor, AutoModelForImageTextToText
-import warnings
 
 warnings.filterwarnings("ignore", category=UserWarning)
 
-# Устанавливаем свои директории для кеша
-# Например:
-root_cache_dir = "/home/zarina/Work/BakaiMarket/Avito/vision"
-models_cache_dir = os.path.join(root_cache_dir, "models")
-hub_cache_dir = os.path.join(root_cache_dir, "hub")
-datasets_cache_dir = os.path.join(root_cache_dir, "datasets")
-
-os.makedirs(models_cache_dir, exist_ok=True)
-os.makedirs(hub_cache_dir, exist_ok=True)
-os.makedirs(datasets_cache_dir, exist_ok=True)
-
-# Устанавливаем переменные окружения, чтобы Transformers / hub использовали наши директории
-os.environ["HF_HOME"] = root_cache_dir
-os.environ["TRANSFORMERS_CACHE"] = models_cache_dir
-os.environ["HF_DATASETS_CACHE"] = datasets_cache_dir
-
-# --- Настройка модели и устройства ---
-model_id = "AvitoTech/avision"
-device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-print(f"✅ Модель будет работать на устройстве: {device}")
-
-# Путь к изображению
-local_image_path = "/home/zarina/Work/BakaiMarket/Avito/car5.jpeg"
-
-# --- Загрузка модели и процессора (с указанием cache_dir) ---
-print(f"\n⬇️ Скачивание и загрузка модели {model_id} в {models_cache_dir} ...")
-processor = AutoProcessor.from_pretrained(model_id, cache_dir=models_cache_dir, local_files_only=False)
-
-model = AutoModelForImageTextToText.from_pretrained(
-    model_id,
-    torch_dtype="auto",
-    cache_dir=models_cache_dir,
-    local_files_only=False
-)
-model.to(device)
-print("🚀 Модель успешно загружена.")
-
-# --- Загрузка локального изображения ---
-if not os.path.exists(local_image_path):
-    print(f"❌ Ошибка: файл не найден по пути: {local_image_path}")
-    img = Image.new('RGB', (400, 300), color='red')
-else:
+# —————————————————————————————————————
+# Значения по умолчанию
+
+DEFAULT_CACHE_DIR = "/home/zarina/Work/BakaiMarket/Avito/vision"
+DEFAULT_IMAGE_PATH = "/home/zarina/Work/BakaiMarket/Avito/car5.jpeg"
+DEFAULT_PROMPT = "Опиши изображение подробно и скажи, что здесь можно продать."
+MODEL_ID = "AvitoTech/avision"
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif", ".webp"}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Пакетный анализ фотографий объявлений моделью Avision (результаты в JSONL)"
+    )
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--input-dir", help="Папка с изображениями (обходится рекурсивно)")
+    source.add_argument("--manifest", help='JSONL-манифест: {"id": ..., "path": ..., "prompt": ...} на строку')
+    parser.add_argument("--output", help="Файл результатов JSONL (обязателен для пакетного режима)")
+    parser.add_argument("--image", default=DEFAULT_IMAGE_PATH, help="Одно изображение (если не задан --input-dir/--manifest)")
+    parser.add_argument("--prompt", default=DEFAULT_PROMPT, help="Вопрос к изображению по умолчанию")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR, help="Корневая папка кешей HF")
+    parser.add_argument("--batch-size", type=int, default=8, help="Изображений на один вызов generate()")
+    parser.add_argument("--workers", type=int, default=8, help="Потоков для чтения и декодирования изображений")
+    parser.add_argument("--prefetch", type=int, default=64, help="Сколько изображений декодировать наперёд")
+    parser.add_argument("--max-new-tokens", type=int, default=256)
+    parser.add_argument("--temperature", type=float, default=0.7)
+    parser.add_argument("--resume", action="store_true", help="Продолжить с последнего чекпоинта")
+    args = parser.parse_args()
+    if (args.input_dir or args.manifest) and not args.output:
+        parser.error("--output обязателен вместе с --input-dir/--manifest")
+    return args
+
+
+# —————————————————————————————————————
+# Источники изображений
+
+def iter_directory(root):
+    """Рекурсивный обход папки в детерминированном порядке (важно для resume)"""
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in sorted(filenames):
+            if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS:
+                path = os.path.join(dirpath, name)
+                yield {"id": os.path.relpath(path, root), "path": path}
+
+
+def iter_manifest(manifest_path):
+    """Чтение JSONL-манифеста построчно, без загрузки целиком в память"""
+    with open(manifest_path, encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if "path" not in record:
+                raise ValueError(f"{manifest_path}:{line_no}: нет поля 'path'")
+            record.setdefault("id", record["path"])
+            yield record
+
+
+def load_image(record):
+    """Чтение и декодирование одного изображения (выполняется в пуле потоков)"""
     try:
-        img = Image.open(local_image_path).convert('RGB')
-        print(f"🖼️ Загружено изображение: {local_image_path}")
+        with Image.open(record["path"]) as img:
+            return record, img.convert("RGB"), None
     except Exception as e:
-        print(f"❌ Ошибка при открытии файла: {e}")
+        return record, None, f"{type(e).__name__}: {e}"
+
+
+def prefetch_images(records, pool, depth):
+    """
+    Декодирует изображения в пуле потоков, держа не больше `depth` в работе
+    Порядок выдачи совпадает с порядком входа
+    """
+    in_flight = deque()
+    for record in records:
+        in_flight.append(pool.submit(load_image, record))
+        if len(in_flight) >= depth:
+            yield in_flight.popleft().result()
+    while in_flight:
+        yield in_flight.popleft().result()
+
+
+def batched(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# —————————————————————————————————————
+# Чекпоинт: сколько записей входа обработано и где кончается валидная часть вывода
+
+def checkpoint_path(output_path):
+    return output_path + ".ckpt"
+
+
+def load_checkpoint(output_path):
+    path = checkpoint_path(output_path)
+    if not os.path.exists(path):
+        return {"processed": 0, "output_offset": 0}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_checkpoint(output_path, processed, output_offset):
+    path = checkpoint_path(output_path)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"processed": processed, "output_offset": output_offset}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)  # атомарная замена: чекпоинт никогда не бывает наполовину записан
+
+
+# —————————————————————————————————————
+# Модель
+
+def load_model(cache_dir):
+    models_cache_dir = os.path.join(cache_dir, "models")
+    os.makedirs(models_cache_dir, exist_ok=True)
+    os.environ["HF_HOME"] = cache_dir
+    os.environ["TRANSFORMERS_CACHE"] = models_cache_dir
+    os.environ["HF_DATASETS_CACHE"] = os.path.join(cache_dir, "datasets")
+
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    print(f"✅ Модель будет работать на устройстве: {device}", file=sys.stderr)
+    print(f"⬇️ Загрузка модели {MODEL_ID} из {models_cache_dir} ...", file=sys.stderr)
+    processor = AutoProcessor.from_pretrained(MODEL_ID, cache_dir=models_cache_dir, local_files_only=False)
+    # Для пакетной генерации промпты выравниваются по правому краю
+    processor.tokenizer.padding_side = "left"
+    model = AutoModelForImageTextToText.from_pretrained(
+        MODEL_ID,
+        torch_dtype="auto",
+        cache_dir=models_cache_dir,
+        local_files_only=False
+    )
+    model.to(device)
+    model.eval()
+    print("🚀 Модель успешно загружена.", file=sys.stderr)
+    return processor, model, device
+
+
+def describe_batch(processor, model, device, images, prompts, max_new_tokens, temperature):
+    """Один вызов generate() для пачки изображений; возвращает [(текст, число токенов)]"""
+    texts = []
+    for img, prompt in zip(images, prompts):
+        messages = [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "image", "image": img},
+                    {"type": "text", "text": prompt}
+                ],
+            }
+        ]
+        texts.append(processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True))
+
+    inputs = processor(text=texts, images=images, return_tensors="pt", padding=True).to(device)
+    with torch.inference_mode():
+        generated_ids = model.generate(
+            **inputs,
+            max_new_tokens=max_new_tokens,
+            do_sample=temperature > 0,
+            temperature=temperature if temperature > 0 else None,
+        )
+
+    # Удаляем токены исходного промпта из ответа
+    generated_text_ids = generated_ids[:, inputs.input_ids.shape[1]:].cpu()
+    eos_token_id = processor.tokenizer.eos_token_id
+    results = []
+    for row in generated_text_ids.tolist():
+        # Строки пачки заканчиваются в разное время: всё после EOS — паддинг
+        if eos_token_id in row:
+            row = row[:row.index(eos_token_id) + 1]
+        results.append((processor.tokenizer.decode(row, skip_special_tokens=True), len(row)))
+    return results
+
+
+# —————————————————————————————————————
+# Режимы работы
+
+def run_single(args, processor, model, device):
+    """Исходное поведение скрипта: описать одно изображение"""
+    if not os.path.exists(args.image):
+        print(f"❌ Ошибка: файл не найден по пути: {args.image}")
         img = Image.new('RGB', (400, 300), color='red')
+    else:
+        try:
+            img = Image.open(args.image).convert('RGB')
+            print(f"🖼️ Загружено изображение: {args.image}")
+        except Exception as e:
+            print(f"❌ Ошибка при открытии файла: {e}")
+            img = Image.new('RGB', (400, 300), color='red')
+
+    print("\n⚙️ Генерация ответа...")
+    (response, _), = describe_batch(
+        processor, model, device, [img], [args.prompt], args.max_new_tokens, args.temperature
+    )
+    print("\n--- Результат ---")
+    print(f"Запрос: {args.prompt}")
+    print(f"Ответ: \n{response}")
+
+
+def run_bulk(args, processor, model, device):
+    """Пакетный режим: поток изображений -> JSONL с чекпоинтами"""
+    records = iter_directory(args.input_dir) if args.input_dir else iter_manifest(args.manifest)
+
+    start_index = 0
+    if args.resume:
+        ckpt = load_checkpoint(args.output)
+        start_index = ckpt["processed"]
+        if os.path.exists(args.output):
+            # Отрезаем строки, записанные после последнего чекпоинта (могли оборваться на середине)
+            with open(args.output, "r+b") as f:
+                f.truncate(ckpt["output_offset"])
+        print(f"↩️  Продолжаем с записи #{start_index}", file=sys.stderr)
+        for _ in range(start_index):
+            if next(records, None) is None:
+                break
+    elif os.path.exists(checkpoint_path(args.output)):
+        os.remove(checkpoint_path(args.output))
+
+    processed = start_index
+    done_this_run = 0
+    started = time.time()
+
+    with ThreadPoolExecutor(max_workers=args.workers) as pool, \
+            open(args.output, "ab" if args.resume else "wb") as out:
+        for batch in batched(prefetch_images(records, pool, args.prefetch), args.batch_size):
+            batch_start = time.time()
+            ok = [(record, img) for record, img, error in batch if error is None]
+            outputs = {}
+            if ok:
+                try:
+                    described = describe_batch(
+                        processor, model, device,
+                        [img for _, img in ok],
+                        [record.get("prompt") or args.prompt for record, _ in ok],
+                        args.max_new_tokens, args.temperature,
+                    )
+                    outputs = {id(record): result for (record, _), result in zip(ok, described)}
+                except Exception as e:
+                    outputs = {id(record): e for record, _ in ok}
+
+            for record, _, error in batch:
+                line = {"id": record["id"], "path": record["path"], "prompt": record.get("prompt") or args.prompt}
+                result = outputs.get(id(record))
+                if error is not None:
+                    line["error"] = error
+                elif isinstance(result, Exception):
+                    line["error"] = f"{type(result).__name__}: {result}"
+                else:
+                    line["response"], line["generated_tokens"] = result
+                out.write((json.dumps(line, ensure_ascii=False) + "\n").encode("utf-8"))
+
+            out.flush()
+            os.fsync(out.fileno())
+            processed += len(batch)
+            done_this_run += len(batch)
+            save_checkpoint(args.output, processed, out.tell())
+
+            elapsed = time.time() - started
+            batch_time = time.time() - batch_start
+            print(
+                f"📊 обработано {processed} | {done_this_run / elapsed:.2f} изобр/сек "
+                f"(пачка: {len(batch) / batch_time:.2f} изобр/сек)",
+                file=sys.stderr
+            )
+
+    print(f"✅ Готово: {done_this_run} изображений за {time.time() - started:.1f} сек -> {args.output}", file=sys.stderr)
+
+
+def main():
+    args = parse_args()
+    processor, model, device = load_model(args.cache_dir)
+    try:
+        if args.input_dir or args.manifest:
+            run_bulk(args, processor, model, device)
+        else:
+            run_single(args, processor, model, device)
+    finally:
+        # Очистка модели и кеши памяти
+        del model
+        del processor
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
 
-# --- Подготовка мультимодального запроса (ОБНОВЛЁННЫЙ БЛОК) ---
-prompt_text = "Опиши изображение подробно и скажи, что здесь можно продать."
-
-# 1. Форматирование сообщения: создаем структуру, необходимую для apply_chat_template
-messages = [
-    {
-        "role": "user",
-        "content": [
-            {"type": "image", "image": img},
-            {"type": "text", "text": prompt_text}
-        ],
-    }
-]
-
-# 2. ВРУЧНУЮ преобразуем сообщения в чат-строку, которую ожидает токенизатор
-chat_text = processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
-
-
-# 3. Вызываем процессор, передавая ТОЛЬКО готовую строку 'chat_text' и объект изображения.
-# Это обходит проблему с аргументом `messages`.
-inputs = processor(
-    text=[chat_text],  # <--- Передаем готовую строку
-    images=img,        # <--- Передаем объект PIL.Image
-    return_tensors="pt",
-    padding=True
-)
-inputs = inputs.to(device)
-
-# --- Генерация ответа ---
-print("\n⚙️ Генерация ответа...")
-generated_ids = model.generate(
-    **inputs,
-    max_new_tokens=256,
-    do_sample=True,
-    temperature=0.7
-)
-
-# Удаляем токены исходного промпта из ответа (для чистоты)
-input_ids_len = inputs.input_ids.shape[1]
-generated_text_ids = generated_ids[:, input_ids_len:]
-response = processor.batch_decode(generated_text_ids, skip_special_tokens=True)[0]
-
-# --- Вывод результата ---
-print("\n--- Результат ---")
-print(f"Запрос: {prompt_text}")
-print(f"Ответ: \n{response}")
-
-# Очистка модели и кеши памяти
-del model
-del processor
-if torch.cuda.is_available():
-    torch.cuda.empty_cache()
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,17 @@
 import os
-import io
 import torch
 import logging
 from datetime import datetime
 import time
-from base64 import b64encode
+from base64 import b64encode, b64decode
+from binascii import Error as Base64Error
 
-# ⚡ ВАЖНО: Устанавливаем использование только GPU 1 (NVIDIA H200)
-os.environ["CUDA_VISIBLE_DEVICES"] = "1"
+# ⚡ ВАЖНО: По умолчанию используем только GPU 1 (NVIDIA H200);
+# для реплик на нескольких GPU задайте CUDA_VISIBLE_DEVICES в окружении
+os.environ.setdefault("CUDA_VISIBLE_DEVICES", "1")
 
 from flask import Flask, request, render_template_string, g, jsonify
 from flask_cors import CORS
-from PIL import Image
 from transformers import (
     AutoTokenizer,
     AutoModelForCausalLM,
@@ -25,13 +25,51 @@ from middleware import (
     RequestIDMiddleware,
     rate_limit_required,
     setup_error_handlers,
+    rate_limit_cost,
     validate_prompt,
+    validate_prompt_tokens,
+    validate_generation_params,
     validate_image_file,
+    validate_image_detail,
     RequestContextFilter,
+    APIError,
     ValidationError,
-    ModelError
+    ModelError,
+    DeadlineExceededError,
+    ServiceOverloadedError
+)
+from health import health_bp, record_inference_metrics, register_metrics_provider
+from compression import ResponseCompression, static_response
+from batching import (
+    TextItem,
+    ImageItem,
+    plan_batches,
+    plan_image_batches,
+    tokenize_chat_prompt
+)
+from cancellation import control_for_request, raise_if_stopped
+from scheduler import inference_queue, token_budget
+from warmup import start_warmup
+from static_decode import enable_static_decode
+from speculative import enable_speculative_decode, prompt_lookup, DECODING_MODES
+from vision_pruning import enable_vision_pruning
+from image_questions import question_stats
+from replicas import LocalReplica, build_pool
+from residency import residency_manager
+from sessions import session_store
+from phash import image_cache, dhash, request_key
+from disk_cache import generation_cache, cache_key, image_digest
+from coalescing import single_flight
+from imaging import (
+    ImageRejected,
+    decode_image,
+    decode_images_parallel,
+    decode_image_buffer,
+    read_body_into_buffer,
+    mapped_file,
+    resize_for_detail,
+    detail_stats
 )
-from health import health_bp, record_inference_metrics
 
 # ===============================
 # Logging Setup
@@ -66,9 +104,12 @@ CORS(app, origins=config.security.allowed_origins)
 # Initialize middleware
 RequestIDMiddleware(app)
 setup_error_handlers(app)
+compression = ResponseCompression(app)
 
 # Register blueprints
 app.register_blueprint(health_bp, url_prefix='/api')
+register_metrics_provider("inference_queue", inference_queue.get_stats)
+register_metrics_provider("token_budget", token_budget.get_stats)
 
 # ===============================
 # Model Loading
@@ -113,11 +154,73 @@ model_avision = AutoModelForImageTextToText.from_pretrained(
     local_files_only=True,
     low_cpu_mem_usage=True,
 )
+# Batched requests need prompts aligned to the right edge for generation
+processor_avision.tokenizer.padding_side = "left"
 logger.info(f"✅ Avision загружен за {time.time() - start_time:.2f} сек")
 logger.info("="*70)
 logger.info("🎉 Все модели загружены! Сервер готов к работе")
 logger.info("="*70)
 
+# Статические формы декодирования (опционально): KV-кеш выделяется заранее, шаг декодирования компилируется
+if config.model.static_decode:
+    static_decoder = enable_static_decode(model_avibe)
+    register_metrics_provider("static_decode", static_decoder.get_stats)
+
+# Спекулятивное декодирование (опционально): малая draft-модель предлагает токены, Avibe проверяет их за один проход
+if config.model.speculative_draft_model:
+    speculative_decoder = enable_speculative_decode(model_avibe, tokenizer_avibe)
+    if speculative_decoder is not None:
+        register_metrics_provider("speculative_decode", speculative_decoder.get_stats)
+
+# Прореживание визуальных токенов (опционально): похожие на соседей патчи изображения не попадают в языковую модель
+if config.model.vision_keep_ratio < 1.0:
+    vision_pruner = enable_vision_pruning(model_avision)
+    if vision_pruner is not None:
+        register_metrics_provider("vision_pruning", vision_pruner.get_stats)
+
+# Пулы реплик: основная копия модели + дополнительные (AVIBE_REPLICAS / AVISION_REPLICAS)
+avibe_pool = build_pool(
+    "avibe",
+    LocalReplica("avibe-0", str(model_avibe.device), model_avibe, tokenizer_avibe),
+    config.model.avibe_replicas,
+    loader="replicas:load_avibe",
+)
+avision_pool = build_pool(
+    "avision",
+    LocalReplica("avision-0", str(model_avision.device), model_avision, processor_avision),
+    config.model.avision_replicas,
+    loader="replicas:load_avision",
+)
+# Each replica can run one generation at a time, so each pool gets one queue slot per replica
+inference_queue.concurrency = max(inference_queue.concurrency, len(avibe_pool), len(avision_pool))
+inference_queue.set_slots(avibe_pool.name, len(avibe_pool))
+inference_queue.set_slots(avision_pool.name, len(avision_pool))
+register_metrics_provider("chat_sessions", session_store.get_stats)
+# Сессии чата живут в памяти одного процесса: при WORKERS > 1 следующий ход может попасть в другой worker
+if config.server.workers > 1:
+    logger.warning(
+        f"⚠️ WORKERS={config.server.workers}: chat sessions are kept in one worker's memory, "
+        "so turns routed to another worker get 404. Run chat sessions with WORKERS=1"
+    )
+if image_cache is not None:
+    register_metrics_provider("image_cache", image_cache.get_stats)
+if generation_cache is not None:
+    register_metrics_provider("generation_cache", generation_cache.get_stats)
+register_metrics_provider("coalescing", single_flight.get_stats)
+register_metrics_provider("prompt_lookup", prompt_lookup.get_stats)
+register_metrics_provider("image_detail", detail_stats.get_stats)
+register_metrics_provider("image_questions", question_stats.get_stats)
+register_metrics_provider("replicas", lambda: {"avibe": avibe_pool.get_stats(), "avision": avision_pool.get_stats()})
+
+# Резидентность: простаивающая модель выгружается из GPU и возвращается при следующем запросе
+if config.model.residency_enabled:
+    residency_manager.register("avibe", model_avibe)
+    residency_manager.register("avision", model_avision)
+    register_metrics_provider("residency", residency_manager.get_stats)
+
+# Прогрев в фоне: /api/health/ready отвечает 503, пока он не закончится
+start_warmup(model_avibe, tokenizer_avibe, model_avision, processor_avision)
+
 # ===============================
 # HTML Template (unchanged for UI)
 # ===============================
@@ -514,7 +617,55 @@ HTML = """
 # Routes
 # ===============================
 
+def _generation_key(model: str, prompt: str, max_tokens: int, temperature, image_bytes=None, detail=None):
+    """
+    Exact identity of a generation request (model, prompt, image bytes and detail, sampling parameters)
+
+    Used as the persistent cache key and to coalesce identical in-flight
+    requests; None when both are turned off.
+    """
+    if generation_cache is None and not single_flight.enabled:
+        return None
+    params = {
+        "max_tokens": max_tokens,
+        "temperature": float(temperature),
+        "top_p": config.model.top_p,
+        "repetition_penalty": config.model.repetition_penalty,
+    }
+    if detail is not None:
+        params["detail"] = detail
+        if config.model.vision_keep_ratio < 1.0:
+            params["vision_keep_ratio"] = config.model.vision_keep_ratio
+    return cache_key(model, prompt, params, image_digest(image_bytes) if image_bytes is not None else "")
+
+
+def _stored_key(key, temperature):
+    """
+    Persistent cache key of a request, or None when its answer must not be stored
+
+    Only greedy (temperature 0) answers are stored: a sampled answer is one
+    draw of many, and serving it forever would freeze it for every client.
+    """
+    if generation_cache is None or float(temperature) > 0:
+        return None
+    return key
+
+
+def _cached_result(data: dict) -> dict:
+    """A stored answer shaped like a fresh single-item generation result"""
+    return {"data": data, "metrics": {"generation_time": 0.0, "tokens_per_second": 0.0}}
+
+
+def _generate_one(pool, task: str, max_tokens: int, control, **kwargs) -> dict:
+    """One queued single-item generation on the least-loaded replica"""
+    with inference_queue.admit(max_tokens, control.remaining(), pool=pool.name) as ticket:
+        result, = pool.run(task, max_tokens, control, **kwargs)
+        ticket.generated_tokens = result["data"]["generated_tokens"]
+    return result
+
+
 @app.route("/", methods=["GET"])
+@static_response
 def index():
     """Main page"""
     return render_template_string(HTML)
@@ -539,34 +690,48 @@ def route_avibe():
         logger.info(f"│ Промпт: {prompt[:50]}{'...' if len(prompt) > 50 else '':<14}│")
         
         # Prepare input
-        messages = [{"role": "user", "content": prompt}]
-        text = tokenizer_avibe.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
-        inputs = tokenizer_avibe([text], return_tensors="pt").to(model_avibe.device)
+        input_ids = validate_prompt_tokens(tokenize_chat_prompt(tokenizer_avibe, prompt))
+        max_tokens = token_budget.apply(config.model.max_tokens_avibe)
+        item = TextItem(
+            index=0,
+            prompt=prompt,
+            max_tokens=max_tokens,
+            temperature=config.model.temperature,
+            input_ids=input_ids,
+        )
         
-        logger.info(f"│ Входных токенов: {inputs.input_ids.shape[1]:<49}│")
+        logger.info(f"│ Входных токенов: {item.input_len:<49}│")
         logger.info("│ ⏳ Генерация ответа...                                           │")
         
-        # Generate
-        gen_start = time.time()
-        generated_ids = model_avibe.generate(
-            **inputs,
-            max_new_tokens=config.model.max_tokens_avibe,
-            do_sample=True,
-            temperature=config.model.temperature,
-            top_p=config.model.top_p,
-            repetition_penalty=config.model.repetition_penalty,
-            pad_token_id=tokenizer_avibe.eos_token_id,
-            use_cache=True,
-        )
-        gen_time = time.time() - gen_start
+        # Generate (or take the answer from the persistent cache)
+        control = control_for_request()
+        key = _generation_key("avibe", prompt, max_tokens, config.model.temperature)
+        stored_key = _stored_key(key, config.model.temperature)
+        stored = generation_cache.get(stored_key) if stored_key else None
+        coalesced = False
+        if stored:
+            result = _cached_result(stored)
+        else:
+            result, leader = single_flight.run(key, lambda: _generate_one(
+                avibe_pool,
+                "text_batch",
+                max_tokens,
+                control,
+                batch=[item],
+                top_p=config.model.top_p,
+                repetition_penalty=config.model.repetition_penalty,
+            ), control)
+            coalesced = not leader
         
         # Process output
-        input_len = inputs.input_ids.shape[1]
-        gen_ids = generated_ids[:, input_len:]
-        generated_tokens = gen_ids.shape[1]
-        tokens_per_sec = generated_tokens / gen_time
+        generated_tokens = result["data"]["generated_tokens"]
+        gen_time = result["metrics"]["generation_time"]
+        tokens_per_sec = result["metrics"]["tokens_per_second"]
         
-        response = tokenizer_avibe.decode(gen_ids[0], skip_special_tokens=True)
+        response = result["data"]["text"]
+        raise_if_stopped(control, partial_text=response, generated_tokens=generated_tokens)
+        if stored_key and not stored and not coalesced:
+            generation_cache.put(stored_key, result["data"])
         total_time = time.time() - request_start
         
         logger.info(f"│ ✅ Сгенерировано токенов: {generated_tokens:<42}│")
@@ -581,12 +746,15 @@ def route_avibe():
             'tokens_per_sec': f"{tokens_per_sec:.2f}",
             'gen_time': f"{gen_time:.2f}",
             'generated_tokens': generated_tokens,
+            'max_tokens': max_tokens,
             'total_time': f"{total_time:.2f}"
         }
         
         success = True
         return render_template_string(HTML, result=response, image_data=None, metrics=metrics)
     
+    except APIError:
+        raise
     except Exception as e:
         logger.exception("Error in avibe endpoint")
         raise ModelError(f"Failed to generate response: {str(e)}")
@@ -613,6 +781,7 @@ def route_avision():
         # Validate inputs
         prompt2 = request.form.get("prompt2", "")
         prompt2 = validate_prompt(prompt2)
+        detail = validate_image_detail(request.form.get("detail", "auto"))
         
         file = request.files.get("image")
         validate_image_file(file)
@@ -625,51 +794,54 @@ def route_avision():
         
         # Process image
         image_bytes = file.read()
-        img = Image.open(io.BytesIO(image_bytes)).convert("RGB")
+        img = decode_image(image_bytes)
         logger.info(f"│ Размер изображения: {img.size[0]}x{img.size[1]}{' '*(43-len(f'{img.size[0]}x{img.size[1]}'))}│")
         
-        # Prepare inputs
-        messages = [
-            {
-                "role": "user",
-                "content": [
-                    {"type": "image", "image": img},
-                    {"type": "text", "text": prompt2}
-                ],
-            }
-        ]
-        
-        chat_text = processor_avision.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
-        inputs = processor_avision(
-            text=[chat_text],
-            images=img,
-            return_tensors="pt",
-            padding=True
-        ).to(model_avision.device)
-        
-        logger.info(f"│ Входных токенов: {inputs.input_ids.shape[1]:<49}│")
         logger.info("│ ⏳ Генерация ответа...                                           │")
         
-        # Generate
-        gen_start = time.time()
-        generated_ids = model_avision.generate(
-            **inputs,
-            max_new_tokens=config.model.max_tokens_avision,
-            do_sample=True,
-            temperature=config.model.temperature,
-            top_p=config.model.top_p,
-            repetition_penalty=config.model.repetition_penalty,
-            use_cache=True,
-        )
-        gen_time = time.time() - gen_start
+        # Generate (or reuse the answer for a near-identical recent photo)
+        control = control_for_request()
+        max_tokens = token_budget.apply(config.model.max_tokens_avision)
+        key = _generation_key("avision", prompt2, max_tokens, config.model.temperature, image_bytes, detail)
+        stored_key = _stored_key(key, config.model.temperature)
+        stored = generation_cache.get(stored_key) if stored_key else None
+        image_key = _image_cache_key(img, prompt2, max_tokens, config.model.temperature, detail)
+        hit = image_cache.lookup(*image_key) if image_key and not stored else None
+        coalesced = False
+        if stored:
+            result = _cached_result(stored)
+        elif hit:
+            data, distance = hit
+            logger.info(f"│ ♻️  Ответ из кеша похожих изображений (distance={distance}){' '*(16-len(str(distance)))}│")
+            result = {"data": data, "metrics": {"generation_time": 0.0, "tokens_per_second": 0.0}}
+        else:
+            result, leader = single_flight.run(key, lambda: _generate_one(
+                avision_pool,
+                "image_batch",
+                max_tokens,
+                control,
+                batch=[_image_item(0, prompt2, img, detail)],
+                max_new_tokens=max_tokens,
+                temperature=config.model.temperature,
+                top_p=config.model.top_p,
+                repetition_penalty=config.model.repetition_penalty,
+            ), control)
+            coalesced = not leader
+            if leader:
+                detail_stats.record(result["metrics"])
         
         # Process output
-        input_ids_len = inputs.input_ids.shape[1]
-        generated_text_ids = generated_ids[:, input_ids_len:]
-        generated_tokens = generated_text_ids.shape[1]
-        tokens_per_sec = generated_tokens / gen_time
+        generated_tokens = result["data"]["generated_tokens"]
+        gen_time = result["metrics"]["generation_time"]
+        tokens_per_sec = result["metrics"]["tokens_per_second"]
+        logger.info(f"│ Входных токенов: {result['data']['input_tokens']:<49}│")
         
-        response = processor_avision.batch_decode(generated_text_ids, skip_special_tokens=True)[0]
+        response = result["data"]["text"]
+        raise_if_stopped(control, partial_text=response, generated_tokens=generated_tokens)
+        if image_key and not hit and not stored and not coalesced:
+            image_cache.store(*image_key, result["data"])
+        if stored_key and not stored and not coalesced:
+            generation_cache.put(stored_key, result["data"])
         total_time = time.time() - request_start
         
         logger.info(f"│ ✅ Сгенерировано токенов: {generated_tokens:<42}│")
@@ -684,6 +856,7 @@ def route_avision():
             'tokens_per_sec': f"{tokens_per_sec:.2f}",
             'gen_time': f"{gen_time:.2f}",
             'generated_tokens': generated_tokens,
+            'max_tokens': max_tokens,
             'total_time': f"{total_time:.2f}"
         }
         
@@ -691,6 +864,8 @@ def route_avision():
         success = True
         return render_template_string(HTML, result=response, image_data=img_data, metrics=metrics)
     
+    except APIError:
+        raise
     except Exception as e:
         logger.exception("Error in avision endpoint")
         raise ModelError(f"Failed to analyze image: {str(e)}")
@@ -718,8 +893,10 @@ def api_generate_text():
     Request body:
     {
         "prompt": "Your question here",
-        "max_tokens": 256,  // optional
-        "temperature": 0.7  // optional
+        "max_tokens": 256,  // optional; shortened under load when omitted
+        "temperature": 0.7, // optional
+        "timeout": 30,      // optional, seconds (also X-Request-Timeout header)
+        "decoding": "auto"  // optional; "prompt_lookup" for answers that copy from the prompt
     }
     """
     request_start = time.time()
@@ -734,44 +911,64 @@ def api_generate_text():
         prompt = data.get("prompt", "")
         prompt = validate_prompt(prompt)
         
-        max_tokens = data.get("max_tokens", config.model.max_tokens_avibe)
+        max_tokens = data.get("max_tokens")
+        if max_tokens is None:
+            max_tokens = token_budget.apply(config.model.max_tokens_avibe)
         temperature = data.get("temperature", config.model.temperature)
+        decoding = data.get("decoding", "auto")
         
         # Validate parameters
-        if not isinstance(max_tokens, int) or max_tokens < 1 or max_tokens > 1024:
-            raise ValidationError("max_tokens must be between 1 and 1024")
-        if not isinstance(temperature, (int, float)) or temperature < 0 or temperature > 2:
-            raise ValidationError("temperature must be between 0 and 2")
+        validate_generation_params(max_tokens, temperature)
+        if decoding not in DECODING_MODES:
+            raise ValidationError(f"decoding must be one of: {', '.join(DECODING_MODES)}")
+        input_ids = validate_prompt_tokens(tokenize_chat_prompt(tokenizer_avibe, prompt))
         
-        logger.info(f"API text generation request: prompt_length={len(prompt)}, max_tokens={max_tokens}")
+        logger.info(
+            f"API text generation request: prompt_length={len(prompt)}, input_tokens={len(input_ids)}, "
+            f"max_tokens={max_tokens}, decoding={decoding}"
+        )
         
         # Generate
-        messages = [{"role": "user", "content": prompt}]
-        text = tokenizer_avibe.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
-        inputs = tokenizer_avibe([text], return_tensors="pt").to(model_avibe.device)
-        
-        gen_start = time.time()
-        generated_ids = model_avibe.generate(
-            **inputs,
-            max_new_tokens=max_tokens,
-            do_sample=True,
-            temperature=temperature,
-            top_p=config.model.top_p,
-            repetition_penalty=config.model.repetition_penalty,
-            pad_token_id=tokenizer_avibe.eos_token_id,
-            use_cache=True,
+        item = TextItem(
+            index=0,
+            prompt=prompt,
+            max_tokens=max_tokens,
+            temperature=float(temperature),
+            input_ids=input_ids,
+            decoding=decoding,
         )
-        gen_time = time.time() - gen_start
         
-        input_len = inputs.input_ids.shape[1]
-        gen_ids = generated_ids[:, input_len:]
-        generated_tokens = gen_ids.shape[1]
+        control = control_for_request(data.get("timeout"))
+        key = _generation_key("avibe", prompt, max_tokens, temperature)
+        stored_key = _stored_key(key, temperature)
+        stored = generation_cache.get(stored_key) if stored_key else None
+        coalesced = False
+        if stored:
+            result = _cached_result(stored)
+        else:
+            result, leader = single_flight.run(key, lambda: _generate_one(
+                avibe_pool,
+                "text_batch",
+                max_tokens,
+                control,
+                batch=[item],
+                top_p=config.model.top_p,
+                repetition_penalty=config.model.repetition_penalty,
+            ), control)
+            coalesced = not leader
         
-        response_text = tokenizer_avibe.decode(gen_ids[0], skip_special_tokens=True)
+        input_len = item.input_len
+        generated_tokens = result["data"]["generated_tokens"]
+        gen_time = result["metrics"]["generation_time"]
+        
+        response_text = result["data"]["text"]
+        raise_if_stopped(control, partial_text=response_text, generated_tokens=generated_tokens)
+        if stored_key and not stored and not coalesced:
+            generation_cache.put(stored_key, result["data"])
         total_time = time.time() - request_start
         
         success = True
-        return jsonify({
+        response = {
             "success": True,
             "data": {
                 "text": response_text,
@@ -781,11 +978,21 @@ def api_generate_text():
             "metrics": {
                 "generation_time": round(gen_time, 3),
                 "total_time": round(total_time, 3),
-                "tokens_per_second": round(generated_tokens / gen_time, 2)
+                "tokens_per_second": result["metrics"]["tokens_per_second"],
+                "max_tokens_applied": max_tokens
             },
             "request_id": g.request_id
-        }), 200
+        }
+        if "speculative" in result["metrics"]:
+            response["metrics"]["speculative"] = result["metrics"]["speculative"]
+        if coalesced:
+            response["cache"] = {"hit": True, "source": "in_flight"}
+        elif stored_key:
+            response["cache"] = {"hit": bool(stored), "source": "disk"} if stored else {"hit": False}
+        return jsonify(response), 200
     
+    except APIError:
+        raise
     except Exception as e:
         logger.exception("Error in API text generation")
         raise
@@ -794,6 +1001,953 @@ def api_generate_text():
         record_inference_metrics("avibe", success, time.time() - request_start, generated_tokens)
 
 
+@app.route("/api/v1/chat/sessions", methods=["POST"])
+@rate_limit_required
+def api_create_chat_session():
+    """
+    Start a multi-turn chat session (its KV cache stays on the server)
+
+    Request body (optional):
+    {
+        "system": "You help sellers write listings"  // optional system prompt
+    }
+    """
+    data = request.get_json(silent=True) or {}
+    system = data.get("system")
+    if system is not None:
+        system = validate_prompt(system)
+    session = session_store.create(system)
+    logger.info(f"Chat session created: {session.id}")
+    return jsonify({
+        "success": True,
+        "data": {
+            "session_id": session.id,
+            "expires_in": config.sessions.ttl
+        },
+        "request_id": g.request_id
+    }), 201
+
+
+@app.route("/api/v1/chat/sessions/<session_id>/messages", methods=["POST"])
+@rate_limit_required
+def api_chat_message(session_id):
+    """
+    Send the next user message of a chat session
+
+    Only the new message is prefilled; earlier turns come from the session's
+    KV cache. Request body:
+    {
+        "message": "And what price should I set?",
+        "max_tokens": 256,  // optional; shortened under load when omitted
+        "temperature": 0.7, // optional
+        "timeout": 30       // optional, seconds (also X-Request-Timeout header)
+    }
+    """
+    request_start = time.time()
+    success = False
+    generated_tokens = 0
+
+    try:
+        data = request.get_json()
+        if not data:
+            raise ValidationError("Request body must be JSON")
+
+        message = validate_prompt(data.get("message", ""))
+        # Earlier turns come from the KV cache, so the new message is what this turn prefills
+        validate_prompt_tokens(tokenize_chat_prompt(tokenizer_avibe, message))
+        max_tokens = data.get("max_tokens")
+        if max_tokens is None:
+            max_tokens = token_budget.apply(config.model.max_tokens_avibe)
+        temperature = data.get("temperature", config.model.temperature)
+        validate_generation_params(max_tokens, temperature)
+
+        session = session_store.get(session_id)
+        control = control_for_request(data.get("timeout"))
+        with session.lock:
+            with inference_queue.admit(max_tokens, control.remaining(), pool=avibe_pool.name) as ticket:
+                # The cache lives next to the primary model, so every turn runs there
+                result = avibe_pool.run_on(
+                    avibe_pool.replicas[0],
+                    "chat_turn",
+                    max_tokens,
+                    control,
+                    session=session,
+                    message=message,
+                    max_tokens=max_tokens,
+                    temperature=float(temperature),
+                    top_p=config.model.top_p,
+                    repetition_penalty=config.model.repetition_penalty,
+                )
+                ticket.generated_tokens = result["data"]["generated_tokens"]
+            # A stopped turn was not added to the history; its cache still counts toward the memory cap
+            session_store.record_turn(session, result)
+
+        generated_tokens = result["data"]["generated_tokens"]
+        # A turn that finished (and is in the history) is answered even if the deadline passed meanwhile
+        if result["stopped"]:
+            raise_if_stopped(control, partial_text=result["data"]["text"], generated_tokens=generated_tokens)
+
+        success = True
+        return jsonify({
+            "success": True,
+            "data": {
+                "session_id": session.id,
+                "text": result["data"]["text"],
+                "generated_tokens": generated_tokens,
+                "input_tokens": result["data"]["input_tokens"],
+                "turn": session.turns
+            },
+            "metrics": {
+                "cached_tokens": result["metrics"]["cached_tokens"],
+                "prefill_tokens": result["metrics"]["prefill_tokens"],
+                "generation_time": result["metrics"]["generation_time"],
+                "total_time": round(time.time() - request_start, 3),
+                "tokens_per_second": result["metrics"]["tokens_per_second"],
+                "max_tokens_applied": max_tokens
+            },
+            "request_id": g.request_id
+        }), 200
+
+    except APIError:
+        raise
+    except Exception as e:
+        logger.exception("Error in chat session turn")
+        raise
+
+    finally:
+        record_inference_metrics("avibe", success, time.time() - request_start, generated_tokens)
+
+
+@app.route("/api/v1/chat/sessions/<session_id>", methods=["DELETE"])
+def api_delete_chat_session(session_id):
+    """End a chat session and free its KV cache"""
+    session_store.delete(session_id)
+    return jsonify({"success": True, "request_id": g.request_id}), 200
+
+
+def _fail_remaining_batches(batches, results, control, endpoint: str) -> None:
+    """
+    Mark every item of unfinished batches as failed after the deadline passed
+    A disconnected client gets nothing back, so that case propagates as an error
+    """
+    try:
+        raise_if_stopped(control)
+    except DeadlineExceededError as e:
+        error = e.to_dict()
+    for batch in batches:
+        for item in batch:
+            results[item.index] = {"index": item.index, "success": False, "error": error}
+            record_inference_metrics(endpoint, False, 0.0, 0)
+
+
+def _fail_shed_batches(batches, results, error: ServiceOverloadedError, endpoint: str) -> None:
+    """Mark every item of batches that were refused by the inference queue as failed"""
+    error = error.to_dict()
+    for batch in batches:
+        for item in batch:
+            results[item.index] = {"index": item.index, "success": False, "error": error}
+            record_inference_metrics(endpoint, False, 0.0, 0)
+
+
+def _batch_item_count() -> int:
+    """Rate-limit cost of a batch request: one unit per item"""
+    data = request.get_json(silent=True) or {}
+    items = data.get("items") if isinstance(data, dict) else None
+    return len(items) if isinstance(items, list) else 1
+
+
+@app.route("/api/v1/text/generate_batch", methods=["POST"])
+@rate_limit_cost(_batch_item_count)
+def api_generate_text_batch():
+    """
+    API endpoint for batched text generation (JSON)
+    
+    Request body:
+    {
+        "items": [
+            {"prompt": "First question", "max_tokens": 128},
+            {"prompt": "Second question", "temperature": 0.3}
+        ],
+        "max_tokens": 256,  // optional default for items; shortened under load when omitted
+        "temperature": 0.7  // optional default for items
+    }
+    
+    Prompts are bucketed by token length and generated as padded batches
+    within the per-batch prefill token budget. Results come back in input order; an invalid item gets its own error
+    without failing the rest of the batch.
+    """
+    request_start = time.time()
+    
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        raise ValidationError("Request body must be JSON")
+    
+    raw_items = data.get("items")
+    if not isinstance(raw_items, list) or not raw_items:
+        raise ValidationError("items must be a non-empty list")
+    if len(raw_items) > config.security.max_batch_items:
+        raise ValidationError(f"Too many items. Maximum: {config.security.max_batch_items}")
+    
+    default_max_tokens = data.get("max_tokens")
+    if default_max_tokens is None:
+        default_max_tokens = token_budget.apply(config.model.max_tokens_avibe)
+    default_temperature = data.get("temperature", config.model.temperature)
+    validate_generation_params(default_max_tokens, default_temperature)
+    
+    results = [None] * len(raw_items)
+    items = []
+    stored_keys = {}
+    for index, raw in enumerate(raw_items):
+        try:
+            if not isinstance(raw, dict):
+                raise ValidationError("Item must be an object")
+            prompt = validate_prompt(raw.get("prompt", ""))
+            max_tokens = raw.get("max_tokens", default_max_tokens)
+            temperature = raw.get("temperature", default_temperature)
+            validate_generation_params(max_tokens, temperature)
+            stored_key = _stored_key(_generation_key("avibe", prompt, max_tokens, temperature), temperature)
+            stored = generation_cache.get(stored_key) if stored_key else None
+            if stored:
+                results[index] = {
+                    "index": index,
+                    "success": True,
+                    "data": stored,
+                    "metrics": {"generation_time": 0.0},
+                    "cache": {"hit": True, "source": "disk"},
+                }
+                record_inference_metrics("avibe", True, time.time() - request_start, 0)
+                continue
+            input_ids = validate_prompt_tokens(tokenize_chat_prompt(tokenizer_avibe, prompt))
+            if stored_key:
+                stored_keys[index] = stored_key
+            items.append(TextItem(
+                index=index,
+                prompt=prompt,
+                max_tokens=max_tokens,
+                temperature=float(temperature),
+                input_ids=input_ids,
+            ))
+        except ValidationError as e:
+            results[index] = {"index": index, "success": False, "error": e.to_dict()}
+    
+    batches = plan_batches(items, config.model.max_batch_size, config.model.max_batch_prefill_tokens)
+    logger.info(f"API batch text generation request: items={len(raw_items)}, valid={len(items)}, batches={len(batches)}")
+    
+    control = control_for_request(data.get("timeout"))
+    for batch_number, batch in enumerate(batches):
+        if control.should_stop():
+            _fail_remaining_batches(batches[batch_number:], results, control, "avibe")
+            break
+        batch_start = time.time()
+        try:
+            with inference_queue.admit(
+                sum(item.max_tokens for item in batch), control.remaining(), pool=avibe_pool.name
+            ) as ticket:
+                batch_results = avibe_pool.run(
+                    "text_batch",
+                    sum(item.max_tokens for item in batch),
+                    control,
+                    batch=batch,
+                    top_p=config.model.top_p,
+                    repetition_penalty=config.model.repetition_penalty,
+                )
+                ticket.generated_tokens = sum(result["data"]["generated_tokens"] for result in batch_results)
+            if control.stop_reason:
+                _fail_remaining_batches(batches[batch_number:], results, control, "avibe")
+                break
+            for result in batch_results:
+                results[result["index"]] = result
+                stored_key = stored_keys.get(result["index"])
+                if stored_key:
+                    generation_cache.put(stored_key, result["data"])
+                    result["cache"] = {"hit": False}
+                record_inference_metrics(
+                    "avibe",
+                    True,
+                    time.time() - batch_start,
+                    result["data"]["generated_tokens"]
+                )
+        except ServiceOverloadedError as e:
+            if batch_number == 0:
+                raise
+            _fail_shed_batches(batches[batch_number:], results, e, "avibe")
+            break
+        except Exception as e:
+            logger.exception("Error in API batch text generation")
+            error = ModelError(f"Failed to generate response: {str(e)}").to_dict()
+            for item in batch:
+                results[item.index] = {"index": item.index, "success": False, "error": error}
+                record_inference_metrics("avibe", False, time.time() - batch_start, 0)
+    
+    total_time = time.time() - request_start
+    succeeded = sum(1 for result in results if result["success"])
+    
+    return jsonify({
+        "success": succeeded == len(results),
+        "data": {
+            "results": results
+        },
+        "metrics": {
+            "items": len(results),
+            "succeeded": succeeded,
+            "failed": len(results) - succeeded,
+            "batches": len(batches),
+            "max_tokens_applied": default_max_tokens,
+            "total_time": round(total_time, 3),
+            "total_generated_tokens": sum(
+                result["data"]["generated_tokens"] for result in results if result["success"]
+            )
+        },
+        "request_id": g.request_id
+    }), 200
+
+
+def _resolve_local_image(path) -> str:
+    """Map a caller-supplied path to a real file under LOCAL_IMAGE_ROOT"""
+    root = config.security.local_image_root
+    if not root:
+        raise ValidationError("Local image paths are not enabled on this server", status_code=403)
+    if not isinstance(path, str) or not path:
+        raise ValidationError("path must be a non-empty string")
+    root = os.path.realpath(root)
+    resolved = os.path.realpath(os.path.join(root, path))
+    if os.path.commonpath([root, resolved]) != root:
+        raise ValidationError("path is outside the allowed image directory", status_code=403)
+    if not os.path.isfile(resolved):
+        raise ValidationError("Image file not found", status_code=404)
+    return resolved
+
+
+def _check_image_size(size: int) -> None:
+    max_size = config.server.max_content_length
+    if size > max_size:
+        raise ValidationError(f"File too large. Maximum size: {max_size / (1024*1024):.0f}MB")
+    if size == 0:
+        raise ValidationError("File is empty")
+
+
+def _image_cache_key(img, prompt: str, max_tokens: int, temperature, detail: str):
+    """
+    (perceptual hash, request key) of an analysis request, or None when it must not be cached
+
+    Like the persistent cache, only greedy (temperature 0) answers are
+    stored and reused; see _stored_key.
+    """
+    if image_cache is None or float(temperature) > 0:
+        return None
+    return dhash(img), request_key(prompt, max_tokens, float(temperature), detail)
+
+
+def _image_item(index: int, prompt: str, img, detail: str, decode_time: float = 0.0) -> ImageItem:
+    """Batch item for an uploaded image, downscaled here so replicas never receive the full-size photo"""
+    resized = resize_for_detail(img, detail)
+    return ImageItem(
+        index=index,
+        prompt=prompt,
+        image=resized,
+        decode_time=decode_time,
+        detail=detail,
+        original_size=img.size if resized is not img else None,
+    )
+
+
+@app.route("/api/v1/image/analyze", methods=["POST"])
+@rate_limit_required
+def api_analyze_image():
+    """
+    API endpoint for single image analysis (JSON response)
+    
+    Raw body upload:
+        POST /api/v1/image/analyze?prompt=Опиши+товар&max_tokens=200
+        Content-Type: image/jpeg   (or application/octet-stream)
+        <image bytes>
+    
+    Local file reference (internal callers, requires LOCAL_IMAGE_ROOT):
+    {
+        "path": "2024/11/123456.jpg",  // relative to LOCAL_IMAGE_ROOT
+        "prompt": "Опиши товар",
+        "max_tokens": 200,              // optional
+        "temperature": 0.7,             // optional
+        "detail": "auto"                // optional; "low" for cheap checks, "high" for full resolution
+    }
+    
+    The body is read into a single preallocated buffer (or the file is
+    memory-mapped) and decoded through a memoryview, so the encoded image
+    is held in memory once.
+    """
+    request_start = time.time()
+    success = False
+    generated_tokens = 0
+    
+    try:
+        if request.mimetype == "application/json":
+            data = request.get_json(silent=True)
+            if not isinstance(data, dict):
+                raise ValidationError("Request body must be JSON")
+            source = _resolve_local_image(data.get("path"))
+            prompt = data.get("prompt", "")
+            max_tokens = data.get("max_tokens")
+            temperature = data.get("temperature", config.model.temperature)
+            timeout = data.get("timeout")
+            detail = data.get("detail", "auto")
+        elif request.mimetype.startswith("image/") or request.mimetype == "application/octet-stream":
+            source = None
+            prompt = request.args.get("prompt", "")
+            max_tokens = request.args.get("max_tokens", type=int)
+            temperature = request.args.get("temperature", type=float, default=config.model.temperature)
+            timeout = request.args.get("timeout")
+            detail = request.args.get("detail", "auto")
+        else:
+            raise ValidationError(
+                "Content-Type must be image/*, application/octet-stream or application/json",
+                status_code=415
+            )
+        
+        prompt = validate_prompt(prompt)
+        if max_tokens is None:
+            max_tokens = token_budget.apply(config.model.max_tokens_avision)
+        validate_generation_params(max_tokens, temperature)
+        detail = validate_image_detail(detail)
+        
+        decode_start = time.time()
+        try:
+            if source is None:
+                if request.content_length is None:
+                    raise ValidationError("Content-Length header is required", status_code=411)
+                _check_image_size(request.content_length)
+                body = read_body_into_buffer(request.stream, request.content_length)
+                img = decode_image_buffer(body)
+                key = _generation_key("avision", prompt, max_tokens, temperature, body, detail)
+                del body
+            else:
+                _check_image_size(os.path.getsize(source))
+                with mapped_file(source) as view:
+                    img = decode_image_buffer(view)
+                    key = _generation_key("avision", prompt, max_tokens, temperature, view, detail)
+        except ImageRejected as e:
+            raise ValidationError(str(e))
+        except (ValueError, OSError) as e:
+            logger.warning(f"Failed to decode image: {e}")
+            raise ValidationError("Cannot decode image")
+        decode_time = time.time() - decode_start
+        
+        logger.info(
+            f"API image analysis request: image={img.size[0]}x{img.size[1]}, detail={detail}, max_tokens={max_tokens}"
+        )
+        
+        # The same image seen before (exact, then near-duplicate) is answered from cache
+        stored_key = _stored_key(key, temperature)
+        stored = generation_cache.get(stored_key) if stored_key else None
+        image_key = _image_cache_key(img, prompt, max_tokens, temperature, detail)
+        hit = image_cache.lookup(*image_key) if image_key and not stored else None
+        if stored or hit:
+            if stored:
+                data, cache_info = stored, {"hit": True, "source": "disk"}
+            else:
+                data, distance = hit
+                cache_info = {"hit": True, "source": "near_duplicate", "distance": distance}
+                logger.info(f"Near-duplicate image cache hit: distance={distance}")
+            success = True
+            return jsonify({
+                "success": True,
+                "data": data,
+                "metrics": {
+                    "decode_time": round(decode_time, 3),
+                    "generation_time": 0.0,
+                    "total_time": round(time.time() - request_start, 3),
+                    "max_tokens_applied": max_tokens
+                },
+                "cache": cache_info,
+                "request_id": g.request_id
+            }), 200
+        
+        control = control_for_request(timeout)
+        result, leader = single_flight.run(key, lambda: _generate_one(
+            avision_pool,
+            "image_batch",
+            max_tokens,
+            control,
+            batch=[_image_item(0, prompt, img, detail, decode_time)],
+            max_new_tokens=max_tokens,
+            temperature=float(temperature),
+            top_p=config.model.top_p,
+            repetition_penalty=config.model.repetition_penalty,
+        ), control)
+        generated_tokens = result["data"]["generated_tokens"]
+        raise_if_stopped(control, partial_text=result["data"]["text"], generated_tokens=generated_tokens)
+        if leader:
+            detail_stats.record(result["metrics"])
+        if leader and image_key:
+            image_cache.store(*image_key, result["data"])
+        if leader and stored_key:
+            generation_cache.put(stored_key, result["data"])
+        
+        success = True
+        # A coalesced result is shared with the other waiting requests, so it is not modified in place
+        response = {
+            "success": True,
+            "data": result["data"],
+            "metrics": {
+                **result["metrics"],
+                "total_time": round(time.time() - request_start, 3),
+                "max_tokens_applied": max_tokens
+            },
+            "request_id": g.request_id
+        }
+        if not leader:
+            response["cache"] = {"hit": True, "source": "in_flight"}
+        elif image_key or stored_key:
+            response["cache"] = {"hit": False}
+        return jsonify(response), 200
+    
+    except APIError:
+        raise
+    except Exception as e:
+        logger.exception("Error in API image analysis")
+        raise ModelError(f"Failed to analyze image: {str(e)}")
+    
+    finally:
+        record_inference_metrics("avision", success, time.time() - request_start, generated_tokens)
+
+
+def _read_questions(raw) -> dict:
+    """Questions of a multi-question request, keyed the way answers come back (a list is keyed by its text)"""
+    if isinstance(raw, list) and all(isinstance(question, str) for question in raw):
+        raw = {question: question for question in raw}
+    if not isinstance(raw, dict):
+        raise ValidationError("questions must be a list of strings or an object of named questions")
+    if not raw:
+        raise ValidationError("No questions provided")
+    if len(raw) > config.security.max_image_questions:
+        raise ValidationError(f"Too many questions. Maximum: {config.security.max_image_questions}")
+    return {str(name): validate_prompt(question) for name, question in raw.items()}
+
+
+def _question_count() -> int:
+    """Rate-limit cost of a multi-question request: one unit per question"""
+    if request.files:
+        return len(request.form.getlist("questions"))
+    data = request.get_json(silent=True) or {}
+    questions = data.get("questions") if isinstance(data, dict) else None
+    return len(questions) if isinstance(questions, (list, dict)) else 1
+
+
+@app.route("/api/v1/image/ask", methods=["POST"])
+@rate_limit_cost(_question_count)
+def api_ask_image():
+    """
+    API endpoint for several questions about one image (JSON response)
+    
+    Multipart request:
+        image=@a.jpg
+        questions="Придумай заголовок", questions="Какая категория?"  (repeated field)
+    
+    JSON request:
+    {
+        "image": "<base64>",                 // or "path" (requires LOCAL_IMAGE_ROOT)
+        "questions": {"title": "Придумай заголовок", "category": "Какая категория?"},
+                                             // or a list; answers are then keyed by the question text
+        "max_tokens": 200,                   // optional, per answer
+        "temperature": 0.7,                  // optional
+        "detail": "auto"                     // optional
+    }
+    
+    The image is decoded, preprocessed and encoded once, and the shared
+    image + chat template prefix is prefilled once; the questions are then
+    decoded as one batch. Answers already in the caches (for the same image
+    and question) are reused.
+    """
+    request_start = time.time()
+    success = False
+    generated_tokens = 0
+    
+    try:
+        source = None
+        if request.files:
+            file = request.files.get("image")
+            validate_image_file(file)
+            image_bytes = file.read()
+            questions = _read_questions(request.form.getlist("questions"))
+            max_tokens = request.form.get("max_tokens", type=int)
+            temperature = request.form.get("temperature", type=float, default=config.model.temperature)
+            timeout = request.form.get("timeout")
+            detail = request.form.get("detail", "auto")
+        else:
+            data = request.get_json(silent=True)
+            if not isinstance(data, dict):
+                raise ValidationError("Request must be multipart/form-data with an image or a JSON body")
+            if data.get("path") is not None:
+                source = _resolve_local_image(data.get("path"))
+                image_bytes = None
+            else:
+                try:
+                    image_bytes = b64decode(data.get("image") or "", validate=True)
+                except (Base64Error, ValueError, TypeError):
+                    raise ValidationError("image must be base64-encoded")
+                _check_image_size(len(image_bytes))
+            questions = _read_questions(data.get("questions"))
+            max_tokens = data.get("max_tokens")
+            temperature = data.get("temperature", config.model.temperature)
+            timeout = data.get("timeout")
+            detail = data.get("detail", "auto")
+        
+        if max_tokens is None:
+            max_tokens = token_budget.apply(config.model.max_tokens_avision)
+        validate_generation_params(max_tokens, temperature)
+        detail = validate_image_detail(detail)
+        
+        decode_start = time.time()
+        try:
+            if source is None:
+                img = decode_image(image_bytes)
+                keys = {
+                    name: _generation_key("avision", question, max_tokens, temperature, image_bytes, detail)
+                    for name, question in questions.items()
+                }
+            else:
+                _check_image_size(os.path.getsize(source))
+                with mapped_file(source) as view:
+                    img = decode_image_buffer(view)
+                    keys = {
+                        name: _generation_key("avision", question, max_tokens, temperature, view, detail)
+                        for name, question in questions.items()
+                    }
+        except ImageRejected as e:
+            raise ValidationError(str(e))
+        except (ValueError, OSError) as e:
+            logger.warning(f"Failed to decode image: {e}")
+            raise ValidationError("Cannot decode image")
+        decode_time = time.time() - decode_start
+        
+        # Answers seen before for this image (exact, then near-duplicate) are not generated again
+        answers, cache_info, pending = {}, {}, []
+        for name, question in questions.items():
+            stored_key = _stored_key(keys[name], temperature)
+            stored = generation_cache.get(stored_key) if stored_key else None
+            image_key = _image_cache_key(img, question, max_tokens, temperature, detail)
+            hit = image_cache.lookup(*image_key) if image_key and not stored else None
+            if stored:
+                answers[name], cache_info[name] = stored, {"hit": True, "source": "disk"}
+            elif hit:
+                answers[name], distance = hit
+                cache_info[name] = {"hit": True, "source": "near_duplicate", "distance": distance}
+            else:
+                pending.append((name, question, stored_key, image_key))
+        
+        logger.info(
+            f"API image questions request: image={img.size[0]}x{img.size[1]}, detail={detail}, "
+            f"questions={len(questions)}, cached={len(answers)}, max_tokens={max_tokens}"
+        )
+        
+        metrics = {"decode_time": round(decode_time, 3), "generation_time": 0.0}
+        if pending:
+            control = control_for_request(timeout)
+            estimated_tokens = max_tokens * len(pending)
+            with inference_queue.admit(estimated_tokens, control.remaining(), pool=avision_pool.name) as ticket:
+                results = avision_pool.run(
+                    "image_questions",
+                    estimated_tokens,
+                    control,
+                    item=_image_item(0, "", img, detail, decode_time),
+                    questions=[question for _, question, _, _ in pending],
+                    max_new_tokens=max_tokens,
+                    temperature=float(temperature),
+                    top_p=config.model.top_p,
+                    repetition_penalty=config.model.repetition_penalty,
+                )
+                generated_tokens = sum(result["data"]["generated_tokens"] for result in results)
+                ticket.generated_tokens = generated_tokens
+            raise_if_stopped(
+                control,
+                partial_answers={name: result["data"]["text"] for (name, *_), result in zip(pending, results)},
+                generated_tokens=generated_tokens,
+            )
+            detail_stats.record(results[0]["metrics"])
+            question_stats.record(results)
+            for (name, _, stored_key, image_key), result in zip(pending, results):
+                answers[name] = result["data"]
+                if image_key:
+                    image_cache.store(*image_key, result["data"])
+                if stored_key:
+                    generation_cache.put(stored_key, result["data"])
+                if image_key or stored_key:
+                    cache_info[name] = {"hit": False}
+            metrics = {
+                key: results[0]["metrics"][key]
+                for key in ("detail", "vision_tokens", "vision_tokens_kept", "shared_prefix_tokens",
+                            "decode_time", "preprocess_time", "generation_time")
+                if key in results[0]["metrics"]
+            }
+        
+        success = True
+        response = {
+            "success": True,
+            "data": {
+                "answers": {name: answers[name]["text"] for name in questions},
+                "generated_tokens": {name: answers[name]["generated_tokens"] for name in questions},
+                "image_size": list(img.size),
+            },
+            "metrics": {
+                **metrics,
+                "questions": len(questions),
+                "generated_questions": len(pending),
+                "total_time": round(time.time() - request_start, 3),
+                "max_tokens_applied": max_tokens
+            },
+            "request_id": g.request_id
+        }
+        if cache_info:
+            response["cache"] = {name: cache_info[name] for name in questions if name in cache_info}
+        return jsonify(response), 200
+    
+    except APIError:
+        raise
+    except Exception as e:
+        logger.exception("Error in API image questions")
+        raise ModelError(f"Failed to answer questions about image: {str(e)}")
+    
+    finally:
+        record_inference_metrics("avision", success, time.time() - request_start, generated_tokens)
+
+
+def _image_item_count() -> int:
+    """Rate-limit cost of an image batch request: one unit per image"""
+    if request.files:
+        return len(request.files.getlist("images"))
+    return _batch_item_count()
+
+
+def _read_image_batch_request():
+    """
+    Collect (prompt, image_bytes or error) pairs from a multipart or JSON batch request
+    Returns (entries, defaults) where defaults holds request-level parameters
+    """
+    if request.files:
+        files = request.files.getlist("images")
+        prompts = request.form.getlist("prompts")
+        default_prompt = request.form.get("prompt", "")
+        if prompts and len(prompts) != len(files):
+            raise ValidationError("prompts must have one entry per image")
+        defaults = {
+            "max_tokens": request.form.get("max_tokens", type=int),
+            "temperature": request.form.get("temperature", type=float, default=config.model.temperature),
+            "timeout": request.form.get("timeout"),
+            "detail": request.form.get("detail", "auto"),
+        }
+        entries = []
+        for index, file in enumerate(files):
+            prompt = prompts[index] if prompts else default_prompt
+            try:
+                validate_image_file(file)
+                entries.append((prompt, file.read(), None))
+            except ValidationError as e:
+                entries.append((prompt, None, e))
+        return entries, defaults
+    
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        raise ValidationError("Request must be multipart/form-data with images or a JSON body")
+    raw_items = data.get("items")
+    if not isinstance(raw_items, list):
+        raise ValidationError("items must be a list")
+    defaults = {
+        "max_tokens": data.get("max_tokens"),
+        "temperature": data.get("temperature", config.model.temperature),
+        "timeout": data.get("timeout"),
+        "detail": data.get("detail", "auto"),
+    }
+    default_prompt = data.get("prompt", "")
+    entries = []
+    for raw in raw_items:
+        if not isinstance(raw, dict):
+            entries.append(("", None, ValidationError("Item must be an object")))
+            continue
+        prompt = raw.get("prompt", default_prompt)
+        try:
+            image_bytes = b64decode(raw.get("image") or "", validate=True)
+        except (Base64Error, ValueError, TypeError):
+            entries.append((prompt, None, ValidationError("image must be base64-encoded")))
+            continue
+        if not image_bytes:
+            entries.append((prompt, None, ValidationError("No image file provided")))
+        elif len(image_bytes) > config.server.max_content_length:
+            entries.append((prompt, None, ValidationError("File too large")))
+        else:
+            entries.append((prompt, image_bytes, None))
+    return entries, defaults
+
+
+@app.route("/api/v1/image/analyze_batch", methods=["POST"])
+@rate_limit_cost(_image_item_count)
+def api_analyze_image_batch():
+    """
+    API endpoint for batched image analysis (JSON response)
+    
+    Multipart request:
+        images=@a.jpg, images=@b.jpg          (repeated file field)
+        prompts="Вопрос 1", prompts="Вопрос 2" (optional, one per image)
+        prompt="Общий вопрос"                  (optional default)
+    
+    JSON request:
+    {
+        "items": [{"image": "<base64>", "prompt": "Опиши товар"}, ...],
+        "prompt": "Общий вопрос",  // optional default
+        "max_tokens": 200,          // optional
+        "temperature": 0.7,         // optional
+        "detail": "auto"            // optional, applies to every image
+    }
+    
+    Images are decoded in parallel, bucketed by resolution and run through
+    Avision as padded batches. Results come back in input order.
+    """
+    request_start = time.time()
+    
+    entries, defaults = _read_image_batch_request()
+    if not entries:
+        raise ValidationError("No images provided")
+    if len(entries) > config.security.max_image_batch_items:
+        raise ValidationError(f"Too many images. Maximum: {config.security.max_image_batch_items}")
+    
+    max_tokens = defaults["max_tokens"]
+    if max_tokens is None:
+        max_tokens = token_budget.apply(config.model.max_tokens_avision)
+    temperature = defaults["temperature"]
+    validate_generation_params(max_tokens, temperature)
+    detail = validate_image_detail(defaults["detail"])
+    
+    results = [None] * len(entries)
+    pending = []
+    for index, (prompt, image_bytes, error) in enumerate(entries):
+        try:
+            if error:
+                raise error
+            pending.append((index, validate_prompt(prompt), image_bytes))
+        except ValidationError as e:
+            results[index] = {"index": index, "success": False, "error": e.to_dict()}
+    
+    decode_start = time.time()
+    decoded = decode_images_parallel([image_bytes for _, _, image_bytes in pending])
+    decode_wall_time = time.time() - decode_start
+    
+    items = []
+    image_keys = {}
+    stored_keys = {}
+    for (index, prompt, image_bytes), image in zip(pending, decoded):
+        if image.error:
+            results[index] = {
+                "index": index,
+                "success": False,
+                "error": ValidationError(image.error).to_dict()
+            }
+            continue
+        stored_key = _stored_key(
+            _generation_key("avision", prompt, max_tokens, temperature, image_bytes, detail), temperature
+        )
+        stored = generation_cache.get(stored_key) if stored_key else None
+        image_key = _image_cache_key(image.image, prompt, max_tokens, temperature, detail)
+        hit = image_cache.lookup(*image_key) if image_key and not stored else None
+        if stored or hit:
+            if stored:
+                data, cache_info = stored, {"hit": True, "source": "disk"}
+            else:
+                data, distance = hit
+                cache_info = {"hit": True, "source": "near_duplicate", "distance": distance}
+            results[index] = {
+                "index": index,
+                "success": True,
+                "data": data,
+                "metrics": {"decode_time": round(image.decode_time, 3), "generation_time": 0.0},
+                "cache": cache_info,
+            }
+            record_inference_metrics("avision", True, time.time() - request_start, 0)
+            continue
+        if image_key:
+            image_keys[index] = image_key
+        if stored_key:
+            stored_keys[index] = stored_key
+        items.append(_image_item(index, prompt, image.image, detail, image.decode_time))
+    
+    batches = plan_image_batches(items, config.model.max_image_batch_size)
+    logger.info(
+        f"API batch image analysis request: images={len(entries)}, valid={len(items)}, "
+        f"cached={sum(1 for result in results if result and result.get('cache'))}, batches={len(batches)}"
+    )
+    
+    control = control_for_request(defaults["timeout"])
+    for batch_number, batch in enumerate(batches):
+        if control.should_stop():
+            _fail_remaining_batches(batches[batch_number:], results, control, "avision")
+            break
+        batch_start = time.time()
+        try:
+            with inference_queue.admit(max_tokens * len(batch), control.remaining(), pool=avision_pool.name) as ticket:
+                batch_results = avision_pool.run(
+                    "image_batch",
+                    max_tokens * len(batch),
+                    control,
+                    batch=batch,
+                    max_new_tokens=max_tokens,
+                    temperature=float(temperature),
+                    top_p=config.model.top_p,
+                    repetition_penalty=config.model.repetition_penalty,
+                )
+                ticket.generated_tokens = sum(result["data"]["generated_tokens"] for result in batch_results)
+            if control.stop_reason:
+                _fail_remaining_batches(batches[batch_number:], results, control, "avision")
+                break
+            for result in batch_results:
+                results[result["index"]] = result
+                detail_stats.record(result["metrics"])
+                image_key = image_keys.get(result["index"])
+                if image_key:
+                    image_cache.store(*image_key, result["data"])
+                stored_key = stored_keys.get(result["index"])
+                if stored_key:
+                    generation_cache.put(stored_key, result["data"])
+                if image_key or stored_key:
+                    result["cache"] = {"hit": False}
+                record_inference_metrics(
+                    "avision",
+                    True,
+                    time.time() - batch_start,
+                    result["data"]["generated_tokens"]
+                )
+        except ServiceOverloadedError as e:
+            if batch_number == 0:
+                raise
+            _fail_shed_batches(batches[batch_number:], results, e, "avision")
+            break
+        except Exception as e:
+            logger.exception("Error in API batch image analysis")
+            error = ModelError(f"Failed to analyze image: {str(e)}").to_dict()
+            for item in batch:
+                results[item.index] = {"index": item.index, "success": False, "error": error}
+                record_inference_metrics("avision", False, time.time() - batch_start, 0)
+    
+    total_time = time.time() - request_start
+    succeeded = sum(1 for result in results if result["success"])
+    
+    return jsonify({
+        "success": succeeded == len(results),
+        "data": {
+            "results": results
+        },
+        "metrics": {
+            "images": len(results),
+            "succeeded": succeeded,
+            "failed": len(results) - succeeded,
+            "batches": len(batches),
+            "max_tokens_applied": max_tokens,
+            "decode_time": round(decode_wall_time, 3),
+            "total_time": round(total_time, 3),
+            "total_generated_tokens": sum(
+                result["data"]["generated_tokens"] for result in results if result["success"]
+            )
+        },
+        "request_id": g.request_id
+    }), 200
+
+
 # ===============================
 # Graceful Shutdown
 # ===============================
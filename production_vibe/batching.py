@@ -0,0 +1,323 @@
+"""
+Batched Generation
+Groups prompts into length buckets and runs them as padded batches
+"""
+import time
+import logging
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+import torch
+
+from static_decode import generate_padded
+from speculative import get_speculative_decoder, prompt_lookup
+from vision_pruning import get_vision_pruner
+
+logger = logging.getLogger(__name__)
+
+
+# ===============================
+# Batch Items
+# ===============================
+
+@dataclass
+class TextItem:
+    """One prompt of a batch request, tokenized once up front"""
+    index: int
+    prompt: str
+    max_tokens: int
+    temperature: float
+    input_ids: List[int] = field(default_factory=list)
+    decoding: str = "auto"  # "prompt_lookup" copies candidate tokens from the prompt (batch size 1)
+
+    @property
+    def input_len(self) -> int:
+        return len(self.input_ids)
+
+
+def plan_batches(items: List[TextItem], max_batch_size: int, max_prefill_tokens: int = 0) -> List[List[TextItem]]:
+    """
+    Split items into batches that waste as little padding as possible
+
+    Items sharing a temperature can go through one generate() call. Within
+    such a group, sorting by prompt length (then max_tokens) and cutting
+    consecutive runs keeps every batch's prompts close in length. A batch is
+    also cut before its padded prefill (rows x longest prompt) would exceed
+    max_prefill_tokens, so long prompts run in smaller batches (0 = no cap).
+    """
+    groups: Dict[float, List[TextItem]] = {}
+    for item in items:
+        groups.setdefault(item.temperature, []).append(item)
+
+    batches = []
+    for group in groups.values():
+        group.sort(key=lambda item: (item.input_len, item.max_tokens))
+        batch: List[TextItem] = []
+        for item in group:
+            # Sorted by length, so the new item is the longest prompt of the batch
+            over_budget = max_prefill_tokens and (len(batch) + 1) * item.input_len > max_prefill_tokens
+            if batch and (len(batch) >= max_batch_size or over_budget):
+                batches.append(batch)
+                batch = []
+            batch.append(item)
+        if batch:
+            batches.append(batch)
+    return batches
+
+
+def left_pad(sequences: List[List[int]], pad_token_id: int, device) -> Dict[str, torch.Tensor]:
+    """Left-pad token id lists so every row ends at the generation position"""
+    width = max(len(seq) for seq in sequences)
+    input_ids = torch.full((len(sequences), width), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(sequences), width), dtype=torch.long)
+    for row, seq in enumerate(sequences):
+        if seq:
+            input_ids[row, width - len(seq):] = torch.tensor(seq, dtype=torch.long)
+            attention_mask[row, width - len(seq):] = 1
+    return {
+        "input_ids": input_ids.to(device),
+        "attention_mask": attention_mask.to(device),
+    }
+
+
+def trim_generated(row: torch.Tensor, eos_token_id: Optional[int], max_tokens: int) -> List[int]:
+    """Cut one generated row at its first EOS (inclusive) and at the item's own budget"""
+    tokens = row.tolist()[:max_tokens]
+    if eos_token_id is not None and eos_token_id in tokens:
+        tokens = tokens[:tokens.index(eos_token_id) + 1]
+    return tokens
+
+
+# ===============================
+# Text Batch Generation
+# ===============================
+
+def tokenize_chat_prompt(tokenizer, prompt: str) -> List[int]:
+    """Apply the chat template to a single-turn prompt and return its token ids"""
+    messages = [{"role": "user", "content": prompt}]
+    text = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+    return tokenizer(text)["input_ids"]
+
+
+def generate_text_batch(
+    model,
+    tokenizer,
+    batch: List[TextItem],
+    top_p: float,
+    repetition_penalty: float,
+    stopping_criteria=None,
+) -> List[Dict[str, Any]]:
+    """
+    Run one padded generate() call for a batch of items
+    Returns per-item results in the batch's order
+    """
+    pad_token_id = tokenizer.pad_token_id
+    if pad_token_id is None:
+        pad_token_id = tokenizer.eos_token_id
+
+    inputs = left_pad([item.input_ids for item in batch], pad_token_id, model.device)
+    max_new_tokens = max(item.max_tokens for item in batch)
+    temperature = batch[0].temperature
+
+    generate_kwargs = dict(
+        do_sample=temperature > 0,
+        temperature=temperature if temperature > 0 else None,
+        top_p=top_p,
+        repetition_penalty=repetition_penalty,
+        use_cache=True,
+        stopping_criteria=stopping_criteria,
+    )
+    speculative = get_speculative_decoder(model)
+    speculative_stats = None
+
+    gen_start = time.time()
+    if len(batch) == 1 and batch[0].decoding == "prompt_lookup":
+        generated_ids, padded_len, speculative_stats = prompt_lookup.generate(
+            model,
+            inputs["input_ids"],
+            inputs["attention_mask"],
+            pad_token_id=pad_token_id,
+            max_new_tokens=max_new_tokens,
+            **generate_kwargs
+        )
+    elif speculative is not None and speculative.accepts(len(batch), temperature > 0):
+        generated_ids, padded_len, speculative_stats = speculative.generate(
+            inputs["input_ids"],
+            inputs["attention_mask"],
+            pad_token_id=pad_token_id,
+            max_new_tokens=max_new_tokens,
+            **generate_kwargs
+        )
+    else:
+        generated_ids, padded_len = generate_padded(
+            model,
+            inputs["input_ids"],
+            inputs["attention_mask"],
+            pad_token_id=pad_token_id,
+            max_new_tokens=max_new_tokens,
+            **generate_kwargs
+        )
+    gen_time = time.time() - gen_start
+
+    gen_ids = generated_ids[:, padded_len:].cpu()
+
+    results = []
+    for row, item in enumerate(batch):
+        tokens = trim_generated(gen_ids[row], tokenizer.eos_token_id, item.max_tokens)
+        results.append({
+            "index": item.index,
+            "success": True,
+            "data": {
+                "text": tokenizer.decode(tokens, skip_special_tokens=True),
+                "generated_tokens": len(tokens),
+                "input_tokens": item.input_len,
+            },
+            "metrics": {
+                "batch_size": len(batch),
+                "padded_input_tokens": padded_len,
+                "generation_time": round(gen_time, 3),
+                "tokens_per_second": round(len(tokens) / gen_time, 2) if gen_time > 0 else 0.0,
+            },
+        })
+        if speculative_stats is not None:
+            results[-1]["metrics"]["speculative"] = speculative_stats
+
+    logger.info(
+        f"Batch generated: size={len(batch)}, padded_len={padded_len}, "
+        f"max_new_tokens={max_new_tokens}, time={gen_time:.2f}s"
+    )
+    return results
+
+
+# ===============================
+# Image Batch Generation
+# ===============================
+
+@dataclass
+class ImageItem:
+    """One image + prompt pair of a batch request (image already resized for its detail level)"""
+    index: int
+    prompt: str
+    image: Any
+    decode_time: float = 0.0
+    detail: str = "auto"
+    original_size: Optional[Tuple[int, int]] = None  # uploaded size, when the image was downscaled
+
+    @property
+    def pixels(self) -> int:
+        return self.image.size[0] * self.image.size[1]
+
+
+def plan_image_batches(items: List[ImageItem], max_batch_size: int) -> List[List[ImageItem]]:
+    """
+    Split image items into batches of similar input length
+
+    The number of vision tokens grows with image resolution, so sorting by
+    pixel count (then prompt length) keeps padding inside a batch small.
+    """
+    ordered = sorted(items, key=lambda item: (item.pixels, len(item.prompt)))
+    return [ordered[start:start + max_batch_size] for start in range(0, len(ordered), max_batch_size)]
+
+
+def build_vision_chat(processor, prompt: str, image) -> str:
+    """Apply the Avision chat template to a single image + prompt turn"""
+    messages = [
+        {
+            "role": "user",
+            "content": [
+                {"type": "image", "image": image},
+                {"type": "text", "text": prompt}
+            ],
+        }
+    ]
+    return processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+
+
+def count_vision_tokens(processor, input_ids: torch.Tensor) -> Optional[List[int]]:
+    """Image placeholder tokens per row of a processed batch (None if the processor does not say which id they use)"""
+    image_token_id = getattr(processor, "image_token_id", None)
+    if image_token_id is None:
+        return None
+    return (input_ids == image_token_id).sum(dim=1).tolist()
+
+
+def generate_image_batch(
+    model,
+    processor,
+    batch: List[ImageItem],
+    max_new_tokens: int,
+    temperature: float,
+    top_p: float,
+    repetition_penalty: float,
+    stopping_criteria=None,
+) -> List[Dict[str, Any]]:
+    """
+    Run one padded generate() call for a batch of images
+    Returns per-item results in the batch's order
+    """
+    tokenizer = processor.tokenizer
+    texts = [build_vision_chat(processor, item.prompt, item.image) for item in batch]
+
+    prep_start = time.time()
+    inputs = processor(
+        text=texts,
+        images=[item.image for item in batch],
+        return_tensors="pt",
+        padding=True
+    ).to(model.device)
+    prep_time = time.time() - prep_start
+
+    generate_kwargs = dict(
+        max_new_tokens=max_new_tokens,
+        do_sample=temperature > 0,
+        temperature=temperature if temperature > 0 else None,
+        top_p=top_p,
+        repetition_penalty=repetition_penalty,
+        use_cache=True,
+        stopping_criteria=stopping_criteria,
+    )
+    pruner = get_vision_pruner(model)
+    kept_tokens = None
+
+    gen_start = time.time()
+    if pruner is not None:
+        generated_ids, padded_len, kept_tokens = pruner.generate(inputs, **generate_kwargs)
+    else:
+        generated_ids = model.generate(**inputs, **generate_kwargs)
+        padded_len = inputs.input_ids.shape[1]
+    gen_time = time.time() - gen_start
+
+    input_lens = inputs.attention_mask.sum(dim=1).tolist()
+    vision_tokens = count_vision_tokens(processor, inputs.input_ids)
+    gen_ids = generated_ids[:, padded_len:].cpu()
+
+    results = []
+    for row, item in enumerate(batch):
+        tokens = trim_generated(gen_ids[row], tokenizer.eos_token_id, max_new_tokens)
+        results.append({
+            "index": item.index,
+            "success": True,
+            "data": {
+                "text": tokenizer.decode(tokens, skip_special_tokens=True),
+                "generated_tokens": len(tokens),
+                "input_tokens": int(input_lens[row]),
+                "image_size": list(item.original_size or item.image.size),
+            },
+            "metrics": {
+                "batch_size": len(batch),
+                "detail": item.detail,
+                "vision_tokens": int(vision_tokens[row]) if vision_tokens is not None else None,
+                "decode_time": round(item.decode_time, 3),
+                "preprocess_time": round(prep_time, 3),
+                "generation_time": round(gen_time, 3),
+                "tokens_per_second": round(len(tokens) / gen_time, 2) if gen_time > 0 else 0.0,
+            },
+        })
+        if kept_tokens is not None:
+            results[-1]["metrics"]["vision_tokens_kept"] = kept_tokens[row]
+
+    logger.info(
+        f"Image batch generated: size={len(batch)}, padded_len={padded_len}, "
+        f"max_new_tokens={max_new_tokens}, time={gen_time:.2f}s"
+    )
+    return results
@@ -0,0 +1,120 @@
+"""
+Incremental Detokenization Benchmark
+Per-token cost of naive full re-decoding vs the incremental detokenizer, and output equality
+
+A byte-level BPE (like Avibe's) and a SentencePiece-style tokenizer are trained
+on the fly with a small vocabulary, so Cyrillic letters are often split into
+byte pieces across tokens. Pass --tokenizer to use a real tokenizer instead.
+
+Usage (from production_vibe/):
+    python -m benchmarks.bench_detokenize
+    python -m benchmarks.bench_detokenize --tokenizer /path/to/avibe --lengths 1000,8000,32000
+"""
+import time
+import argparse
+
+from tokenizers import Tokenizer, decoders, models, normalizers, pre_tokenizers, trainers
+from transformers import AutoTokenizer, PreTrainedTokenizerFast
+
+from detokenize import IncrementalDetokenizer, REPLACEMENT_CHAR
+
+TEXT = (
+    "Продаю велосипед Stels Navigator 500, рама 18\", 21 скорость — дисковые тормоза. "
+    "Куплен в 2022 году, катался мало; хранился в квартире. Цена: 15 000 ₽, торг уместен! "
+    "Ёлочные игрушки, щётка, объём 2,5 л, «Жигули» — всё в хорошем состоянии 👍. "
+)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Naive vs incremental detokenization")
+    parser.add_argument("--tokenizer", help="HF tokenizer id or local path (default: small trained tokenizers)")
+    parser.add_argument("--lengths", default="500,2000,8000", help="output lengths in tokens")
+    parser.add_argument("--vocab", type=int, default=400)
+    return parser.parse_args()
+
+
+def trained_tokenizers(vocab: int):
+    """Byte-level BPE (GPT-2/Qwen style) and Metaspace BPE (SentencePiece style) with tiny vocabularies"""
+    corpus = [TEXT] * 20
+    byte_level = Tokenizer(models.BPE())
+    byte_level.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    byte_level.decoder = decoders.ByteLevel()
+    byte_level.train_from_iterator(corpus, trainers.BpeTrainer(
+        vocab_size=vocab, initial_alphabet=pre_tokenizers.ByteLevel.alphabet(), show_progress=False
+    ))
+
+    metaspace = Tokenizer(models.BPE(byte_fallback=True))
+    metaspace.normalizer = normalizers.Replace(" ", "▁")
+    metaspace.pre_tokenizer = pre_tokenizers.Metaspace()
+    metaspace.decoder = decoders.Sequence([decoders.ByteFallback(), decoders.Fuse(), decoders.Metaspace()])
+    byte_tokens = [f"<0x{value:02X}>" for value in range(256)]
+    metaspace.train_from_iterator(corpus, trainers.BpeTrainer(
+        vocab_size=vocab + 256, special_tokens=byte_tokens, show_progress=False, limit_alphabet=40
+    ))
+    return {
+        "byte-level BPE": PreTrainedTokenizerFast(tokenizer_object=byte_level),
+        "sentencepiece-style": PreTrainedTokenizerFast(tokenizer_object=metaspace),
+    }
+
+
+def token_stream(tokenizer, length: int):
+    ids = []
+    while len(ids) < length:
+        ids.extend(tokenizer(TEXT, add_special_tokens=False)["input_ids"])
+    return ids[:length]
+
+
+def naive(tokenizer, ids):
+    """What a streaming layer does without offsets: decode everything, diff against the last text"""
+    chunks, previous = [], ""
+    for end in range(1, len(ids) + 1):
+        text = tokenizer.decode(ids[:end], skip_special_tokens=True)
+        chunks.append(text[len(previous):])
+        previous = text
+    return chunks
+
+
+def incremental(tokenizer, ids):
+    detokenizer = IncrementalDetokenizer(tokenizer)
+    chunks = [detokenizer.step(token_id) for token_id in ids]
+    chunks.append(detokenizer.finish())
+    return chunks
+
+
+def main():
+    args = parse_args()
+    lengths = [int(length) for length in args.lengths.split(",")]
+    if args.tokenizer:
+        tokenizers = {args.tokenizer: AutoTokenizer.from_pretrained(args.tokenizer)}
+    else:
+        tokenizers = trained_tokenizers(args.vocab)
+
+    for name, tokenizer in tokenizers.items():
+        sample = token_stream(tokenizer, 200)
+        pieces = [tokenizer.decode([token_id]) for token_id in sample]
+        split = sum(REPLACEMENT_CHAR in piece for piece in pieces)
+        print(f"\n{name}: {split} of 200 tokens are partial UTF-8 characters on their own")
+        for length in lengths:
+            ids = token_stream(tokenizer, length)
+            reference = tokenizer.decode(ids, skip_special_tokens=True)
+
+            start = time.perf_counter()
+            chunks = incremental(tokenizer, ids)
+            incremental_us = 1e6 * (time.perf_counter() - start) / length
+            joined = "".join(chunks)
+            # The final flush may end in a character the stream itself cut in half
+            broken = sum(REPLACEMENT_CHAR in chunk for chunk in chunks[:-1])
+
+            line = (f"  {length:6,} tokens: incremental {incremental_us:6.1f} us/token "
+                    f"(matches full decode: {joined == reference}, chunks with U+FFFD: {broken})")
+            if length <= 8000:
+                start = time.perf_counter()
+                naive_chunks = naive(tokenizer, ids)
+                naive_us = 1e6 * (time.perf_counter() - start) / length
+                naive_broken = sum(REPLACEMENT_CHAR in chunk for chunk in naive_chunks)
+                line += f"; naive {naive_us:8.1f} us/token ({naive_broken} chunks with U+FFFD)"
+            print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Generation Cache Benchmark
+Warm read latency, concurrent writers in several processes, and size-based eviction
+
+Usage (from production_vibe/):
+    python -m benchmarks.bench_disk_cache
+    python -m benchmarks.bench_disk_cache --path /var/cache/avito-ai/bench.sqlite3 --entries 200000
+"""
+import os
+import time
+import random
+import argparse
+import tempfile
+import statistics
+from multiprocessing import Process
+
+from disk_cache import DiskCache, cache_key
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="SQLite generation cache latency and concurrency")
+    parser.add_argument("--path", default=os.path.join(tempfile.mkdtemp(prefix="gencache-"), "bench.sqlite3"))
+    parser.add_argument("--entries", type=int, default=50_000)
+    parser.add_argument("--reads", type=int, default=20_000)
+    parser.add_argument("--writers", type=int, default=4)
+    parser.add_argument("--writes-per-process", type=int, default=2_000)
+    parser.add_argument("--max-mb", type=int, default=64)
+    return parser.parse_args()
+
+
+def answer(index: int) -> dict:
+    return {"text": f"Ответ номер {index}. " * 20, "generated_tokens": 120, "input_tokens": 40}
+
+
+def key(index: int) -> str:
+    return cache_key("avibe", f"prompt {index}", {"max_tokens": 256, "temperature": 0.7})
+
+
+def writer(path: str, worker: int, count: int, max_bytes: int) -> None:
+    cache = DiskCache(path, max_bytes)
+    for index in range(count):
+        cache.put(key(10_000_000 * (worker + 1) + index), answer(index))
+
+
+def main():
+    args = parse_args()
+    max_bytes = args.max_mb * 1024 ** 2
+    cache = DiskCache(args.path, max_bytes)
+    print(f"cache file: {args.path}")
+
+    start = time.perf_counter()
+    for index in range(args.entries):
+        cache.put(key(index), answer(index))
+    elapsed = time.perf_counter() - start
+    print(f"fill: {args.entries:,} entries in {elapsed:.2f}s ({1e6 * elapsed / args.entries:.1f} us/put)")
+
+    rng = random.Random(0)
+    keys = [key(rng.randrange(args.entries)) for _ in range(args.reads)]
+    for warm in keys[:1000]:
+        cache.get(warm)
+    timings = []
+    for lookup in keys:
+        start = time.perf_counter()
+        cache.get(lookup)
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    print(f"warm get: p50 {1e6 * statistics.median(timings):.1f} us, "
+          f"p99 {1e6 * timings[int(0.99 * len(timings))]:.1f} us")
+
+    start = time.perf_counter()
+    processes = [
+        Process(target=writer, args=(args.path, worker, args.writes_per_process, max_bytes))
+        for worker in range(args.writers)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    elapsed = time.perf_counter() - start
+    total = args.writers * args.writes_per_process
+    failed = sum(1 for process in processes if process.exitcode != 0)
+    print(f"{args.writers} writer processes: {total:,} puts in {elapsed:.2f}s, {failed} failed")
+
+    cache.evict()
+    stats = cache.get_stats()
+    print(f"after eviction: {stats['entries']:,} entries, {stats['size_mb']} MB (limit {stats['max_size_mb']} MB)")
+
+
+if __name__ == "__main__":
+    main()
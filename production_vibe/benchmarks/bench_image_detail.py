@@ -0,0 +1,178 @@
+"""
+Image Detail Benchmark
+Vision tokens and latency of one Avision request at each detail level
+
+Without --model, a small randomly initialised Qwen2-VL (dynamic resolution,
+one vision token per 28x28 pixels like Avision) stands in for the real model,
+so timings show the relative cost of the levels rather than production
+latency. The photo is ../car5.jpeg, also upscaled to typical phone sizes.
+
+Usage (from production_vibe/):
+    python -m benchmarks.bench_image_detail
+    python -m benchmarks.bench_image_detail --model /path/to/avision --device cuda:0 --sizes 1600x1200,4032x3024
+"""
+import time
+import argparse
+import statistics
+
+import torch
+from PIL import Image
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+from transformers import (
+    AutoModelForImageTextToText,
+    AutoProcessor,
+    BatchFeature,
+    PreTrainedTokenizerFast,
+    Qwen2VLConfig,
+    Qwen2VLForConditionalGeneration,
+    Qwen2VLImageProcessorPil,
+)
+
+from batching import generate_image_batch, ImageItem
+from imaging import DETAIL_LEVELS, resize_for_detail
+
+PROMPT = "Есть ли на фото запрещённые к продаже предметы? Ответь да или нет."
+SPECIAL_TOKENS = [
+    "<|endoftext|>", "<|im_start|>", "<|im_end|>", "<|vision_start|>", "<|vision_end|>", "<|image_pad|>", "<|video_pad|>"
+]
+CHAT_TEMPLATE = (
+    "{% for m in messages %}<|im_start|>{{ m['role'] }}\n"
+    "{% for c in m['content'] %}{% if c['type'] == 'image' %}<|vision_start|><|image_pad|><|vision_end|>"
+    "{% else %}{{ c['text'] }}{% endif %}{% endfor %}<|im_end|>\n{% endfor %}"
+    "{% if add_generation_prompt %}<|im_start|>assistant\n{% endif %}"
+)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Vision tokens and latency per image detail level")
+    parser.add_argument("--model", help="Avision snapshot directory (default: small random Qwen2-VL stand-in)")
+    parser.add_argument("--device", default="cuda:0" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--image", default="../car5.jpeg")
+    parser.add_argument("--sizes", default="original,1600x1200", help="'original' and/or WxH upscales of the photo")
+    parser.add_argument("--new-tokens", type=int, default=8, help="a moderation verdict is a few tokens")
+    parser.add_argument("--runs", type=int, default=3)
+    return parser.parse_args()
+
+
+class StandInProcessor:
+    """Qwen2-VL preprocessing: image patches plus one <|image_pad|> per merged 2x2 patch group"""
+
+    def __init__(self, image_processor, tokenizer):
+        self.image_processor = image_processor
+        self.tokenizer = tokenizer
+        self.image_token = "<|image_pad|>"
+        self.image_token_id = tokenizer.convert_tokens_to_ids(self.image_token)
+
+    def apply_chat_template(self, messages, tokenize=False, add_generation_prompt=True):
+        return self.tokenizer.apply_chat_template(
+            messages, chat_template=CHAT_TEMPLATE, tokenize=tokenize, add_generation_prompt=add_generation_prompt
+        )
+
+    def __call__(self, text, images, return_tensors="pt", padding=True):
+        vision = self.image_processor(images=images, return_tensors=return_tensors)
+        merge = self.image_processor.merge_size ** 2
+        counts = (vision["image_grid_thw"].prod(-1) // merge).tolist()
+        expanded = [prompt.replace(self.image_token, self.image_token * count) for prompt, count in zip(text, counts)]
+        encoded = self.tokenizer(expanded, return_tensors=return_tensors, padding=padding)
+        # Image placeholders get their own type so the model can build 3D rotary positions
+        encoded["mm_token_type_ids"] = (encoded["input_ids"] == self.image_token_id).int()
+        return BatchFeature({**encoded, **vision})
+
+
+def build_stand_in():
+    torch.manual_seed(0)
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    tokenizer.train_from_iterator([PROMPT] * 10, trainers.BpeTrainer(
+        vocab_size=600,
+        special_tokens=SPECIAL_TOKENS,
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+        show_progress=False,
+    ))
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=tokenizer, eos_token="<|im_end|>", pad_token="<|endoftext|>")
+    tokenizer.padding_side = "left"
+    # Pixel limits of Avision's checkpoint processor (Qwen2.5-VL defaults)
+    image_processor = Qwen2VLImageProcessorPil(min_pixels=3136, max_pixels=12845056)
+    processor = StandInProcessor(image_processor, tokenizer)
+
+    token_id = tokenizer.convert_tokens_to_ids
+    model_config = Qwen2VLConfig(
+        text_config=dict(
+            vocab_size=len(tokenizer),
+            hidden_size=512,
+            intermediate_size=1536,
+            num_hidden_layers=4,
+            num_attention_heads=8,
+            num_key_value_heads=8,
+            max_position_embeddings=32768,
+            rope_scaling={"type": "mrope", "mrope_section": [8, 12, 12]},
+            bos_token_id=None,
+            eos_token_id=None,  # always generate the full budget
+            pad_token_id=tokenizer.pad_token_id,
+        ),
+        vision_config=dict(depth=4, embed_dim=256, hidden_size=512, num_heads=4, mlp_ratio=2),
+        image_token_id=token_id("<|image_pad|>"),
+        video_token_id=token_id("<|video_pad|>"),
+        vision_start_token_id=token_id("<|vision_start|>"),
+    )
+    return Qwen2VLForConditionalGeneration(model_config).eval(), processor
+
+
+def load_real_model(args):
+    dtype = torch.float16 if args.device.startswith("cuda") else torch.float32
+    processor = AutoProcessor.from_pretrained(args.model)
+    processor.tokenizer.padding_side = "left"
+    model = AutoModelForImageTextToText.from_pretrained(args.model, torch_dtype=dtype).to(args.device).eval()
+    return model, processor
+
+
+def photos(args):
+    original = Image.open(args.image).convert("RGB")
+    for size in args.sizes.split(","):
+        if size == "original":
+            yield original
+        else:
+            width, height = (int(value) for value in size.split("x"))
+            yield original.resize((width, height), Image.BICUBIC)
+
+
+def timed(fn, runs: int, device: str):
+    timings, output = [], None
+    for _ in range(runs):
+        if device.startswith("cuda"):
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        output = fn()
+        if device.startswith("cuda"):
+            torch.cuda.synchronize()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings), output
+
+
+def main():
+    args = parse_args()
+    model, processor = load_real_model(args) if args.model else build_stand_in()
+
+    for photo in photos(args):
+        print(f"\n{photo.size[0]}x{photo.size[1]} photo:")
+        rows = {}
+        for detail in DETAIL_LEVELS:
+            image = resize_for_detail(photo, detail)
+            item = ImageItem(index=0, prompt=PROMPT, image=image, detail=detail)
+            with torch.inference_mode():
+                rows[detail] = (image.size,) + timed(
+                    lambda: generate_image_batch(
+                        model, processor, [item],
+                        max_new_tokens=args.new_tokens, temperature=0.0, top_p=1.0, repetition_penalty=1.0,
+                    ),
+                    args.runs,
+                    args.device,
+                )
+        for detail, ((width, height), elapsed, (result,)) in rows.items():
+            print(f"  {detail:<5} {width:>5}x{height:<5} {result['metrics']['vision_tokens']:>6} vision tokens  "
+                  f"{elapsed:6.2f}s  ({rows['auto'][1] / elapsed:.1f}x vs auto)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Image Questions Benchmark
+Several questions about one photo: separate calls vs one batch vs one shared-prefix call
+
+A listing photo usually needs a title, a category, a defect check and a
+price hint. Asked separately, each question encodes and prefills the whole
+image again. A batch with the image repeated does the same work in one
+call. generate_image_questions encodes and prefills it once. Without
+--model, the small random Qwen2-VL stand-in from bench_image_detail is used.
+
+Usage (from production_vibe/):
+    python -m benchmarks.bench_image_questions
+    python -m benchmarks.bench_image_questions --model /path/to/avision --device cuda:0 --size 1280x960
+"""
+import argparse
+
+import torch
+from PIL import Image
+
+from batching import ImageItem, generate_image_batch
+from image_questions import generate_image_questions
+from imaging import resize_for_detail
+from benchmarks.bench_image_detail import build_stand_in, load_real_model, timed
+
+QUESTIONS = [
+    "Придумай короткий заголовок для объявления с этим товаром.",
+    "К какой категории Авито относится товар на фото?",
+    "Есть ли на товаре видимые дефекты? Ответь да или нет.",
+    "Оцени примерную цену товара в рублях.",
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Several questions about one image: separate, batched, shared prefix")
+    parser.add_argument("--model", help="Avision snapshot directory (default: small random Qwen2-VL stand-in)")
+    parser.add_argument("--device", default="cuda:0" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--image", default="../car5.jpeg")
+    parser.add_argument("--size", default="original", help="'original' or a WxH upscale of the photo")
+    parser.add_argument("--questions", type=int, default=4, help="how many of the listing questions to ask (max 4)")
+    parser.add_argument("--new-tokens", type=int, default=16)
+    parser.add_argument("--runs", type=int, default=3)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    model, processor = load_real_model(args) if args.model else build_stand_in()
+    photo = Image.open(args.image).convert("RGB")
+    if args.size != "original":
+        width, height = (int(value) for value in args.size.split("x"))
+        photo = photo.resize((width, height), Image.BICUBIC)
+    image = resize_for_detail(photo, "auto")
+    questions = QUESTIONS[:args.questions]
+    kwargs = dict(max_new_tokens=args.new_tokens, temperature=0.0, top_p=1.0, repetition_penalty=1.0)
+    items = [ImageItem(index=index, prompt=question, image=image) for index, question in enumerate(questions)]
+
+    with torch.inference_mode():
+        separate_time, separate = timed(
+            lambda: [generate_image_batch(model, processor, [item], **kwargs)[0] for item in items],
+            args.runs,
+            args.device,
+        )
+        batch_time, _ = timed(lambda: generate_image_batch(model, processor, items, **kwargs), args.runs, args.device)
+        shared_time, shared = timed(
+            lambda: generate_image_questions(model, processor, items[0], questions, **kwargs), args.runs, args.device
+        )
+
+    vision_tokens = shared[0]["metrics"]["vision_tokens"]
+    separate_prefill = sum(result["data"]["input_tokens"] for result in separate)
+    shared_prefill = shared[0]["metrics"]["shared_prefix_tokens"] + sum(r["metrics"]["prefill_tokens"] for r in shared)
+    same = sum(a["data"]["text"] == b["data"]["text"] for a, b in zip(separate, shared))
+
+    encodes = len(questions)
+    print(f"\n{image.size[0]}x{image.size[1]} photo, {vision_tokens} vision tokens, {len(questions)} questions:")
+    print(f"  separate calls  {separate_time:6.2f}s  {encodes} vision encodes  {separate_prefill:>6} prefill tokens")
+    print(f"  one batch       {batch_time:6.2f}s  {encodes} vision encodes  {separate_prefill:>6} prefill tokens  "
+          f"({separate_time / batch_time:.1f}x)")
+    print(f"  shared prefix   {shared_time:6.2f}s  1 vision encode   {shared_prefill:>6} prefill tokens  "
+          f"({separate_time / shared_time:.1f}x)")
+    print(f"  answers identical to separate calls: {same}/{len(questions)}")
+
+
+if __name__ == "__main__":
+    main()
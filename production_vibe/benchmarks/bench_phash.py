@@ -0,0 +1,94 @@
+"""
+Near-Duplicate Cache Benchmark
+Hash robustness on a real photo and lookup cost of the index at scale
+
+Usage (from production_vibe/):
+    python -m benchmarks.bench_phash                        # ../car5.jpeg, 1M entries
+    python -m benchmarks.bench_phash --image photo.jpg --entries 200000
+"""
+import io
+import time
+import argparse
+import statistics
+
+import numpy as np
+from PIL import Image, ImageEnhance
+
+from phash import NearDuplicateCache, dhash, request_key
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="dHash robustness and index lookup cost")
+    parser.add_argument("--image", default="../car5.jpeg")
+    parser.add_argument("--entries", type=int, default=1_000_000)
+    parser.add_argument("--lookups", type=int, default=200)
+    parser.add_argument("--max-distance", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+def reencode(image: Image.Image, quality: int) -> Image.Image:
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", quality=quality)
+    return Image.open(io.BytesIO(buffer.getvalue())).convert("RGB")
+
+
+def variants(image: Image.Image):
+    """Edits sellers typically make before re-uploading the same photo"""
+    width, height = image.size
+    yield "jpeg q=60", reencode(image, 60)
+    yield "jpeg q=30", reencode(image, 30)
+    yield "resize 50%", image.resize((width // 2, height // 2))
+    yield "resize 25% + q=70", reencode(image.resize((width // 4, height // 4)), 70)
+    for share in (0.01, 0.03):
+        crop = int(min(width, height) * share)
+        yield f"crop {share:.0%} each side", image.crop((crop, crop, width - crop, height - crop))
+    yield "brightness +10%", ImageEnhance.Brightness(image).enhance(1.1)
+    yield "mirrored (different photo)", image.transpose(Image.Transpose.FLIP_LEFT_RIGHT)
+
+
+def percentile(values, share):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(share * len(ordered)))]
+
+
+def main():
+    args = parse_args()
+    image = Image.open(args.image).convert("RGB")
+
+    timings = []
+    for _ in range(20):
+        start = time.perf_counter()
+        original = dhash(image)
+        timings.append(time.perf_counter() - start)
+    print(f"image {args.image} {image.size[0]}x{image.size[1]}: dhash {1000 * statistics.median(timings):.2f} ms")
+    for name, variant in variants(image):
+        distance = bin(original ^ dhash(variant)).count("1")
+        verdict = "hit" if distance <= args.max_distance else "miss"
+        print(f"  {name:<28} distance={distance:2d}  {verdict}")
+
+    rng = np.random.default_rng(args.seed)
+    cache = NearDuplicateCache(max_entries=args.entries, max_distance=args.max_distance)
+    key = request_key("Опиши товар", 200, 0.7)
+    start = time.perf_counter()
+    # Worst case for the key filter: every entry was asked with the same prompt
+    cache.hashes[:] = rng.integers(0, 2 ** 64, size=args.entries, dtype=np.uint64)
+    cache.keys[:] = key
+    cache.size = args.entries
+    cache.store(original, key, {"text": "cached answer"})
+    print(f"\nindex: {args.entries:,} entries, {(cache.hashes.nbytes + cache.keys.nbytes) / 2 ** 20:.1f} MB of arrays "
+          f"(filled in {time.perf_counter() - start:.2f}s)")
+
+    for label, query in (("hit", dhash(reencode(image, 60))), ("miss", int(rng.integers(0, 2 ** 64, dtype=np.uint64)))):
+        timings = []
+        for _ in range(args.lookups):
+            start = time.perf_counter()
+            found = cache.lookup(query, key)
+            timings.append(time.perf_counter() - start)
+        print(f"  lookup ({label}, {'found' if found else 'not found'}): "
+              f"p50 {1000 * percentile(timings, 0.5):.2f} ms, p99 {1000 * percentile(timings, 0.99):.2f} ms")
+    print(f"  popcount: {'np.bitwise_count' if hasattr(np, 'bitwise_count') else 'SWAR fallback'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""
+Prompt Lookup Benchmark
+Plain greedy decoding vs prompt-lookup decoding on copy-heavy and free-form prompts
+
+Without --model, a random Llama whose output follows a fixed token chain stands
+in for Avibe: the copy-heavy prompt embeds a stretch of that chain, like a
+listing that a rewrite or extraction answer repeats. With --model, the prompts
+are a real rewrite request and an open-ended question.
+
+Usage (from production_vibe/):
+    python -m benchmarks.bench_prompt_lookup
+    python -m benchmarks.bench_prompt_lookup --model /path/to/avibe --device cuda:0
+"""
+import time
+import argparse
+import statistics
+
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer, LlamaConfig, LlamaForCausalLM
+
+from speculative import PromptLookupDecoder
+
+LISTING = (
+    "Продаю велосипед Stels Navigator 500, рама 18 дюймов, 21 скорость, дисковые тормоза. "
+    "Куплен в 2022 году, катался мало, хранился в квартире. Есть небольшие царапины на раме. "
+    "В комплекте замок и фонарь. Самовывоз от метро Пролетарская, торг уместен."
+)
+REAL_PROMPTS = {
+    "copy-heavy": f"Исправь опечатки и верни полный текст объявления без изменений по сути:\n\n{LISTING}",
+    "free-form": "Придумай пять коротких слоганов для магазина велосипедов.",
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Prompt lookup decoding throughput")
+    parser.add_argument("--model", help="HF model id or local path (default: random copy stand-in)")
+    parser.add_argument("--device", default="cuda:0" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--new-tokens", type=int, default=96)
+    parser.add_argument("--lookup-tokens", type=int, default=10)
+    parser.add_argument("--max-ngram", type=int, default=2)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+def build_copy_model(args):
+    """
+    Llama stand-in whose greedy continuation of token t is always perm[t]
+
+    Every layer still runs its full matmuls, but its output projections are
+    zeroed, so the logits depend on the current token only. A prompt that
+    contains a stretch of the permutation chain is therefore copied, like a
+    listing repeated in a rewrite answer.
+    """
+    torch.manual_seed(args.seed)
+    vocab = 4096
+    model = LlamaForCausalLM(LlamaConfig(
+        vocab_size=vocab,
+        hidden_size=768,
+        intermediate_size=3072,
+        num_hidden_layers=12,
+        num_attention_heads=12,
+        num_key_value_heads=12,
+        max_position_embeddings=4096,
+        bos_token_id=None,
+        eos_token_id=None,  # always generate the full budget
+        pad_token_id=0,
+    ))
+    perm = torch.randperm(vocab)
+    with torch.no_grad():
+        for layer in model.model.layers:
+            layer.self_attn.o_proj.weight.zero_()
+            layer.mlp.down_proj.weight.zero_()
+        model.lm_head.weight[perm] = model.model.embed_tokens.weight
+
+    def chain(start: int, length: int):
+        tokens = [start]
+        while len(tokens) < length:
+            tokens.append(int(perm[tokens[-1]]))
+        return tokens
+
+    generator = torch.Generator().manual_seed(args.seed)
+    instruction = torch.randint(1, vocab, (32,), generator=generator).tolist()
+    listing = chain(int(torch.randint(1, vocab, (1,), generator=generator)), args.new_tokens + 32)
+    prompts = {
+        # instruction, the listing, then its first token: the answer repeats the listing
+        "copy-heavy": torch.tensor([instruction + listing + instruction[:4] + listing[:1]]),
+        "free-form": torch.randint(1, vocab, (1, 64), generator=generator),
+    }
+    return model.eval(), prompts
+
+
+def load_real_model(args):
+    dtype = torch.float16 if args.device.startswith("cuda") else torch.float32
+    tokenizer = AutoTokenizer.from_pretrained(args.model)
+    model = AutoModelForCausalLM.from_pretrained(args.model, torch_dtype=dtype).to(args.device).eval()
+    prompts = {}
+    for name, prompt in REAL_PROMPTS.items():
+        text = tokenizer.apply_chat_template(
+            [{"role": "user", "content": prompt}], tokenize=False, add_generation_prompt=True
+        )
+        prompts[name] = tokenizer(text, return_tensors="pt")["input_ids"].to(args.device)
+    return model, prompts
+
+
+def timed(fn, runs: int, device: str):
+    timings, output = [], None
+    for _ in range(runs):
+        if device.startswith("cuda"):
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        output = fn()
+        if device.startswith("cuda"):
+            torch.cuda.synchronize()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings), output
+
+
+def main():
+    args = parse_args()
+    model, prompts = load_real_model(args) if args.model else build_copy_model(args)
+    decoder = PromptLookupDecoder(num_tokens=args.lookup_tokens, max_ngram=args.max_ngram)
+    pad_token_id = model.config.pad_token_id if model.config.pad_token_id is not None else 0
+    kwargs = dict(pad_token_id=pad_token_id, max_new_tokens=args.new_tokens, do_sample=False)
+
+    for name, input_ids in prompts.items():
+        attention_mask = torch.ones_like(input_ids)
+        with torch.inference_mode():
+            plain_time, plain_ids = timed(
+                lambda: model.generate(input_ids=input_ids, attention_mask=attention_mask, **kwargs), args.runs, args.device
+            )
+            lookup_time, (lookup_ids, _, stats) = timed(
+                lambda: decoder.generate(model, input_ids, attention_mask, **kwargs), args.runs, args.device
+            )
+        plain_tokens = plain_ids.shape[1] - input_ids.shape[1]
+        lookup_tokens = lookup_ids.shape[1] - input_ids.shape[1]
+        print(f"\n{name} ({input_ids.shape[1]} prompt tokens):")
+        print(f"  plain:         {plain_tokens / plain_time:8.1f} tok/s")
+        print(f"  prompt lookup: {lookup_tokens / lookup_time:8.1f} tok/s  "
+              f"speedup {(lookup_tokens / lookup_time) / (plain_tokens / plain_time):.2f}x, "
+              f"{stats['tokens_per_pass']:.2f} tokens/pass, same output: {torch.equal(plain_ids, lookup_ids)}")
+
+
+if __name__ == "__main__":
+    main()
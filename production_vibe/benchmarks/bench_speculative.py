@@ -0,0 +1,122 @@
+"""
+Speculative Decoding Benchmark
+Plain vs draft-assisted decoding on small CPU stand-ins for Avibe and its draft
+
+The target is a randomly initialised Llama-style model; the draft is the same
+model truncated to its first layers. The target's remaining layers are damped
+by --perturb, which controls how often the draft agrees with it (larger means
+less agreement). An unrelated draft shows the automatic fallback.
+
+Usage (from production_vibe/):
+    python -m benchmarks.bench_speculative
+    python -m benchmarks.bench_speculative --layers 16 --draft-layers 2 --perturb 0.1 --new-tokens 96
+"""
+import time
+import argparse
+import statistics
+
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM
+
+from speculative import SpeculativeDecoder
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Assisted generation speed and acceptance on CPU stand-ins")
+    parser.add_argument("--hidden", type=int, default=768)
+    parser.add_argument("--layers", type=int, default=12)
+    parser.add_argument("--draft-layers", type=int, default=2)
+    parser.add_argument("--vocab", type=int, default=8192)
+    parser.add_argument("--perturb", type=float, default=0.05)
+    parser.add_argument("--draft-tokens", type=int, default=5)
+    parser.add_argument("--prompt-tokens", type=int, default=64)
+    parser.add_argument("--new-tokens", type=int, default=64)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--threads", type=int, default=0, help="torch threads (0 = torch default)")
+    return parser.parse_args()
+
+
+def build_models(args):
+    """(target, truncated draft, unrelated draft)"""
+    def llama(layers: int, seed: int):
+        torch.manual_seed(seed)
+        model_config = LlamaConfig(
+            vocab_size=args.vocab,
+            hidden_size=args.hidden,
+            intermediate_size=4 * args.hidden,
+            num_hidden_layers=layers,
+            num_attention_heads=args.hidden // 64,
+            num_key_value_heads=args.hidden // 64,
+            max_position_embeddings=4096,
+            bos_token_id=None,
+            eos_token_id=None,  # always generate the full budget
+            pad_token_id=0,
+        )
+        return LlamaForCausalLM(model_config).eval()
+
+    target = llama(args.layers, seed=0)
+    draft = llama(args.draft_layers, seed=0)
+    draft.load_state_dict(target.state_dict(), strict=False)
+    with torch.no_grad():
+        for layer in target.model.layers[args.draft_layers:]:
+            layer.self_attn.o_proj.weight.mul_(args.perturb)
+            layer.mlp.down_proj.weight.mul_(args.perturb)
+    unrelated = llama(args.draft_layers, seed=1)
+    return target, draft, unrelated
+
+
+def params_m(model) -> float:
+    return sum(p.numel() for p in model.parameters()) / 1e6
+
+
+def timed(fn, runs: int):
+    timings, output = [], None
+    for _ in range(runs):
+        start = time.perf_counter()
+        output = fn()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings), output
+
+
+def main():
+    args = parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    target, draft, unrelated = build_models(args)
+    print(f"target: {args.layers} layers, {params_m(target):.0f}M params; "
+          f"draft: first {args.draft_layers} layers, {params_m(draft):.0f}M params; perturb={args.perturb}")
+
+    input_ids = torch.randint(1, args.vocab, (1, args.prompt_tokens), generator=torch.Generator().manual_seed(0))
+    attention_mask = torch.ones_like(input_ids)
+    kwargs = dict(pad_token_id=0, max_new_tokens=args.new_tokens, min_new_tokens=args.new_tokens, do_sample=False)
+
+    with torch.inference_mode():
+        plain_time, plain_ids = timed(lambda: target.generate(input_ids=input_ids, attention_mask=attention_mask, **kwargs), args.runs)
+        print(f"\nplain:        {args.new_tokens / plain_time:7.1f} tok/s ({plain_time:.2f}s)")
+
+        decoder = SpeculativeDecoder(target, draft, "truncated", num_draft_tokens=args.draft_tokens)
+        spec_time, (spec_ids, _, stats) = timed(
+            lambda: decoder.generate(input_ids, attention_mask, **kwargs), args.runs
+        )
+        print(f"speculative:  {args.new_tokens / spec_time:7.1f} tok/s ({spec_time:.2f}s), "
+              f"speedup {plain_time / spec_time:.2f}x, acceptance {stats['acceptance_rate']:.2f}, "
+              f"{stats['tokens_per_pass']:.2f} tokens/pass, same output: {torch.equal(plain_ids, spec_ids)}")
+
+        # Unrelated draft: acceptance collapses and the decoder stops using it
+        decoder = SpeculativeDecoder(target, unrelated, "unrelated", num_draft_tokens=args.draft_tokens, window=3, cooldown=5)
+        short = dict(kwargs, max_new_tokens=16, min_new_tokens=16)
+        used = []
+        for _ in range(10):
+            if decoder.accepts(1, do_sample=False):
+                decoder.generate(input_ids, attention_mask, **short)
+                used.append("S")
+            else:
+                target.generate(input_ids=input_ids, attention_mask=attention_mask, **short)
+                used.append("-")
+        stats = decoder.get_stats()
+        print(f"unrelated draft: acceptance {stats['acceptance_rate']:.2f}, fallbacks {stats['fallbacks']}, "
+              f"requests {''.join(used)} (S = speculative, - = plain)")
+
+
+if __name__ == "__main__":
+    main()
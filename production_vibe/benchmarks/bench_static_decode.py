@@ -0,0 +1,127 @@
+"""
+Static Decode Benchmark
+Compares eager generate() with the static-cache compiled decoder
+
+Usage (from production_vibe/):
+    python -m benchmarks.bench_static_decode                      # small random Llama on CPU
+    python -m benchmarks.bench_static_decode --model /path/to/avibe --device cuda:0
+"""
+import time
+import random
+import argparse
+
+import torch
+from transformers import AutoModelForCausalLM, LlamaConfig, LlamaForCausalLM
+
+from static_decode import StaticDecoder
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Eager vs static-shape decoding throughput")
+    parser.add_argument("--model", help="HF model id or local path (default: random Llama stand-in)")
+    parser.add_argument("--device", default="cuda:0" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--requests", type=int, default=20)
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--min-prompt", type=int, default=32)
+    parser.add_argument("--max-prompt", type=int, default=200)
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    parser.add_argument("--prompt-buckets", default="64,128,256")
+    parser.add_argument("--batch-buckets", default="1,2,4,8")
+    parser.add_argument("--compile-mode", default=None, help="default: reduce-overhead on GPU, default on CPU")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+def load_model(args):
+    if args.model:
+        dtype = torch.float16 if args.device.startswith("cuda") else torch.float32
+        model = AutoModelForCausalLM.from_pretrained(args.model, torch_dtype=dtype)
+    else:
+        torch.manual_seed(args.seed)
+        model = LlamaForCausalLM(LlamaConfig(
+            vocab_size=32000,
+            hidden_size=512,
+            intermediate_size=1376,
+            num_hidden_layers=6,
+            num_attention_heads=8,
+            num_key_value_heads=4,
+        ))
+    return model.to(args.device).eval()
+
+
+def make_requests(args, vocab_size):
+    rng = random.Random(args.seed)
+    generator = torch.Generator().manual_seed(args.seed)
+    requests = []
+    for _ in range(args.requests):
+        lengths = [rng.randint(args.min_prompt, args.max_prompt) for _ in range(args.batch_size)]
+        width = max(lengths)
+        input_ids = torch.zeros((args.batch_size, width), dtype=torch.long)
+        attention_mask = torch.zeros_like(input_ids)
+        for row, length in enumerate(lengths):
+            input_ids[row, width - length:] = torch.randint(3, vocab_size, (length,), generator=generator)
+            attention_mask[row, width - length:] = 1
+        requests.append((input_ids.to(args.device), attention_mask.to(args.device)))
+    return requests
+
+
+def synchronize(device):
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+
+
+def run(generate, requests, args):
+    """Decode every request; returns (seconds, generated tokens)"""
+    tokens = 0
+    synchronize(args.device)
+    start = time.perf_counter()
+    for input_ids, attention_mask in requests:
+        with torch.inference_mode():
+            sequences, width = generate(input_ids, attention_mask)
+        tokens += (sequences.shape[1] - width) * input_ids.shape[0]
+    synchronize(args.device)
+    return time.perf_counter() - start, tokens
+
+
+def main():
+    args = parse_args()
+    model = load_model(args)
+    requests = make_requests(args, model.config.vocab_size)
+    # min_new_tokens keeps EOS from ending runs early, so both modes decode the same number of steps
+    generate_kwargs = {"max_new_tokens": args.max_new_tokens, "min_new_tokens": args.max_new_tokens, "do_sample": False}
+
+    def eager(input_ids, attention_mask):
+        sequences = model.generate(input_ids=input_ids, attention_mask=attention_mask, pad_token_id=0, **generate_kwargs)
+        return sequences, input_ids.shape[1]
+
+    compile_mode = args.compile_mode or ("reduce-overhead" if args.device.startswith("cuda") else "default")
+    decoder = StaticDecoder(
+        model,
+        prompt_buckets=[int(size) for size in args.prompt_buckets.split(",")],
+        batch_buckets=[int(size) for size in args.batch_buckets.split(",")],
+        max_new_tokens=args.max_new_tokens,
+        compile_mode=compile_mode,
+    )
+
+    def static(input_ids, attention_mask):
+        return decoder.generate(input_ids, attention_mask, pad_token_id=0, **generate_kwargs)
+
+    print(f"device={args.device} requests={args.requests} batch={args.batch_size} "
+          f"prompt={args.min_prompt}-{args.max_prompt} new_tokens={args.max_new_tokens} compile={compile_mode}")
+
+    run(eager, requests[:2], args)  # lazy init / allocator warmup for a fair eager number
+    compile_start = time.perf_counter()
+    run(static, requests[:1], args)
+    print(f"static warmup (compile + capture): {time.perf_counter() - compile_start:.1f}s")
+
+    results = {}
+    for name, generate in (("eager", eager), ("static", static)):
+        seconds, tokens = run(generate, requests, args)
+        results[name] = seconds
+        print(f"{name:>7}: {seconds:7.2f}s  {tokens / seconds:9.1f} tok/s  "
+              f"{1000 * seconds / (tokens / args.batch_size):7.2f} ms/step")
+    print(f"speedup: {results['eager'] / results['static']:.2f}x  ({decoder.get_stats()})")
+
+
+if __name__ == "__main__":
+    main()
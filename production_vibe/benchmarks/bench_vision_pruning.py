@@ -0,0 +1,114 @@
+"""
+Vision Token Pruning Benchmark
+Prefill speedup and output agreement with the unpruned model at several keep ratios
+
+Every photo is run as uploaded, centred on a plain white canvas (a product
+shot with a studio background), and upscaled to 1280x960. Agreement is
+measured on greedy answers against the unpruned baseline. Dropping the same
+number of tokens at random is shown for comparison. Without --model the
+small random Qwen2-VL stand-in from bench_image_detail is used, so its
+agreement numbers only compare the two selection rules; pass --model for
+real answers.
+
+Usage (from production_vibe/):
+    python -m benchmarks.bench_vision_pruning
+    python -m benchmarks.bench_vision_pruning --model /path/to/avision --device cuda:0 --images "photos/*.jpg"
+"""
+import glob
+import math
+import argparse
+
+import torch
+from PIL import Image
+
+from batching import ImageItem, generate_image_batch
+from imaging import resize_for_detail
+from benchmarks.bench_image_detail import PROMPT, build_stand_in, load_real_model, timed
+import vision_pruning
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Vision token pruning: prefill speedup and answer agreement")
+    parser.add_argument("--model", help="Avision snapshot directory (default: small random Qwen2-VL stand-in)")
+    parser.add_argument("--device", default="cuda:0" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--images", default="../car5.jpeg", help="glob of local photos")
+    parser.add_argument("--ratios", default="0.75,0.5,0.25")
+    parser.add_argument("--min-tokens", type=int, default=64)
+    parser.add_argument("--new-tokens", type=int, default=16)
+    parser.add_argument("--runs", type=int, default=3)
+    return parser.parse_args()
+
+
+class RandomPruner(vision_pruning.VisionTokenPruner):
+    """Same budget, tokens chosen at random (the baseline a selection rule has to beat)"""
+
+    def select(self, features, grid):
+        count = features.shape[0]
+        keep = min(count, max(self.min_tokens, math.ceil(count * self.keep_ratio)))
+        generator = torch.Generator().manual_seed(count)
+        return torch.randperm(count, generator=generator)[:keep].sort().values.to(features.device)
+
+
+def image_set(pattern: str):
+    for path in sorted(glob.glob(pattern)):
+        photo = Image.open(path).convert("RGB")
+        canvas = Image.new("RGB", (photo.size[0] * 2, photo.size[1] * 2), (255, 255, 255))
+        canvas.paste(photo, (photo.size[0] // 2, photo.size[1] // 2))
+        yield f"{path}", photo
+        yield f"{path} on white", canvas
+        yield f"{path} 1280x960", photo.resize((1280, 960), Image.BICUBIC)
+
+
+def run(model, processor, image, pruner, new_tokens: int, runs: int, device: str):
+    """(time to first token, greedy answer token ids, vision tokens kept)"""
+    vision_pruning._pruners.pop(id(model), None)
+    if pruner is not None:
+        vision_pruning._pruners[id(model)] = pruner
+    item = ImageItem(index=0, prompt=PROMPT, image=image)
+    kwargs = dict(temperature=0.0, top_p=1.0, repetition_penalty=1.0)
+    with torch.inference_mode():
+        first_token_time, _ = timed(
+            lambda: generate_image_batch(model, processor, [item], max_new_tokens=1, **kwargs), runs, device
+        )
+        result, = generate_image_batch(model, processor, [item], max_new_tokens=new_tokens, **kwargs)
+    vision_pruning._pruners.pop(id(model), None)
+    tokens = processor.tokenizer(result["data"]["text"], add_special_tokens=False)["input_ids"]
+    return first_token_time, tokens, result["metrics"].get("vision_tokens_kept", result["metrics"]["vision_tokens"])
+
+
+def agreement(a, b) -> float:
+    """Share of answer positions where both answers have the same token"""
+    length = max(len(a), len(b))
+    return sum(x == y for x, y in zip(a, b)) / length if length else 1.0
+
+
+def main():
+    args = parse_args()
+    model, processor = load_real_model(args) if args.model else build_stand_in()
+    ratios = [float(ratio) for ratio in args.ratios.split(",")]
+    totals = {(ratio, rule): [] for ratio in ratios for rule in ("similarity", "random")}
+
+    for name, photo in image_set(args.images):
+        image = resize_for_detail(photo, "auto")
+        base_time, base_tokens, vision_tokens = run(model, processor, image, None, args.new_tokens, args.runs, args.device)
+        print(f"\n{name} ({image.size[0]}x{image.size[1]}, {vision_tokens} vision tokens): "
+              f"unpruned first token {base_time:.2f}s")
+        for ratio in ratios:
+            for rule, pruner_class in (("similarity", vision_pruning.VisionTokenPruner), ("random", RandomPruner)):
+                pruner = pruner_class(model, keep_ratio=ratio, min_tokens=args.min_tokens)
+                elapsed, tokens, kept = run(model, processor, image, pruner, args.new_tokens, args.runs, args.device)
+                score = agreement(base_tokens, tokens)
+                totals[(ratio, rule)].append((base_time / elapsed, score, tokens == base_tokens))
+                print(f"  keep {ratio:.2f} {rule:<10} {kept:>5} tokens  prefill speedup {base_time / elapsed:4.2f}x  "
+                      f"token agreement {score:5.1%}  identical answer: {tokens == base_tokens}")
+
+    print("\nAverage over the image set:")
+    for (ratio, rule), rows in totals.items():
+        if rows:
+            print(f"  keep {ratio:.2f} {rule:<10} speedup {sum(r[0] for r in rows) / len(rows):4.2f}x  "
+                  f"token agreement {sum(r[1] for r in rows) / len(rows):5.1%}  "
+                  f"identical answers {sum(r[2] for r in rows)}/{len(rows)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+"""
+Generation Cancellation
+Deadlines and client-disconnect detection checked between decode steps
+"""
+import time
+import socket
+import select
+import logging
+from threading import Event
+from typing import Optional
+
+import torch
+from flask import request, g
+from transformers import StoppingCriteria, StoppingCriteriaList
+
+from config import config
+from middleware import DeadlineExceededError, ClientClosedRequestError
+from health import record_cancellation
+
+logger = logging.getLogger(__name__)
+
+
+# ===============================
+# Cancellation Token
+# ===============================
+
+class CancellationToken:
+    """Thread-safe flag that a running generation polls to know it should stop"""
+
+    def __init__(self):
+        self._event = Event()
+        self.reason: Optional[str] = None
+
+    def cancel(self, reason: str) -> None:
+        if not self._event.is_set():
+            self.reason = reason
+            self._event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+
+def client_disconnected(environ: dict) -> bool:
+    """
+    Non-blocking check whether the client closed its connection
+
+    gunicorn and the Werkzeug dev server expose the connection socket in the
+    WSGI environ. A readable socket that yields no bytes on a peek means the
+    peer sent FIN; a reset shows up as an OSError.
+    """
+    sock = environ.get("gunicorn.socket") or environ.get("werkzeug.socket")
+    if sock is None:
+        return False
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        if not readable:
+            return False
+        return sock.recv(1, socket.MSG_PEEK) == b""
+    except (OSError, ValueError):
+        return True
+
+
+# ===============================
+# Stopping Criterion
+# ===============================
+
+class GenerationControl(StoppingCriteria):
+    """
+    Stops generate() once the request deadline passes, the client disconnects,
+    or the token is cancelled from elsewhere
+
+    Disconnect checks hit the socket, so they are throttled to
+    `disconnect_check_interval` seconds; the deadline is checked every step.
+    """
+
+    def __init__(
+        self,
+        deadline: float,
+        token: Optional[CancellationToken] = None,
+        environ: Optional[dict] = None,
+        disconnect_check_interval: float = 0.25,
+    ):
+        self.deadline = deadline
+        self.token = token or CancellationToken()
+        self.environ = environ
+        self.disconnect_check_interval = disconnect_check_interval
+        self._next_disconnect_check = 0.0
+
+    @property
+    def stop_reason(self) -> Optional[str]:
+        return self.token.reason
+
+    def remaining(self) -> float:
+        return self.deadline - time.monotonic()
+
+    def should_stop(self) -> bool:
+        if self.token.cancelled:
+            return True
+        now = time.monotonic()
+        if now >= self.deadline:
+            self.token.cancel("deadline_exceeded")
+            return True
+        if self.environ is not None and now >= self._next_disconnect_check:
+            self._next_disconnect_check = now + self.disconnect_check_interval
+            if client_disconnected(self.environ):
+                self.token.cancel("client_disconnected")
+                return True
+        return False
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        stop = self.should_stop()
+        return torch.full((input_ids.shape[0],), stop, dtype=torch.bool, device=input_ids.device)
+
+    def criteria(self) -> StoppingCriteriaList:
+        return StoppingCriteriaList([self])
+
+
+def request_timeout(requested=None) -> float:
+    """Clamp a client-supplied timeout (seconds) to the server maximum"""
+    limit = config.server.request_timeout
+    try:
+        requested = float(requested)
+    except (TypeError, ValueError):
+        return limit
+    return limit if requested <= 0 else min(requested, limit)
+
+
+def control_for_request(timeout=None) -> GenerationControl:
+    """
+    Build the generation control for the current request
+
+    The deadline counts from when the request arrived, so time spent queued
+    or validating is included. Clients can shorten it with the
+    X-Request-Timeout header or a `timeout` field; the server maximum stays
+    below the gunicorn worker timeout so workers are never killed mid-step.
+    """
+    if timeout is None:
+        timeout = request.headers.get("X-Request-Timeout")
+    elapsed = time.time() - g.get("start_time", time.time())
+    control = GenerationControl(
+        deadline=time.monotonic() + request_timeout(timeout) - elapsed,
+        environ=request.environ,
+    )
+    g.generation_control = control
+    return control
+
+
+def raise_if_stopped(control: GenerationControl, **payload) -> None:
+    """Turn an early stop into the matching API error (partial results go in the payload)"""
+    reason = control.stop_reason
+    if reason is None:
+        return
+    record_cancellation(reason)
+    logger.warning(f"Generation stopped early: {reason}")
+    if reason == "client_disconnected":
+        raise ClientClosedRequestError("Client closed the connection", payload=payload)
+    raise DeadlineExceededError("Generation deadline exceeded", payload=payload)
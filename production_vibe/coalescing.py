@@ -0,0 +1,139 @@
+"""
+Request Coalescing
+Single-flight execution: identical concurrent requests share one in-flight generation
+"""
+import logging
+from threading import Event, Lock
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from config import config
+from middleware import DeadlineExceededError, ClientClosedRequestError, ServiceOverloadedError
+from cancellation import GenerationControl, raise_if_stopped
+
+logger = logging.getLogger(__name__)
+
+# Failures that belong to the leader's own request, not to the generation
+# (load shedding depends on the leader's own deadline, so a follower may still be served)
+_LEADER_ONLY_ERRORS = (DeadlineExceededError, ClientClosedRequestError, ServiceOverloadedError)
+
+
+def _copy_error(error: BaseException) -> BaseException:
+    """
+    A new exception of the same type and content as `error`
+
+    Each follower raises its own copy: one instance raised from several
+    threads at once would have its __traceback__ rewritten by each of them.
+    """
+    copy = type(error).__new__(type(error), *error.args)
+    copy.args = error.args
+    copy.__dict__.update(error.__dict__)
+    return copy
+
+
+class _Flight:
+    """One generation in progress and the requests waiting for it"""
+
+    def __init__(self):
+        self.done = Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+        self.shared = False
+        self.followers = 0
+
+
+class SingleFlight:
+    """
+    Runs at most one generation per key at a time
+
+    The first request for a key (the leader) runs the generation; requests
+    with the same key that arrive while it runs (followers) wait for it and
+    receive the same result object, which callers must treat as read-only.
+    Followers never enter the inference queue. If the leader stopped early
+    on its own deadline or disconnect, or was shed by the queue, its answer
+    or error is not shared; waiting followers retry and one of them becomes
+    the next leader.
+    Followers still honour their own deadline and disconnects while waiting.
+    """
+
+    def __init__(self, enabled: bool = True, poll_interval: float = 0.25):
+        self.enabled = enabled
+        self.poll_interval = poll_interval
+        self.flights: Dict[str, _Flight] = {}
+        self.lock = Lock()
+        self.leaders = 0
+        self.followers = 0
+        self.waiting = 0
+        self.retries = 0
+        self.max_followers = 0
+
+    def run(self, key: Optional[str], generate: Callable[[], Any], control: GenerationControl) -> Tuple[Any, bool]:
+        """(result, True if this request ran the generation itself)"""
+        if not self.enabled or key is None:
+            return generate(), True
+        while True:
+            with self.lock:
+                flight = self.flights.get(key)
+                leader = flight is None
+                if leader:
+                    flight = self.flights[key] = _Flight()
+                    self.leaders += 1
+                else:
+                    flight.followers += 1
+                    self.followers += 1
+                    self.waiting += 1
+                    self.max_followers = max(self.max_followers, flight.followers)
+            if leader:
+                return self._lead(key, flight, generate, control), True
+            try:
+                self._wait(flight, control)
+            finally:
+                with self.lock:
+                    self.waiting -= 1
+            if flight.shared:
+                return flight.result, False
+            if flight.error is not None:
+                raise _copy_error(flight.error) from flight.error
+            with self.lock:
+                self.retries += 1
+            logger.info("Coalesced request retrying: its leader stopped early")
+
+    def _lead(self, key: str, flight: _Flight, generate: Callable[[], Any], control: GenerationControl) -> Any:
+        try:
+            flight.result = generate()
+            # A partial answer cut short by the leader's own deadline is not valid for anyone else
+            flight.shared = control.stop_reason is None
+            return flight.result
+        except _LEADER_ONLY_ERRORS:
+            raise
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            if flight.followers:
+                logger.info(f"Coalesced generation served {flight.followers} follower(s)")
+            flight.done.set()
+
+    def _wait(self, flight: _Flight, control: GenerationControl) -> None:
+        while not flight.done.wait(min(self.poll_interval, max(control.remaining(), 0.0))):
+            if control.should_stop():
+                raise_if_stopped(control)
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {
+                "enabled": self.enabled,
+                "in_flight": len(self.flights),
+                "leaders": self.leaders,
+                "followers": self.followers,
+                "followers_waiting": self.waiting,
+                "max_followers": self.max_followers,
+                "retries": self.retries,
+                "coalesced_ratio": round(self.followers / (self.leaders + self.followers), 3)
+                if self.leaders + self.followers else 0.0,
+            }
+
+
+# Global single-flight group for the generation routes
+single_flight = SingleFlight(enabled=config.server.request_coalescing)
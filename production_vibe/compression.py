@@ -0,0 +1,179 @@
+"""
+Response Compression
+Negotiated gzip/deflate compression for HTML and JSON responses
+"""
+import gzip
+import zlib
+import functools
+from collections import OrderedDict
+from threading import Lock
+from typing import Callable, Optional
+
+from flask import request, g
+
+from config import config
+
+
+# ===============================
+# Encoding Negotiation
+# ===============================
+
+SUPPORTED_ENCODINGS = ("gzip", "deflate")
+
+
+def parse_accept_encoding(header: str) -> dict:
+    """
+    Parse Accept-Encoding header into {encoding: qvalue}
+    Unparseable q-values are treated as 0 (not acceptable)
+    """
+    accepted = {}
+    for part in (header or "").split(","):
+        part = part.strip()
+        if not part:
+            continue
+        coding, _, params = part.partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[coding.strip().lower()] = q
+    return accepted
+
+
+def choose_encoding(header: str) -> Optional[str]:
+    """Pick the best supported encoding the client accepts, or None"""
+    accepted = parse_accept_encoding(header)
+    wildcard = accepted.get("*", 0.0)
+    best, best_q = None, 0.0
+    # SUPPORTED_ENCODINGS is ordered by server preference, so ties keep gzip
+    for encoding in SUPPORTED_ENCODINGS:
+        q = accepted.get(encoding, wildcard)
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+def compress_body(data: bytes, encoding: str, level: int) -> bytes:
+    """Compress bytes with the given content-coding"""
+    if encoding == "gzip":
+        # mtime=0 keeps the output deterministic for identical bodies
+        return gzip.compress(data, compresslevel=level, mtime=0)
+    if encoding == "deflate":
+        # HTTP "deflate" is the zlib format (RFC 9110), not raw deflate
+        return zlib.compress(data, level)
+    raise ValueError(f"Unsupported encoding: {encoding}")
+
+
+# ===============================
+# Precompressed Static Cache
+# ===============================
+
+class CompressedCache:
+    """Small LRU of compressed bodies for responses that never change"""
+
+    def __init__(self, max_entries: int = 32):
+        self.max_entries = max_entries
+        self.entries: OrderedDict = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple) -> Optional[bytes]:
+        with self.lock:
+            body = self.entries.get(key)
+            if body is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return body
+
+    def put(self, key: tuple, body: bytes) -> None:
+        with self.lock:
+            self.entries[key] = body
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+def static_response(f: Callable) -> Callable:
+    """
+    Mark a view whose body is identical for every request
+    Its compressed variants are cached so compression runs once per encoding
+    """
+    @functools.wraps(f)
+    def decorated_function(*args, **kwargs):
+        g.compress_static = True
+        return f(*args, **kwargs)
+    return decorated_function
+
+
+# ===============================
+# Compression Middleware
+# ===============================
+
+class ResponseCompression:
+    """Compresses eligible responses based on the client's Accept-Encoding"""
+
+    def __init__(self, app=None):
+        self.cache = CompressedCache(config.compression.cache_max_entries)
+        if app:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.after_request(self.after_request)
+
+    def after_request(self, response):
+        settings = config.compression
+        if not settings.enabled:
+            return response
+
+        # The body depends on Accept-Encoding even when we decide not to compress
+        response.vary.add("Accept-Encoding")
+
+        if (
+            response.status_code < 200
+            or response.status_code in (204, 206, 304)
+            or response.direct_passthrough
+            or response.is_streamed
+            or "Content-Encoding" in response.headers
+            or response.mimetype not in settings.mimetypes
+        ):
+            return response
+
+        encoding = choose_encoding(request.headers.get("Accept-Encoding", ""))
+        if encoding is None:
+            return response
+
+        data = response.get_data()
+        if len(data) < settings.min_size:
+            return response
+
+        if g.get("compress_static"):
+            # crc32 runs at memory speed, so keying on it is far cheaper than recompressing
+            key = (request.path, encoding, len(data), zlib.crc32(data))
+            compressed = self.cache.get(key)
+            if compressed is None:
+                compressed = compress_body(data, encoding, settings.level)
+                self.cache.put(key, compressed)
+        else:
+            compressed = compress_body(data, encoding, settings.level)
+
+        if len(compressed) >= len(data):
+            return response
+
+        response.set_data(compressed)
+        response.headers["Content-Encoding"] = encoding
+        response.headers["Content-Length"] = str(len(compressed))
+        return response
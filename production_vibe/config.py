@@ -20,6 +20,57 @@ class ModelConfig:
     temperature: float = 0.7
     top_p: float = 0.9
     repetition_penalty: float = 1.1
+    max_batch_size: int = 8  # prompts per padded generate() call
+    max_batch_prefill_tokens: int = 8192  # padded prompt tokens per generate() call (rows x longest prompt)
+    max_image_batch_size: int = 4  # images per padded generate() call
+    image_detail_low_pixels: int = 200_704  # "detail": "low" (448x448); thumbnails and moderation checks
+    image_detail_auto_pixels: int = 1_003_520  # default detail (about 1.0 MP)
+    image_detail_high_pixels: int = 0  # "detail": "high"; 0 = the processor's own limit
+    vision_keep_ratio: float = 1.0  # share of image tokens Avision prefills (1.0 = no pruning)
+    vision_prune_min_tokens: int = 64  # images are never pruned below this many tokens
+    image_decode_workers: int = 4
+    warmup_enabled: bool = True
+    warmup_batch_sizes: list = None  # batch sizes to run at startup
+    warmup_prompt_tokens: list = None  # prompt lengths (tokens) for Avibe warmup
+    warmup_image_sizes: list = None  # (width, height) pairs for Avision warmup
+    warmup_new_tokens: int = 8
+    static_decode: bool = False  # preallocated KV cache + compiled decode step for Avibe
+    static_prompt_buckets: list = None  # prompt lengths are padded up to one of these
+    static_batch_buckets: list = None  # batches are filled up to one of these sizes
+    static_max_new_tokens: int = 256  # longer requests run eagerly
+    static_compile_mode: str = "reduce-overhead"
+    avibe_replicas: list = None  # extra devices for Avibe copies, e.g. ["cuda:1", "cuda:2"]
+    avision_replicas: list = None  # extra devices for Avision copies
+    replica_mode: str = "process"  # "process" (worker per replica) or "local" (same process)
+    replica_health_interval: float = 10.0  # seconds between replica health probes
+    residency_enabled: bool = False  # offload idle models from the accelerator
+    residency_idle_seconds: float = 300.0  # unused this long -> offloaded
+    residency_budget_gb: float = 0.0  # resident weights limit per device (0 = no limit)
+    residency_offload: str = "pinned"  # "pinned" (host RAM) or "disk" (memory-mapped file)
+    residency_offload_dir: str = "/tmp/avito-offload"
+    speculative_draft_model: Optional[str] = None  # small model sharing Avibe's tokenizer; enables assisted decoding
+    speculative_draft_tokens: int = 5  # tokens the draft proposes per verification pass
+    speculative_min_acceptance: float = 0.35  # below this (recent average) speculation is switched off for a while
+    speculative_window: int = 20  # requests averaged for the fallback decision
+    speculative_cooldown: int = 50  # requests decoded without the draft after a fallback
+    prompt_lookup_tokens: int = 10  # tokens copied from the prompt per verification pass ("decoding": "prompt_lookup")
+    prompt_lookup_max_ngram: int = 2  # longest n-gram matched against the prompt
+    
+    def __post_init__(self):
+        if self.warmup_batch_sizes is None:
+            self.warmup_batch_sizes = [1, 4]
+        if self.warmup_prompt_tokens is None:
+            self.warmup_prompt_tokens = [64, 512]
+        if self.warmup_image_sizes is None:
+            self.warmup_image_sizes = [(448, 448), (1024, 768)]
+        if self.static_prompt_buckets is None:
+            self.static_prompt_buckets = [128, 256, 512, 1024]
+        if self.static_batch_buckets is None:
+            self.static_batch_buckets = [1, 2, 4, 8]
+        if self.avibe_replicas is None:
+            self.avibe_replicas = []
+        if self.avision_replicas is None:
+            self.avision_replicas = []
 
 
 @dataclass
@@ -30,6 +81,14 @@ class ServerConfig:
     debug: bool = False
     workers: int = 1
     max_content_length: int = 16 * 1024 * 1024  # 16MB
+    request_timeout: float = 285.0  # seconds; keep below the gunicorn worker timeout (300)
+    inference_queue_depth: int = 32  # requests allowed to wait for the model
+    inference_concurrency: int = 1  # generate() calls running at once
+    adaptive_tokens: bool = True  # shorten unpinned max_tokens under load
+    degrade_queue_depth: int = 8  # queued requests that count as pressure
+    degrade_wait_slo: float = 10.0  # seconds of queue wait that count as pressure
+    degrade_min_ratio: float = 0.25  # floor for the shortened budget
+    request_coalescing: bool = True  # identical concurrent requests share one generation
 
 
 @dataclass
@@ -38,7 +97,13 @@ class SecurityConfig:
     rate_limit_per_minute: int = 10
     rate_limit_per_hour: int = 100
     allowed_origins: list = None
-    max_prompt_length: int = 2000
+    max_prompt_length: int = 8000  # characters; coarse guard checked before tokenizing
+    max_prompt_tokens: int = 1024  # prefill tokens per request, counted after the chat template
+    max_batch_items: int = 10  # prompts per batch API request (each counts against the rate limit)
+    max_image_batch_items: int = 10  # images per batch API request (each counts against the rate limit)
+    max_image_questions: int = 10  # questions per multi-question image request (each counts against the rate limit)
+    max_image_pixels: int = 40_000_000  # width*height budget checked from the header before decoding
+    local_image_root: Optional[str] = None  # enables {"path": ...} requests for files under this directory
     allowed_image_extensions: set = None
     
     def __post_init__(self):
@@ -46,6 +111,49 @@ class SecurityConfig:
             self.allowed_origins = ["*"]
         if self.allowed_image_extensions is None:
             self.allowed_image_extensions = {'.jpg', '.jpeg', '.png', '.gif', '.webp'}
+        # A batch item costs one request, so a batch above the per-minute limit could never be served
+        self.max_batch_items = min(self.max_batch_items, self.rate_limit_per_minute)
+        self.max_image_batch_items = min(self.max_image_batch_items, self.rate_limit_per_minute)
+        self.max_image_questions = min(self.max_image_questions, self.rate_limit_per_minute)
+
+
+@dataclass
+class CompressionConfig:
+    """Response compression configuration"""
+    enabled: bool = True
+    level: int = 6
+    min_size: int = 500  # bytes; smaller bodies are sent as-is
+    cache_max_entries: int = 32
+    mimetypes: set = None
+    
+    def __post_init__(self):
+        if self.mimetypes is None:
+            self.mimetypes = {'text/html', 'text/plain', 'text/css', 'application/json', 'application/javascript'}
+
+
+@dataclass
+class SessionConfig:
+    """Chat session configuration"""
+    ttl: float = 900.0  # seconds a session survives without a turn
+    max_cache_mb: int = 2048  # KV cache memory shared by all sessions
+    max_sessions: int = 1000
+    max_context_tokens: int = 4096  # history + new message + max_tokens; older turns are dropped past it
+
+
+@dataclass
+class ImageCacheConfig:
+    """Near-duplicate image cache configuration"""
+    enabled: bool = True
+    max_entries: int = 100_000  # recent answers kept (ring buffer)
+    max_distance: int = 5  # Hamming distance (of 64 bits) that still counts as the same photo
+
+
+@dataclass
+class DiskCacheConfig:
+    """Persistent generation cache configuration"""
+    enabled: bool = True
+    path: str = "/var/cache/avito-ai/generations.sqlite3"
+    max_mb: int = 1024
 
 
 @dataclass
@@ -83,6 +191,56 @@ class Config:
             max_tokens_avision=int(os.getenv("MAX_TOKENS_AVISION", "200")),
             temperature=float(os.getenv("TEMPERATURE", "0.7")),
             top_p=float(os.getenv("TOP_P", "0.9")),
+            max_batch_size=int(os.getenv("MAX_BATCH_SIZE", "8")),
+            max_batch_prefill_tokens=int(os.getenv("MAX_BATCH_PREFILL_TOKENS", "8192")),
+            max_image_batch_size=int(os.getenv("MAX_IMAGE_BATCH_SIZE", "4")),
+            image_detail_low_pixels=int(os.getenv("IMAGE_DETAIL_LOW_PIXELS", "200704")),
+            image_detail_auto_pixels=int(os.getenv("IMAGE_DETAIL_AUTO_PIXELS", "1003520")),
+            image_detail_high_pixels=int(os.getenv("IMAGE_DETAIL_HIGH_PIXELS", "0")),
+            vision_keep_ratio=float(os.getenv("VISION_KEEP_RATIO", "1.0")),
+            vision_prune_min_tokens=int(os.getenv("VISION_PRUNE_MIN_TOKENS", "64")),
+            image_decode_workers=int(os.getenv("IMAGE_DECODE_WORKERS", "4")),
+            warmup_enabled=os.getenv("WARMUP_ENABLED", "true").lower() == "true",
+            warmup_batch_sizes=[
+                int(size) for size in os.getenv("WARMUP_BATCH_SIZES", "1,4").split(",") if size.strip()
+            ],
+            warmup_prompt_tokens=[
+                int(length) for length in os.getenv("WARMUP_PROMPT_TOKENS", "64,512").split(",") if length.strip()
+            ],
+            warmup_image_sizes=[
+                tuple(int(side) for side in size.lower().split("x"))
+                for size in os.getenv("WARMUP_IMAGE_SIZES", "448x448,1024x768").split(",") if size.strip()
+            ],
+            warmup_new_tokens=int(os.getenv("WARMUP_NEW_TOKENS", "8")),
+            static_decode=os.getenv("STATIC_DECODE", "false").lower() == "true",
+            static_prompt_buckets=[
+                int(length) for length in os.getenv("STATIC_PROMPT_BUCKETS", "128,256,512,1024").split(",") if length.strip()
+            ],
+            static_batch_buckets=[
+                int(size) for size in os.getenv("STATIC_BATCH_BUCKETS", "1,2,4,8").split(",") if size.strip()
+            ],
+            static_max_new_tokens=int(os.getenv("STATIC_MAX_NEW_TOKENS", "256")),
+            static_compile_mode=os.getenv("STATIC_COMPILE_MODE", "reduce-overhead"),
+            avibe_replicas=[
+                device.strip() for device in os.getenv("AVIBE_REPLICAS", "").split(",") if device.strip()
+            ],
+            avision_replicas=[
+                device.strip() for device in os.getenv("AVISION_REPLICAS", "").split(",") if device.strip()
+            ],
+            replica_mode=os.getenv("REPLICA_MODE", "process"),
+            replica_health_interval=float(os.getenv("REPLICA_HEALTH_INTERVAL", "10")),
+            residency_enabled=os.getenv("RESIDENCY_ENABLED", "false").lower() == "true",
+            residency_idle_seconds=float(os.getenv("RESIDENCY_IDLE_SECONDS", "300")),
+            residency_budget_gb=float(os.getenv("RESIDENCY_BUDGET_GB", "0")),
+            residency_offload=os.getenv("RESIDENCY_OFFLOAD", "pinned"),
+            residency_offload_dir=os.getenv("RESIDENCY_OFFLOAD_DIR", "/tmp/avito-offload"),
+            speculative_draft_model=os.getenv("SPECULATIVE_DRAFT_MODEL") or None,
+            speculative_draft_tokens=int(os.getenv("SPECULATIVE_DRAFT_TOKENS", "5")),
+            speculative_min_acceptance=float(os.getenv("SPECULATIVE_MIN_ACCEPTANCE", "0.35")),
+            speculative_window=int(os.getenv("SPECULATIVE_WINDOW", "20")),
+            speculative_cooldown=int(os.getenv("SPECULATIVE_COOLDOWN", "50")),
+            prompt_lookup_tokens=int(os.getenv("PROMPT_LOOKUP_TOKENS", "10")),
+            prompt_lookup_max_ngram=int(os.getenv("PROMPT_LOOKUP_MAX_NGRAM", "2")),
         )
         
         # Server Configuration
@@ -91,6 +249,14 @@ class Config:
             port=int(os.getenv("PORT", "8085")),
             debug=os.getenv("DEBUG", "false").lower() == "true",
             workers=int(os.getenv("WORKERS", "1")),
+            request_timeout=float(os.getenv("REQUEST_TIMEOUT", "285")),
+            inference_queue_depth=int(os.getenv("INFERENCE_QUEUE_DEPTH", "32")),
+            inference_concurrency=int(os.getenv("INFERENCE_CONCURRENCY", "1")),
+            adaptive_tokens=os.getenv("ADAPTIVE_TOKENS", "true").lower() == "true",
+            degrade_queue_depth=int(os.getenv("DEGRADE_QUEUE_DEPTH", "8")),
+            degrade_wait_slo=float(os.getenv("DEGRADE_WAIT_SLO", "10")),
+            degrade_min_ratio=float(os.getenv("DEGRADE_MIN_RATIO", "0.25")),
+            request_coalescing=os.getenv("REQUEST_COALESCING", "true").lower() == "true",
         )
         
         # Security Configuration
@@ -99,7 +265,42 @@ class Config:
             rate_limit_per_minute=int(os.getenv("RATE_LIMIT_PER_MINUTE", "10")),
             rate_limit_per_hour=int(os.getenv("RATE_LIMIT_PER_HOUR", "100")),
             allowed_origins=allowed_origins,
-            max_prompt_length=int(os.getenv("MAX_PROMPT_LENGTH", "2000")),
+            max_prompt_length=int(os.getenv("MAX_PROMPT_LENGTH", "8000")),
+            max_prompt_tokens=int(os.getenv("MAX_PROMPT_TOKENS", "1024")),
+            max_batch_items=int(os.getenv("MAX_BATCH_ITEMS", "10")),
+            max_image_batch_items=int(os.getenv("MAX_IMAGE_BATCH_ITEMS", "10")),
+            max_image_questions=int(os.getenv("MAX_IMAGE_QUESTIONS", "10")),
+            max_image_pixels=int(os.getenv("MAX_IMAGE_PIXELS", "40000000")),
+            local_image_root=os.getenv("LOCAL_IMAGE_ROOT") or None,
+        )
+        
+        # Compression Configuration
+        self.compression = CompressionConfig(
+            enabled=os.getenv("COMPRESSION_ENABLED", "true").lower() == "true",
+            level=int(os.getenv("COMPRESSION_LEVEL", "6")),
+            min_size=int(os.getenv("COMPRESSION_MIN_SIZE", "500")),
+        )
+        
+        # Chat Session Configuration
+        self.sessions = SessionConfig(
+            ttl=float(os.getenv("CHAT_SESSION_TTL", "900")),
+            max_cache_mb=int(os.getenv("CHAT_SESSION_CACHE_MB", "2048")),
+            max_sessions=int(os.getenv("CHAT_MAX_SESSIONS", "1000")),
+            max_context_tokens=int(os.getenv("CHAT_MAX_CONTEXT_TOKENS", "4096")),
+        )
+        
+        # Near-Duplicate Image Cache Configuration
+        self.image_cache = ImageCacheConfig(
+            enabled=os.getenv("IMAGE_CACHE_ENABLED", "true").lower() == "true",
+            max_entries=int(os.getenv("IMAGE_CACHE_SIZE", "100000")),
+            max_distance=int(os.getenv("IMAGE_CACHE_MAX_DISTANCE", "5")),
+        )
+        
+        # Persistent Generation Cache Configuration
+        self.disk_cache = DiskCacheConfig(
+            enabled=os.getenv("GENERATION_CACHE_ENABLED", "true").lower() == "true",
+            path=os.getenv("GENERATION_CACHE_PATH", "/var/cache/avito-ai/generations.sqlite3"),
+            max_mb=int(os.getenv("GENERATION_CACHE_MAX_MB", "1024")),
         )
         
         # Logging Configuration
@@ -60,9 +60,9 @@ fi
 # Check Python version
 log_info "Checking Python version..."
 PYTHON_VERSION=$(python3 --version 2>&1 | awk '{print $2}')
-REQUIRED_VERSION="3.8"
+REQUIRED_VERSION="3.11"
 if [ "$(printf '%s\n' "$REQUIRED_VERSION" "$PYTHON_VERSION" | sort -V | head -n1)" != "$REQUIRED_VERSION" ]; then
-    log_error "Python 3.8+ required. Found: $PYTHON_VERSION"
+    log_error "Python 3.11+ required. Found: $PYTHON_VERSION"
     exit 1
 fi
 log_success "Python version: $PYTHON_VERSION"
@@ -0,0 +1,114 @@
+"""
+Incremental Detokenization
+Turns generated token ids into text step by step at constant cost per token
+"""
+from typing import Callable, List, Optional
+
+from transformers.generation.streamers import BaseStreamer
+
+# What tokenizers emit for an incomplete UTF-8 sequence (e.g. half of a Cyrillic letter)
+REPLACEMENT_CHAR = "\ufffd"
+
+
+class IncrementalDetokenizer:
+    """
+    Text of one sequence, emitted as tokens arrive
+
+    Only a short window of recent tokens is decoded at each step. That is
+    the tokens since the last emitted text, plus the tokens of the emission
+    before it (the prefix). Decoding prefix+new and subtracting the decoded
+    prefix gives exactly the text the new tokens add, including
+    tokenizer-specific spacing such as SentencePiece's leading "▁". When the
+    window ends in U+FFFD, the last token split a multi-byte character. The
+    text is then held back until the character is complete. Tokens before
+    the prefix are dropped, so time and memory per step do not grow with the
+    output length. Text is held back for at most `max_pending` tokens, so a
+    run of invalid bytes from the model cannot widen the window.
+    """
+
+    def __init__(self, tokenizer, skip_special_tokens: bool = True, max_pending: int = 8):
+        self.tokenizer = tokenizer
+        self.skip_special_tokens = skip_special_tokens
+        self.max_pending = max_pending
+        self.tokens: List[int] = []  # window: prefix tokens, then not yet emitted tokens
+        self.read_offset = 0  # first token in the window whose text has not been emitted
+
+    def _decode(self, tokens: List[int]) -> str:
+        return self.tokenizer.decode(
+            tokens,
+            skip_special_tokens=self.skip_special_tokens,
+            clean_up_tokenization_spaces=False,
+        )
+
+    def step(self, token_id: int) -> str:
+        """Add one token; returns the text it completes (may be empty)"""
+        self.tokens.append(int(token_id))
+        prefix = self._decode(self.tokens[:self.read_offset])
+        full = self._decode(self.tokens)
+        pending = len(self.tokens) - self.read_offset
+        if (len(full) <= len(prefix) or full.endswith(REPLACEMENT_CHAR)) and pending < self.max_pending:
+            return ""
+        return self._emit(full[len(prefix):])
+
+    def finish(self) -> str:
+        """Text still held back (an incomplete character at the very end is emitted as U+FFFD)"""
+        prefix = self._decode(self.tokens[:self.read_offset])
+        full = self._decode(self.tokens)
+        return self._emit(full[len(prefix):])
+
+    def _emit(self, text: str) -> str:
+        # The emitted tokens become the next prefix; everything before it is no longer needed
+        del self.tokens[:self.read_offset]
+        self.read_offset = len(self.tokens)
+        return text
+
+
+class DetokenizingStreamer(BaseStreamer):
+    """
+    generate() streamer that hands each row's new text to a callback
+
+    Unlike transformers' TextStreamer, which re-decodes the whole output at
+    every step, each row keeps its own IncrementalDetokenizer, and padded
+    batches are supported. The first put() carries the prompt and is
+    skipped. A row stops producing text after its EOS token, because
+    generate() keeps padding finished rows until the batch is done.
+    """
+
+    def __init__(
+        self,
+        tokenizer,
+        on_text: Callable[[int, str], None],
+        eos_token_id: Optional[int] = None,
+        skip_special_tokens: bool = True,
+    ):
+        self.tokenizer = tokenizer
+        self.on_text = on_text
+        self.eos_token_id = tokenizer.eos_token_id if eos_token_id is None else eos_token_id
+        self.skip_special_tokens = skip_special_tokens
+        self.rows: List[IncrementalDetokenizer] = []
+        self.finished: List[bool] = []
+        self.prompt_seen = False
+
+    def put(self, value) -> None:
+        if not self.prompt_seen:
+            self.prompt_seen = True
+            return
+        # One token per row while sampling, several per row from assisted decoding
+        rows = value.reshape(value.shape[0], -1).tolist() if value.dim() > 1 else [[token] for token in value.tolist()]
+        if not self.rows:
+            self.rows = [IncrementalDetokenizer(self.tokenizer, self.skip_special_tokens) for _ in rows]
+            self.finished = [False] * len(rows)
+        for row, tokens in enumerate(rows):
+            for token_id in tokens:
+                if self.finished[row]:
+                    break
+                text = self.rows[row].step(token_id)
+                if text:
+                    self.on_text(row, text)
+                self.finished[row] = token_id == self.eos_token_id
+
+    def end(self) -> None:
+        for row, detokenizer in enumerate(self.rows):
+            text = detokenizer.finish()
+            if text:
+                self.on_text(row, text)
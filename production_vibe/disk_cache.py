@@ -0,0 +1,176 @@
+"""
+Persistent Generation Cache
+SQLite-backed result store shared by all gunicorn workers and kept across restarts
+"""
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from typing import Any, Dict, Optional
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    key TEXT PRIMARY KEY,
+    value BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    accessed REAL NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed);
+"""
+
+
+def cache_key(model: str, prompt: str, params: Dict[str, Any], image_digest: str = "") -> str:
+    """Stable key for one generation request"""
+    material = json.dumps([model, prompt, image_digest, params], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+def image_digest(data) -> str:
+    """Content hash of an encoded image (bytes, bytearray or memoryview)"""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+class DiskCache:
+    """
+    Key/value store for finished generations in one SQLite file
+
+    WAL mode lets every worker read while one writes, and a busy timeout
+    serializes writers across processes. Each thread keeps its own
+    connection, and the file is memory-mapped, so a warm read is one
+    B-tree lookup without a syscall per page. Access times are refreshed
+    at most every `touch_interval` seconds per entry, which keeps reads
+    from turning into writes. Once the stored values exceed `max_bytes`,
+    the least recently accessed entries are deleted down to 90% of it.
+    """
+
+    def __init__(self, path: str, max_bytes: int, touch_interval: float = 60.0, check_every: int = 100):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.touch_interval = touch_interval
+        self.check_every = check_every
+        self._local = threading.local()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evicted = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connection().executescript(SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        # A connection must not cross a fork (gunicorn --preload)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA mmap_size=268435456")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        conn = self._connection()
+        row = conn.execute("SELECT value, accessed FROM results WHERE key = ?", (key,)).fetchone()
+        with self.lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        now = time.time()
+        if now - row[1] > self.touch_interval:
+            try:
+                conn.execute("UPDATE results SET accessed = ? WHERE key = ?", (now, key))
+            except sqlite3.OperationalError:
+                pass  # another worker holds the write lock; the next read refreshes it
+        return json.loads(row[0])
+
+    def put(self, key: str, value: Dict[str, Any]) -> None:
+        blob = json.dumps(value, ensure_ascii=False).encode("utf-8")
+        now = time.time()
+        try:
+            self._connection().execute(
+                "INSERT OR REPLACE INTO results (key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                (key, blob, len(blob), now, now),
+            )
+        except sqlite3.OperationalError as e:
+            logger.warning(f"Generation cache write skipped: {e}")
+            return
+        with self.lock:
+            self.writes += 1
+            check = self.writes % self.check_every == 0
+        if check:
+            self.evict()
+
+    def evict(self) -> None:
+        """Delete least recently accessed entries while the cache is over its size limit"""
+        conn = self._connection()
+        try:
+            # Size check and delete in one write transaction, so workers evicting at once do not overshoot
+            conn.execute("BEGIN IMMEDIATE")
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+            deleted = 0
+            if total > self.max_bytes:
+                # Oldest-accessed entries whose running size total stays within the excess
+                deleted = conn.execute(
+                    """
+                    DELETE FROM results WHERE key IN (
+                        SELECT key FROM (
+                            SELECT key, size, SUM(size) OVER (ORDER BY accessed, key) AS running FROM results
+                        ) WHERE running - size < ?
+                    )
+                    """,
+                    (total - int(self.max_bytes * 0.9),),
+                ).rowcount
+            conn.execute("COMMIT")
+        except sqlite3.OperationalError as e:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            logger.warning(f"Generation cache eviction skipped: {e}")
+            return
+        if deleted:
+            with self.lock:
+                self.evicted += deleted
+            logger.info(f"Generation cache evicted {deleted} entries (was {total / 1024 ** 2:.1f} MB)")
+
+    def get_stats(self) -> dict:
+        entries, total = self._connection().execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results"
+        ).fetchone()
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "path": self.path,
+                "entries": entries,
+                "size_mb": round(total / 1024 ** 2, 2),
+                "max_size_mb": round(self.max_bytes / 1024 ** 2, 1),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "writes": self.writes,
+                "evicted": self.evicted,
+            }
+
+
+def _open_cache() -> Optional[DiskCache]:
+    if not config.disk_cache.enabled:
+        return None
+    try:
+        return DiskCache(config.disk_cache.path, config.disk_cache.max_mb * 1024 ** 2)
+    except (OSError, sqlite3.Error) as e:
+        logger.warning(f"Generation cache disabled: cannot open {config.disk_cache.path}: {e}")
+        return None
+
+
+# Global cache (None when disabled or the file cannot be opened)
+generation_cache = _open_cache()
@@ -12,7 +12,11 @@ backlog = 2048
 
 # Worker processes
 workers = int(os.getenv('WORKERS', '1'))  # Для GPU лучше использовать 1 worker
-worker_class = 'sync'
+# Потоки нужны, чтобы ожидающие запросы попадали в очередь инференса (и получали 503 при перегрузке),
+# а не висели в backlog сокета. По умолчанию потоков хватает на всю очередь плюс health/metrics
+queue_depth = int(os.getenv('INFERENCE_QUEUE_DEPTH', '32'))
+threads = int(os.getenv('THREADS', str(queue_depth + 8)))
+worker_class = 'gthread' if threads > 1 else 'sync'
 worker_connections = 1000
 timeout = 300  # 5 minutes timeout for inference
 keepalive = 5
@@ -44,6 +48,9 @@ def on_starting(server):
     print("="*70)
     print("🚀 Starting Avito AI API Server")
     print("="*70)
+    if threads <= queue_depth:
+        print(f"⚠️  THREADS={threads} <= INFERENCE_QUEUE_DEPTH={queue_depth}: at most {threads} request(s) "
+              f"per worker reach the inference queue, the rest wait in the socket backlog without 503s")
 
 def on_reload(server):
     """Called to recycle workers during a reload via SIGHUP."""
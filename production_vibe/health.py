@@ -6,7 +6,7 @@ import time
 import psutil
 import torch
 from datetime import datetime
-from typing import Dict, Any
+from typing import Dict, Any, Callable, List, Optional
 from dataclasses import dataclass, field
 from threading import Lock
 
@@ -27,6 +27,8 @@ class RequestMetrics:
     avision_requests: int = 0
     total_response_time: float = 0.0
     total_tokens_generated: int = 0
+    deadline_exceeded: int = 0
+    client_disconnected: int = 0
     
     def __post_init__(self):
         self.lock = Lock()
@@ -48,6 +50,14 @@ class RequestMetrics:
             self.total_response_time += response_time
             self.total_tokens_generated += tokens
     
+    def record_cancellation(self, reason: str):
+        """Record a generation stopped early"""
+        with self.lock:
+            if reason == "deadline_exceeded":
+                self.deadline_exceeded += 1
+            elif reason == "client_disconnected":
+                self.client_disconnected += 1
+    
     def get_stats(self) -> Dict[str, Any]:
         """Get current statistics"""
         with self.lock:
@@ -69,6 +79,8 @@ class RequestMetrics:
                 "avision_requests": self.avision_requests,
                 "avg_response_time": f"{avg_response_time:.3f}s",
                 "total_tokens_generated": self.total_tokens_generated,
+                "cancelled_deadline_exceeded": self.deadline_exceeded,
+                "cancelled_client_disconnected": self.client_disconnected,
             }
     
     def reset(self):
@@ -81,11 +93,50 @@ class RequestMetrics:
             self.avision_requests = 0
             self.total_response_time = 0.0
             self.total_tokens_generated = 0
+            self.deadline_exceeded = 0
+            self.client_disconnected = 0
 
 
 # Global metrics instance
 metrics = RequestMetrics()
 
+# Extra metric sections contributed by other components (name -> stats callable)
+metrics_providers: Dict[str, Callable[[], Dict[str, Any]]] = {}
+
+
+def register_metrics_provider(name: str, provider: Callable[[], Dict[str, Any]]):
+    """Expose a component's stats as a section of /api/metrics"""
+    metrics_providers[name] = provider
+
+
+@dataclass
+class WarmupStatus:
+    """Progress of the startup warmup pass; readiness waits for it"""
+    state: str = "pending"  # pending | running | done | failed | disabled
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    steps: List[Dict[str, Any]] = field(default_factory=list)
+    error: Optional[str] = None
+    
+    @property
+    def ready(self) -> bool:
+        return self.state in ("done", "disabled")
+    
+    def to_dict(self) -> Dict[str, Any]:
+        duration = None
+        if self.started_at is not None:
+            duration = round((self.finished_at or time.time()) - self.started_at, 2)
+        return {
+            "state": self.state,
+            "duration_seconds": duration,
+            "steps": list(self.steps),
+            "error": self.error,
+        }
+
+
+# Global warmup status (updated by the warmup thread)
+warmup_status = WarmupStatus()
+
 
 # ===============================
 # Health Check Blueprint
@@ -113,10 +164,18 @@ def health_check():
 @health_bp.route('/health/ready', methods=['GET'])
 def readiness_check():
     """
-    Readiness check - ensures models are loaded and GPU is available
+    Readiness check - ensures models are loaded, warmed up and GPU is available
     Returns 200 if service is ready to accept requests
     """
     try:
+        if not warmup_status.ready:
+            return jsonify({
+                "status": "not_ready",
+                "reason": "Warmup failed" if warmup_status.state == "failed" else "Warming up",
+                "warmup": warmup_status.to_dict(),
+                "timestamp": datetime.utcnow().isoformat()
+            }), 503
+        
         # Check CUDA availability
         if not torch.cuda.is_available():
             return jsonify({
@@ -197,7 +256,8 @@ def get_metrics():
                 "disk_free_gb": f"{disk.free / (1024**3):.2f}"
             },
             "gpu": gpu_metrics,
-            "application": app_metrics
+            "application": app_metrics,
+            **{name: provider() for name, provider in metrics_providers.items()}
         }), 200
     
     except Exception as e:
@@ -228,3 +288,8 @@ def record_inference_metrics(endpoint: str, success: bool, response_time: float,
     """Helper function to record inference metrics"""
     metrics.record_request(endpoint, success, response_time, tokens)
 
+
+
+def record_cancellation(reason: str):
+    """Helper function to record a generation stopped by deadline or disconnect"""
+    metrics.record_cancellation(reason)
@@ -0,0 +1,243 @@
+"""
+Image Questions
+Several questions about one image from one vision encode and one shared prefill
+"""
+import time
+import logging
+from threading import Lock
+from typing import Any, Dict, List, Optional, Tuple
+
+import torch
+from transformers import DynamicCache
+
+from batching import ImageItem, build_vision_chat, generate_image_batch, trim_generated
+from vision_pruning import VisionTokenPruner, get_vision_pruner
+
+logger = logging.getLogger(__name__)
+
+
+def question_rows(processor, item: ImageItem, questions: List[str]) -> Optional[Tuple[Any, List[List[int]], int]]:
+    """
+    Token ids of every question's prompt, preprocessing the image once
+
+    Everything up to the image's last placeholder token is the same for all
+    questions, so only the text after it is tokenized per question. Returns
+    (processor output of the first prompt, ids per question, shared prefix
+    length), or None if the chat template puts question text before the
+    image. The prefix always leaves at least one token per question.
+    """
+    texts = [build_vision_chat(processor, question, item.image) for question in questions]
+    cuts = [text.rindex(processor.image_token) + len(processor.image_token) for text in texts]
+    if any(text[:cut] != texts[0][:cuts[0]] for text, cut in zip(texts, cuts)):
+        return None
+    inputs = processor(text=texts[:1], images=[item.image], return_tensors="pt", padding=True)
+    first = inputs["input_ids"][0].tolist()
+    image_end = len(first) - first[::-1].index(processor.image_token_id)
+
+    rows = [first]
+    for text, cut in zip(texts[1:], cuts[1:]):
+        rows.append(first[:image_end] + processor.tokenizer(text[cut:], add_special_tokens=False)["input_ids"])
+
+    shared = min(len(row) for row in rows) - 1
+    for position in range(image_end, shared):
+        if any(row[position] != first[position] for row in rows):
+            shared = position
+            break
+    return inputs, rows, shared
+
+
+class QuestionStats:
+    """Multi-question calls and the prefill they shared"""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.requests = 0
+        self.questions = 0
+        self.shared_prefills = 0
+        self.prefill_tokens_saved = 0
+
+    def record(self, results: List[Dict[str, Any]]) -> None:
+        """Count one generate_image_questions() call from its results"""
+        shared = results[0]["metrics"].get("shared_prefix_tokens", 0)
+        with self.lock:
+            self.requests += 1
+            self.questions += len(results)
+            if shared:
+                self.shared_prefills += 1
+                self.prefill_tokens_saved += shared * (len(results) - 1)
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "questions": self.questions,
+                "avg_questions": round(self.questions / self.requests, 1) if self.requests else 0.0,
+                "shared_prefills": self.shared_prefills,
+                "prefill_tokens_saved": self.prefill_tokens_saved,
+            }
+
+
+# Global multi-question statistics
+question_stats = QuestionStats()
+
+
+@torch.inference_mode()
+def generate_image_questions(
+    model,
+    processor,
+    item: ImageItem,
+    questions: List[str],
+    max_new_tokens: int,
+    temperature: float,
+    top_p: float,
+    repetition_penalty: float,
+    stopping_criteria=None,
+) -> List[Dict[str, Any]]:
+    """
+    Answer several questions about one image in one generate() call
+
+    The vision encoder runs once and the shared image + chat template prefix
+    is prefilled once. Its KV cache is then repeated for every question, and
+    the question suffixes are decoded as one batch. The padding sits between
+    the prefix and each suffix, and every suffix gets the rotary positions it
+    would have alone. Returns per-question results shaped like
+    generate_image_batch's items, in question order. Models without Qwen2-VL
+    style image features fall back to a batch with the image repeated.
+    """
+    prep_start = time.time()
+    prepared = None
+    if VisionTokenPruner.supports(model) and getattr(processor, "image_token_id", None) is not None:
+        prepared = question_rows(processor, item, questions)
+    if prepared is None:
+        return generate_image_batch(
+            model,
+            processor,
+            [
+                ImageItem(index, question, item.image, item.decode_time, item.detail, item.original_size)
+                for index, question in enumerate(questions)
+            ],
+            max_new_tokens=max_new_tokens,
+            temperature=temperature,
+            top_p=top_p,
+            repetition_penalty=repetition_penalty,
+            stopping_criteria=stopping_criteria,
+        )
+
+    tokenizer = processor.tokenizer
+    pad_token_id = tokenizer.pad_token_id
+    if pad_token_id is None:
+        pad_token_id = tokenizer.eos_token_id
+
+    inputs, rows, shared = prepared
+    inputs = inputs.to(model.device)
+    prep_time = time.time() - prep_start
+
+    gen_start = time.time()
+    image_grid_thw = inputs["image_grid_thw"]
+    features = model.get_image_features(inputs["pixel_values"], image_grid_thw)
+    features = torch.cat(getattr(features, "pooler_output", features))
+
+    prefix_ids = inputs["input_ids"][:, :shared]
+    image_mask = prefix_ids == processor.image_token_id
+    rope_kwargs = {}
+    if "mm_token_type_ids" in inputs:
+        rope_kwargs["mm_token_type_ids"] = inputs["mm_token_type_ids"][:, :shared]
+    prefix_positions, _ = model.model.get_rope_index(
+        prefix_ids, image_grid_thw=image_grid_thw, attention_mask=torch.ones_like(prefix_ids), **rope_kwargs
+    )
+    prefix_embeds = model.get_input_embeddings()(prefix_ids)
+    prefix_embeds[image_mask] = features.to(prefix_embeds.device, prefix_embeds.dtype)
+    vision_tokens = features.shape[0]
+    next_position = int(prefix_positions.max()) + 1
+
+    # With pruning on, the shared prefix keeps only the chosen image tokens
+    pruner = get_vision_pruner(model)
+    kept_tokens = None
+    if pruner is not None:
+        frames, height, width = image_grid_thw[0].tolist()
+        grid = (frames, height // pruner.merge_size, width // pruner.merge_size)
+        keep = ~image_mask[0]
+        keep[image_mask[0].nonzero().squeeze(1)[pruner.select(features, grid)]] = True
+        prefix_ids = prefix_ids[:, keep]
+        prefix_embeds = prefix_embeds[:, keep]
+        prefix_positions = prefix_positions[:, :, keep]
+        kept_tokens = vision_tokens - int((~keep).sum())
+
+    # The base model fills the cache without computing logits for every prefix token
+    cache = DynamicCache()
+    model.model(
+        inputs_embeds=prefix_embeds,
+        attention_mask=torch.ones_like(prefix_ids),
+        position_ids=prefix_positions,
+        past_key_values=cache,
+        use_cache=True,
+    )
+    cache.batch_repeat_interleave(len(rows))
+
+    # [shared prefix][padding][question suffix]: padding is masked out, suffixes continue the prefix positions
+    prefix_len = prefix_ids.shape[1]
+    suffix_width = max(len(row) for row in rows) - shared
+    input_ids = torch.full((len(rows), prefix_len + suffix_width), pad_token_id, dtype=torch.long, device=model.device)
+    attention_mask = torch.zeros_like(input_ids)
+    position_ids = prefix_positions.new_zeros(3, len(rows), prefix_len + suffix_width)
+    input_ids[:, :prefix_len] = prefix_ids
+    attention_mask[:, :prefix_len] = 1
+    position_ids[:, :, :prefix_len] = prefix_positions
+    for row, ids in enumerate(rows):
+        suffix = ids[shared:]
+        start = prefix_len + suffix_width - len(suffix)
+        input_ids[row, start:] = torch.tensor(suffix, dtype=torch.long)
+        attention_mask[row, start:] = 1
+        position_ids[:, row, start:] = next_position + torch.arange(len(suffix))
+
+    generated_ids = model.generate(
+        input_ids=input_ids,
+        attention_mask=attention_mask,
+        position_ids=position_ids,
+        past_key_values=cache,
+        pad_token_id=pad_token_id,
+        max_new_tokens=max_new_tokens,
+        do_sample=temperature > 0,
+        temperature=temperature if temperature > 0 else None,
+        top_p=top_p,
+        repetition_penalty=repetition_penalty,
+        use_cache=True,
+        stopping_criteria=stopping_criteria,
+    )
+    gen_time = time.time() - gen_start
+    gen_ids = generated_ids[:, input_ids.shape[1]:].cpu()
+
+    prefill_tokens = prefix_len + sum(len(row) - shared for row in rows)
+
+    results = []
+    for row, ids in enumerate(rows):
+        tokens = trim_generated(gen_ids[row], tokenizer.eos_token_id, max_new_tokens)
+        results.append({
+            "index": row,
+            "success": True,
+            "data": {
+                "text": tokenizer.decode(tokens, skip_special_tokens=True),
+                "generated_tokens": len(tokens),
+                "input_tokens": len(ids),
+                "image_size": list(item.original_size or item.image.size),
+            },
+            "metrics": {
+                "batch_size": len(rows),
+                "detail": item.detail,
+                "vision_tokens": vision_tokens,
+                "shared_prefix_tokens": prefix_len,
+                "prefill_tokens": len(ids) - shared,
+                "decode_time": round(item.decode_time, 3),
+                "preprocess_time": round(prep_time, 3),
+                "generation_time": round(gen_time, 3),
+                "tokens_per_second": round(len(tokens) / gen_time, 2) if gen_time > 0 else 0.0,
+            },
+        })
+        if kept_tokens is not None:
+            results[-1]["metrics"]["vision_tokens_kept"] = kept_tokens
+
+    logger.info(
+        f"Image questions generated: questions={len(rows)}, shared_prefix={prefix_len}, "
+        f"prefill_tokens={prefill_tokens}, max_new_tokens={max_new_tokens}, time={gen_time:.2f}s"
+    )
+    return results
@@ -0,0 +1,315 @@
+"""
+Image Handling
+Decoding helpers shared by the Avision routes
+"""
+import io
+import os
+import mmap
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass
+from threading import Lock
+from typing import BinaryIO, Dict, Iterator, List, Optional, Tuple
+
+from PIL import Image
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+
+# ===============================
+# Header Validation
+# ===============================
+
+# Leading bytes of every format we accept; anything else is rejected unread
+IMAGE_SIGNATURES = (
+    (b"\xff\xd8\xff", "JPEG"),
+    (b"\x89PNG\r\n\x1a\n", "PNG"),
+    (b"GIF87a", "GIF"),
+    (b"GIF89a", "GIF"),
+)
+
+EXTENSION_FORMATS = {
+    ".jpg": "JPEG",
+    ".jpeg": "JPEG",
+    ".png": "PNG",
+    ".gif": "GIF",
+    ".webp": "WEBP",
+}
+
+# PIL's own guard stays on as a backstop: it warns above this and refuses above twice this
+Image.MAX_IMAGE_PIXELS = config.security.max_image_pixels
+
+
+class ImageRejected(ValueError):
+    """Upload refused before decoding (unknown format or over the pixel budget)"""
+
+
+def sniff_image_format(header: bytes) -> Optional[str]:
+    """Identify the image format from its first bytes, or None if unsupported"""
+    for signature, fmt in IMAGE_SIGNATURES:
+        if header.startswith(signature):
+            return fmt
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "WEBP"
+    return None
+
+
+def allowed_image_formats() -> set:
+    return {
+        EXTENSION_FORMATS[ext]
+        for ext in config.security.allowed_image_extensions
+        if ext in EXTENSION_FORMATS
+    }
+
+
+def open_image_checked(fp: BinaryIO) -> Image.Image:
+    """
+    Open an image lazily after checking its signature and declared dimensions
+
+    Only the header is parsed here; pixel data is decoded later by load()
+    or convert(), and only if the declared size fits the pixel budget.
+    """
+    start = fp.tell()
+    header = fp.read(16)
+    fp.seek(start)
+
+    fmt = sniff_image_format(header)
+    if fmt is None or fmt not in allowed_image_formats():
+        raise ImageRejected("Unsupported image format")
+
+    try:
+        img = Image.open(fp, formats=[fmt])
+    except Image.DecompressionBombError:
+        raise ImageRejected("Image dimensions exceed the allowed pixel budget")
+
+    width, height = img.size
+    budget = config.security.max_image_pixels
+    if width * height > budget:
+        # Not closed explicitly: Image.close() would also close the caller's stream
+        del img
+        raise ImageRejected(
+            f"Image too large: {width}x{height} exceeds the budget of {budget} pixels"
+        )
+    return img
+
+
+def inspect_image_header(fp: BinaryIO) -> Tuple[str, Tuple[int, int]]:
+    """Validate an image by its header alone; returns (format, (width, height))"""
+    start = fp.tell()
+    try:
+        img = open_image_checked(fp)
+        return img.format, img.size
+    finally:
+        fp.seek(start)
+
+
+# PIL releases the GIL while decoding, so a thread pool gives real parallelism
+_decode_pool = ThreadPoolExecutor(
+    max_workers=config.model.image_decode_workers,
+    thread_name_prefix="image-decode"
+)
+
+
+@dataclass
+class DecodedImage:
+    """Result of decoding one upload"""
+    image: Optional[Image.Image]
+    decode_time: float
+    error: Optional[str] = None
+
+
+def decode_image(data: bytes) -> Image.Image:
+    """Decode image bytes into an RGB PIL image"""
+    with open_image_checked(io.BytesIO(data)) as img:
+        return img.convert("RGB")
+
+
+def _timed_decode(data: bytes) -> DecodedImage:
+    start = time.time()
+    try:
+        img = decode_image(data)
+        return DecodedImage(image=img, decode_time=time.time() - start)
+    except ImageRejected as e:
+        return DecodedImage(image=None, decode_time=time.time() - start, error=str(e))
+    except Exception as e:
+        logger.warning(f"Failed to decode image: {e}")
+        return DecodedImage(image=None, decode_time=time.time() - start, error="Cannot decode image")
+
+
+def decode_images_parallel(blobs: List[bytes]) -> List[DecodedImage]:
+    """Decode many images concurrently, preserving input order"""
+    return list(_decode_pool.map(_timed_decode, blobs))
+
+
+# ===============================
+# Single-Buffer Decoding
+# ===============================
+
+class BufferReader(io.RawIOBase):
+    """
+    Seekable read-only file object over a memoryview
+    PIL reads through it in small chunks, so the encoded image is never copied as a whole
+    """
+
+    def __init__(self, view: memoryview):
+        super().__init__()
+        self._view = view.cast("B") if view.format != "B" else view
+        self._pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        n = min(len(b), len(self._view) - self._pos)
+        if n <= 0:
+            return 0
+        b[:n] = self._view[self._pos:self._pos + n]
+        self._pos += n
+        return n
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = len(self._view) + offset
+        else:
+            raise ValueError(f"Invalid whence: {whence}")
+        if pos < 0:
+            raise ValueError("Negative seek position")
+        self._pos = pos
+        return pos
+
+    def tell(self) -> int:
+        return self._pos
+
+    def close(self) -> None:
+        # Drop our reference so the owner can release the underlying buffer
+        self._view = memoryview(b"")
+        super().close()
+
+
+def decode_image_buffer(view: memoryview) -> Image.Image:
+    """Decode an image straight from a buffer without materializing a bytes copy"""
+    reader = BufferReader(view)
+    try:
+        with open_image_checked(reader) as img:
+            return img.convert("RGB")
+    finally:
+        reader.close()
+
+
+def read_body_into_buffer(stream, length: int) -> memoryview:
+    """
+    Read exactly `length` bytes of a request body into one preallocated buffer
+    Raises ValueError if the body ends early
+    """
+    buffer = bytearray(length)
+    view = memoryview(buffer)
+    pos = 0
+    readinto = getattr(stream, "readinto", None)
+    while pos < length:
+        if readinto is not None:
+            n = readinto(view[pos:])
+        else:
+            chunk = stream.read(min(length - pos, 1024 * 1024))
+            n = len(chunk)
+            view[pos:pos + n] = chunk
+        if not n:
+            raise ValueError(f"Request body ended after {pos} of {length} bytes")
+        pos += n
+    return view
+
+
+@contextmanager
+def mapped_file(path: str) -> Iterator[memoryview]:
+    """Memory-map a local file read-only and expose it as a memoryview"""
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            yield memoryview(b"")
+            return
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(mm)
+    try:
+        yield view
+    finally:
+        view.release()
+        mm.close()
+
+
+# ===============================
+# Detail Levels
+# ===============================
+
+# Per-request "detail": how many pixels of a photo reach the vision encoder
+DETAIL_LEVELS = ("low", "auto", "high")
+
+
+def detail_pixel_budget(detail: str) -> int:
+    """Pixel budget of a detail level (0 = leave the resolution to the processor)"""
+    return {
+        "low": config.model.image_detail_low_pixels,
+        "auto": config.model.image_detail_auto_pixels,
+        "high": config.model.image_detail_high_pixels,
+    }[detail]
+
+
+def resize_for_detail(img: Image.Image, detail: str) -> Image.Image:
+    """
+    Downscale an image to its detail level's pixel budget
+
+    Avision's processor works at dynamic resolution: the number of vision
+    tokens, and the prefill they cost, grows with the pixel count. Shrinking
+    the image first is what makes a "low" moderation check cheap. The aspect
+    ratio is kept and images are never upscaled.
+    """
+    budget = detail_pixel_budget(detail)
+    width, height = img.size
+    if not budget or width * height <= budget:
+        return img
+    scale = (budget / (width * height)) ** 0.5
+    size = (max(1, int(width * scale)), max(1, int(height * scale)))
+    return img.resize(size, Image.BICUBIC)
+
+
+class DetailStats:
+    """Requests and vision tokens per detail level"""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.requests: Dict[str, int] = {detail: 0 for detail in DETAIL_LEVELS}
+        self.vision_tokens: Dict[str, int] = {detail: 0 for detail in DETAIL_LEVELS}
+
+    def record(self, metrics: dict) -> None:
+        """Count one generated result (its metrics carry "detail" and "vision_tokens")"""
+        detail = metrics.get("detail")
+        if detail not in self.requests:
+            return
+        with self.lock:
+            self.requests[detail] += 1
+            self.vision_tokens[detail] += metrics.get("vision_tokens") or 0
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {
+                detail: {
+                    "requests": self.requests[detail],
+                    "avg_vision_tokens": round(self.vision_tokens[detail] / self.requests[detail], 1)
+                    if self.requests[detail] else 0.0,
+                    "max_pixels": detail_pixel_budget(detail),
+                }
+                for detail in DETAIL_LEVELS
+            }
+
+
+# Global detail statistics
+detail_stats = DetailStats()
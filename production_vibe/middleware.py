@@ -5,16 +5,17 @@ Handles validation, error handling, rate limiting, and request tracing
 import uuid
 import time
 import functools
-from typing import Dict, Callable
+from typing import Dict, Callable, List
 from datetime import datetime, timedelta
 from collections import defaultdict
 from threading import Lock
 
-from flask import request, jsonify, g
+from flask import request, jsonify, g, has_app_context
 from werkzeug.exceptions import HTTPException
 import logging
 
 from config import config
+from imaging import DETAIL_LEVELS, ImageRejected, inspect_image_header
 
 logger = logging.getLogger(__name__)
 
@@ -62,9 +63,10 @@ class RateLimiter:
         self.requests: Dict[str, list] = defaultdict(list)
         self.lock = Lock()
     
-    def is_allowed(self, client_id: str, max_per_minute: int, max_per_hour: int) -> tuple[bool, str]:
+    def is_allowed(self, client_id: str, max_per_minute: int, max_per_hour: int, cost: int = 1) -> tuple[bool, str]:
         """
         Check if request is allowed based on rate limits
+        A request with cost N counts as N requests (e.g. a batch of N prompts)
         Returns (is_allowed, error_message)
         """
         with self.lock:
@@ -82,15 +84,15 @@ class RateLimiter:
             
             # Check minute limit
             minute_requests = [t for t in recent_requests if t > minute_ago]
-            if len(minute_requests) >= max_per_minute:
+            if len(minute_requests) + cost > max_per_minute:
                 return False, f"Rate limit exceeded: {max_per_minute} requests per minute"
             
             # Check hour limit
-            if len(recent_requests) >= max_per_hour:
+            if len(recent_requests) + cost > max_per_hour:
                 return False, f"Rate limit exceeded: {max_per_hour} requests per hour"
             
             # Add current request
-            self.requests[client_id].append(now)
+            self.requests[client_id].extend([now] * cost)
             return True, ""
     
     def get_stats(self, client_id: str) -> dict:
@@ -115,31 +117,64 @@ class RateLimiter:
 rate_limiter = RateLimiter()
 
 
+def _check_rate_limit(cost: int = 1):
+    """Return a 429 response if the client is over its limits, else None"""
+    # Use IP address as client identifier
+    client_id = request.remote_addr or "unknown"
+    
+    allowed, error_msg = rate_limiter.is_allowed(
+        client_id,
+        config.security.rate_limit_per_minute,
+        config.security.rate_limit_per_hour,
+        cost
+    )
+    
+    if not allowed:
+        logger.warning(f"Rate limit exceeded for {client_id}")
+        return jsonify({
+            "error": "rate_limit_exceeded",
+            "message": error_msg,
+            "request_id": getattr(g, 'request_id', None)
+        }), 429
+    return None
+
+
 def rate_limit_required(f: Callable) -> Callable:
     """Decorator to enforce rate limiting"""
     @functools.wraps(f)
     def decorated_function(*args, **kwargs):
-        # Use IP address as client identifier
-        client_id = request.remote_addr or "unknown"
-        
-        allowed, error_msg = rate_limiter.is_allowed(
-            client_id,
-            config.security.rate_limit_per_minute,
-            config.security.rate_limit_per_hour
-        )
-        
-        if not allowed:
-            logger.warning(f"Rate limit exceeded for {client_id}")
-            return jsonify({
-                "error": "rate_limit_exceeded",
-                "message": error_msg,
-                "request_id": getattr(g, 'request_id', None)
-            }), 429
-        
+        limited = _check_rate_limit()
+        if limited:
+            return limited
         return f(*args, **kwargs)
     return decorated_function
 
 
+def rate_limit_cost(cost_fn: Callable[[], int]) -> Callable:
+    """
+    Decorator to enforce rate limiting for requests that carry several units of work
+    cost_fn is called inside the request context and returns how many requests to charge.
+    A request costing more than the per-minute limit could never pass, so it is
+    rejected with 400 instead of 429.
+    """
+    def decorator(f: Callable) -> Callable:
+        @functools.wraps(f)
+        def decorated_function(*args, **kwargs):
+            cost = max(1, cost_fn())
+            limit = min(config.security.rate_limit_per_minute, config.security.rate_limit_per_hour)
+            if cost > limit:
+                raise ValidationError(
+                    f"Request has {cost} items, but each item counts against the rate limit "
+                    f"of {limit} requests per minute. Split it into batches of at most {limit}"
+                )
+            limited = _check_rate_limit(cost)
+            if limited:
+                return limited
+            return f(*args, **kwargs)
+        return decorated_function
+    return decorator
+
+
 # ===============================
 # Error Handling
 # ===============================
@@ -148,12 +183,13 @@ class APIError(Exception):
     """Base API error class"""
     status_code = 500
     
-    def __init__(self, message: str, status_code: int = None, payload=None):
+    def __init__(self, message: str, status_code: int = None, payload=None, headers: dict = None):
         super().__init__()
         self.message = message
         if status_code is not None:
             self.status_code = status_code
         self.payload = payload
+        self.headers = headers or {}
     
     def to_dict(self):
         rv = dict(self.payload or ())
@@ -168,11 +204,38 @@ class ValidationError(APIError):
     status_code = 400
 
 
+class NotFoundError(APIError):
+    """Requested resource does not exist"""
+    status_code = 404
+
+
 class ModelError(APIError):
     """Model inference error"""
     status_code = 500
 
 
+class DeadlineExceededError(APIError):
+    """Generation stopped because the request deadline passed"""
+    status_code = 504
+
+
+class ClientClosedRequestError(APIError):
+    """Generation stopped because the client went away (nginx-style 499)"""
+    status_code = 499
+
+
+class ServiceOverloadedError(APIError):
+    """Request shed because it could not be served in time"""
+    status_code = 503
+    
+    def __init__(self, message: str, retry_after: int = 1):
+        super().__init__(
+            message,
+            payload={"retry_after": retry_after},
+            headers={"Retry-After": str(retry_after)}
+        )
+
+
 def setup_error_handlers(app):
     """Setup global error handlers"""
     
@@ -180,6 +243,7 @@ def setup_error_handlers(app):
     def handle_api_error(error):
         response = jsonify(error.to_dict())
         response.status_code = error.status_code
+        response.headers.update(error.headers)
         logger.error(f"API Error: {error.message}", extra={'request_id': getattr(g, 'request_id', 'N/A')})
         return response
     
@@ -226,6 +290,31 @@ def validate_prompt(prompt: str, max_length: int = None) -> str:
     return prompt
 
 
+def validate_prompt_tokens(input_ids: List[int], max_tokens: int = None) -> List[int]:
+    """Validate prompt size in tokens (after the chat template), which is what prefill costs"""
+    max_len = max_tokens or config.security.max_prompt_tokens
+    if len(input_ids) > max_len:
+        raise ValidationError(
+            f"Prompt too long: {len(input_ids)} tokens after the chat template. Maximum: {max_len} tokens"
+        )
+    return input_ids
+
+
+def validate_generation_params(max_tokens, temperature) -> None:
+    """Validate per-request generation parameters"""
+    if not isinstance(max_tokens, int) or max_tokens < 1 or max_tokens > 1024:
+        raise ValidationError("max_tokens must be between 1 and 1024")
+    if not isinstance(temperature, (int, float)) or temperature < 0 or temperature > 2:
+        raise ValidationError("temperature must be between 0 and 2")
+
+
+def validate_image_detail(detail) -> str:
+    """Validate a per-request image detail level"""
+    if detail not in DETAIL_LEVELS:
+        raise ValidationError(f"detail must be one of: {', '.join(DETAIL_LEVELS)}")
+    return detail
+
+
 def validate_image_file(file) -> None:
     """Validate uploaded image file"""
     if not file:
@@ -253,6 +342,16 @@ def validate_image_file(file) -> None:
     
     if size == 0:
         raise ValidationError("File is empty")
+    
+    # Check format signature and declared dimensions (header only, nothing is decoded)
+    try:
+        inspect_image_header(file.stream)
+    except ImageRejected as e:
+        raise ValidationError(str(e))
+    except Exception:
+        raise ValidationError("Cannot read image header")
+    finally:
+        file.seek(0)
 
 
 # ===============================
@@ -263,6 +362,7 @@ class RequestContextFilter(logging.Filter):
     """Add request context to log records"""
     
     def filter(self, record):
-        record.request_id = getattr(g, 'request_id', 'N/A')
+        # Startup code and worker threads log outside any request/app context
+        record.request_id = getattr(g, 'request_id', 'N/A') if has_app_context() else 'N/A'
         return True
 
@@ -0,0 +1,129 @@
+"""
+Near-Duplicate Image Cache
+Perceptual hashes of analyzed images and a bounded index answering repeats from cache
+"""
+import time
+import hashlib
+import logging
+from threading import Lock
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+HASH_BITS = 64
+
+_M1 = np.uint64(0x5555555555555555)
+_M2 = np.uint64(0x3333333333333333)
+_M4 = np.uint64(0x0F0F0F0F0F0F0F0F)
+_H01 = np.uint64(0x0101010101010101)
+
+
+def popcount(values: np.ndarray) -> np.ndarray:
+    """Number of set bits in every element of a uint64 array"""
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(values)
+    # NumPy < 2.0: SWAR bit count, still one vectorized pass per step
+    values = values - ((values >> np.uint64(1)) & _M1)
+    values = (values & _M2) + ((values >> np.uint64(2)) & _M2)
+    values = (values + (values >> np.uint64(4))) & _M4
+    return ((values * _H01) >> np.uint64(56)).astype(np.uint8)
+
+
+def dhash(image: Image.Image) -> int:
+    """
+    64-bit difference hash: is each pixel brighter than its left neighbour?
+
+    The image is reduced to 9x8 grayscale first, so re-encoding, resizing
+    and small crops or color shifts change only a few bits.
+    """
+    gray = image.convert("L").resize((9, 8), Image.Resampling.BOX, reducing_gap=2.0)
+    pixels = np.asarray(gray, dtype=np.int16)
+    bits = pixels[:, 1:] > pixels[:, :-1]
+    return int(np.packbits(bits).view(">u8")[0])
+
+
+def request_key(prompt: str, max_tokens: int, temperature: float, detail: str = "auto") -> int:
+    """64-bit fingerprint of the generation parameters a cached answer is valid for"""
+    digest = hashlib.blake2b(
+        f"{prompt}\0{max_tokens}\0{temperature}\0{detail}".encode("utf-8"), digest_size=8
+    ).digest()
+    return int.from_bytes(digest, "big")
+
+
+class NearDuplicateCache:
+    """
+    Recent Avision answers indexed by perceptual hash
+
+    Hashes and request keys live in preallocated uint64 arrays used as a
+    ring buffer, so memory is fixed and the oldest entry is overwritten
+    once `max_entries` is reached. A lookup XORs the query against every
+    stored hash and counts bits in one vectorized pass. The nearest entry
+    with the same request key wins if it is within `max_distance` bits.
+    """
+
+    def __init__(self, max_entries: int = 100_000, max_distance: int = 5):
+        self.max_entries = max_entries
+        self.max_distance = max_distance
+        self.hashes = np.zeros(max_entries, dtype=np.uint64)
+        self.keys = np.zeros(max_entries, dtype=np.uint64)
+        self.results: List[Optional[Dict[str, Any]]] = [None] * max_entries
+        self.size = 0
+        self.next_slot = 0
+        self.lock = Lock()
+        self.lookups = 0
+        self.hits = 0
+        self.exact_hits = 0
+        self.lookup_seconds = 0.0
+
+    def lookup(self, image_hash: int, key: int) -> Optional[Tuple[Dict[str, Any], int]]:
+        """(cached data, Hamming distance) of the nearest matching entry, or None"""
+        start = time.perf_counter()
+        with self.lock:
+            self.lookups += 1
+            found = None
+            if self.size:
+                distances = popcount(self.hashes[:self.size] ^ np.uint64(image_hash))
+                distances[self.keys[:self.size] != np.uint64(key)] = HASH_BITS + 1
+                slot = int(np.argmin(distances))
+                distance = int(distances[slot])
+                if distance <= self.max_distance:
+                    found = (dict(self.results[slot]), distance)
+                    self.hits += 1
+                    if distance == 0:
+                        self.exact_hits += 1
+            self.lookup_seconds += time.perf_counter() - start
+        return found
+
+    def store(self, image_hash: int, key: int, data: Dict[str, Any]) -> None:
+        with self.lock:
+            slot = self.next_slot
+            self.hashes[slot] = image_hash
+            self.keys[slot] = key
+            self.results[slot] = dict(data)
+            self.next_slot = (slot + 1) % self.max_entries
+            self.size = min(self.size + 1, self.max_entries)
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {
+                "entries": self.size,
+                "max_entries": self.max_entries,
+                "max_distance": self.max_distance,
+                "lookups": self.lookups,
+                "hits": self.hits,
+                "exact_hits": self.exact_hits,
+                "hit_rate": round(self.hits / self.lookups, 3) if self.lookups else 0.0,
+                "avg_lookup_ms": round(1000 * self.lookup_seconds / self.lookups, 3) if self.lookups else 0.0,
+            }
+
+
+# Global cache for the Avision routes (None when disabled)
+image_cache = NearDuplicateCache(
+    max_entries=config.image_cache.max_entries,
+    max_distance=config.image_cache.max_distance,
+) if config.image_cache.enabled else None
@@ -0,0 +1,562 @@
+"""
+Model Replicas
+Pool of model copies (in-process or worker processes) with least-loaded routing and health checks
+"""
+import os
+import sys
+import time
+import signal
+import logging
+import shutil
+import secrets
+import tempfile
+import importlib
+import subprocess
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from multiprocessing.connection import Client, Listener
+from threading import Lock, Thread
+from typing import Any, Dict, List, Optional
+
+import torch
+from transformers import StoppingCriteria, StoppingCriteriaList
+
+from config import config
+from batching import generate_text_batch, generate_image_batch
+from image_questions import generate_image_questions
+from middleware import ServiceOverloadedError
+from residency import residency_manager
+from sessions import generate_chat_turn
+
+logger = logging.getLogger(__name__)
+
+# Work a replica can run: (model, tokenizer/processor, **kwargs) -> per-item results
+TASKS = {
+    "text_batch": generate_text_batch,
+    "image_batch": generate_image_batch,
+    "image_questions": generate_image_questions,
+    "chat_turn": generate_chat_turn,  # in-process replicas only: the session holds device tensors
+}
+
+
+class ReplicaError(RuntimeError):
+    """The replica itself failed (worker died or stopped answering), not the request"""
+
+
+# ===============================
+# Model Loading
+# ===============================
+
+def _dtype_for(device: str):
+    return torch.float16 if device.startswith("cuda") else torch.float32
+
+
+def load_avibe(device: str):
+    """Load an Avibe replica on `device`; returns (model, tokenizer)"""
+    from transformers import AutoTokenizer, AutoModelForCausalLM
+    from static_decode import enable_static_decode
+    from speculative import enable_speculative_decode
+
+    tokenizer = AutoTokenizer.from_pretrained(
+        "AvitoTech/avibe",
+        cache_dir=config.model.vibe_tokenizer_dir,
+        local_files_only=True
+    )
+    model = AutoModelForCausalLM.from_pretrained(
+        "AvitoTech/avibe",
+        cache_dir=config.model.vibe_model_dir,
+        torch_dtype=_dtype_for(device),
+        device_map=device,
+        local_files_only=True,
+        low_cpu_mem_usage=True,
+    )
+    if config.model.static_decode:
+        enable_static_decode(model)
+    if config.model.speculative_draft_model:
+        enable_speculative_decode(model, tokenizer)
+    return model, tokenizer
+
+
+def load_avision(device: str):
+    """Load an Avision replica on `device`; returns (model, processor)"""
+    from transformers import AutoProcessor, AutoModelForImageTextToText
+    from vision_pruning import enable_vision_pruning
+
+    processor = AutoProcessor.from_pretrained(config.model.vision_snapshot_dir, local_files_only=True)
+    processor.tokenizer.padding_side = "left"
+    model = AutoModelForImageTextToText.from_pretrained(
+        config.model.vision_snapshot_dir,
+        torch_dtype=_dtype_for(device),
+        device_map=device,
+        local_files_only=True,
+        low_cpu_mem_usage=True,
+    )
+    if config.model.vision_keep_ratio < 1.0:
+        enable_vision_pruning(model)
+    return model, processor
+
+
+def _import_loader(path: str):
+    """Resolve a "module:function" loader reference"""
+    module_name, _, attr = path.partition(":")
+    return getattr(importlib.import_module(module_name), attr)
+
+
+# ===============================
+# Replicas
+# ===============================
+
+class ModelReplica(ABC):
+    """One copy of a model; runs one task at a time"""
+
+    def __init__(self, name: str, device: str):
+        self.name = name
+        self.device = device
+        self.lock = Lock()
+        self.healthy = False
+        self.queued_tokens = 0
+        self.in_flight = 0
+        self.requests = 0
+        self.failures = 0
+        self.last_error: Optional[str] = None
+
+    @abstractmethod
+    def run(self, task: str, kwargs: Dict[str, Any], control=None) -> Any:
+        """Run one task (see TASKS) on this replica's model"""
+
+    @abstractmethod
+    def check(self) -> bool:
+        """Health probe; sets last_error when it fails"""
+
+    def restart(self) -> None:
+        """Bring a failed replica back (only worker processes can be restarted)"""
+
+    def get_stats(self) -> dict:
+        return {
+            "name": self.name,
+            "device": self.device,
+            "healthy": self.healthy,
+            "queued_tokens": self.queued_tokens,
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "failures": self.failures,
+            "last_error": self.last_error,
+        }
+
+
+class LocalReplica(ModelReplica):
+    """A model loaded in this process (e.g. one per GPU)"""
+
+    def __init__(self, name: str, device: str, model, preprocessor):
+        super().__init__(name, device)
+        self.model = model
+        self.preprocessor = preprocessor
+        self.healthy = True
+
+    def run(self, task: str, kwargs: Dict[str, Any], control=None) -> Any:
+        with self.lock, residency_manager.use(self.model):
+            return TASKS[task](
+                self.model,
+                self.preprocessor,
+                stopping_criteria=control.criteria() if control is not None else None,
+                **kwargs
+            )
+
+    def check(self) -> bool:
+        if self.device.startswith("cuda"):
+            try:
+                torch.cuda.mem_get_info(torch.device(self.device))
+            except Exception as e:
+                self.last_error = str(e)
+                return False
+        return True
+
+
+# Set by SIGUSR1 in a worker process: the parent wants the running task stopped
+_cancel_requested = False
+
+
+def _request_cancel(signum, frame) -> None:
+    global _cancel_requested
+    _cancel_requested = True
+
+
+class _WorkerStop(StoppingCriteria):
+    """Stopping criterion inside a worker: deadline (wall clock) or cancellation by the parent"""
+
+    def __init__(self, deadline: Optional[float]):
+        self.deadline = deadline
+
+    def __call__(self, input_ids, scores, **kwargs):
+        stop = _cancel_requested or (self.deadline is not None and time.time() >= self.deadline)
+        return torch.full((input_ids.shape[0],), stop, dtype=torch.bool, device=input_ids.device)
+
+
+def _worker_main(address: str, loader: str, device: str) -> None:
+    """
+    Entry point of a replica worker process (python -m replicas ...)
+
+    The worker listens on a private unix socket, accepts its parent, loads
+    the model, then answers one request at a time until the parent hangs up.
+    """
+    global _cancel_requested
+    signal.signal(signal.SIGUSR1, _request_cancel)
+    authkey = bytes.fromhex(os.environ.pop("REPLICA_AUTHKEY"))
+    with Listener(address, family="AF_UNIX", authkey=authkey) as listener, listener.accept() as conn:
+        model, preprocessor = _import_loader(loader)(device)
+        model.eval()
+        conn.send(("ready", {"pid": os.getpid()}))
+        while True:
+            try:
+                op, payload = conn.recv()
+            except EOFError:
+                return
+            if op == "ping":
+                conn.send(("ok", None))
+                continue
+            _cancel_requested = False
+            deadline = payload.pop("deadline", None)
+            try:
+                with torch.inference_mode():
+                    results = TASKS[op](
+                        model,
+                        preprocessor,
+                        stopping_criteria=StoppingCriteriaList([_WorkerStop(deadline)]),
+                        **payload
+                    )
+                conn.send(("ok", results))
+            except Exception as e:
+                conn.send(("error", f"{type(e).__name__}: {e}"))
+
+
+class ProcessReplica(ModelReplica):
+    """
+    A model served by a separate worker process
+
+    Workers are started as `python -m replicas`, so they never inherit CUDA
+    state and never re-run the app module. Requests and results go over an
+    authenticated unix socket. Deadlines are passed as wall-clock times. A
+    client disconnect that the parent notices is forwarded as SIGUSR1, which
+    the worker's stopping criterion picks up at the next decode step. A
+    worker that has not answered `stop_grace` seconds after the request's
+    deadline is considered wedged and killed, so the health check restarts it.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        device: str,
+        loader: str,
+        startup_timeout: float = 600.0,
+        poll_interval: float = 0.25,
+        stop_grace: float = 30.0,
+    ):
+        super().__init__(name, device)
+        self.loader = loader
+        self.startup_timeout = startup_timeout
+        self.poll_interval = poll_interval
+        self.stop_grace = stop_grace
+        self.process: Optional[subprocess.Popen] = None
+        self.conn = None
+        self._address = None
+        self._authkey = None
+        self.restarting = False
+        # Monotonic time by which the running task must have answered (None when idle)
+        self.busy_until: Optional[float] = None
+
+    def start(self) -> None:
+        self._address = os.path.join(tempfile.mkdtemp(prefix="replica-"), "socket")
+        self._authkey = secrets.token_bytes(16)
+        env = dict(os.environ)
+        env["REPLICA_AUTHKEY"] = self._authkey.hex()
+        env["PYTHONPATH"] = os.pathsep.join(path for path in sys.path if path)
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "replicas", self._address, self.loader, self.device],
+            env=env,
+        )
+
+    def _alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def wait_ready(self) -> bool:
+        """Connect to the worker and block until it has loaded its model"""
+        deadline = time.monotonic() + self.startup_timeout
+        while self.conn is None and self._alive() and time.monotonic() < deadline:
+            try:
+                self.conn = Client(self._address, family="AF_UNIX", authkey=self._authkey)
+            except (FileNotFoundError, ConnectionRefusedError):
+                time.sleep(0.1)
+        if self.conn is not None and self.conn.poll(max(deadline - time.monotonic(), 0)):
+            try:
+                status, info = self.conn.recv()
+            except EOFError:
+                status, info = "exited", None
+            if status == "ready":
+                self.healthy = True
+                logger.info(f"Replica {self.name} ready on {self.device} (pid {info['pid']})")
+                return True
+        self.last_error = "Worker failed to start"
+        logger.error(f"Replica {self.name} failed to start on {self.device}")
+        return False
+
+    def stop(self) -> None:
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+        if self._alive():
+            self.process.kill()
+            self.process.wait(5)
+        if self._address is not None:
+            shutil.rmtree(os.path.dirname(self._address), ignore_errors=True)
+
+    def restart(self) -> None:
+        # Out of rotation first, so no request waits on the lock for the whole startup
+        self.healthy = False
+        self.restarting = True
+        try:
+            with self.lock:
+                logger.warning(f"Restarting replica {self.name}")
+                self.stop()
+                self.start()
+                self.wait_ready()
+        finally:
+            self.restarting = False
+
+    def _call(self, op: str, payload, control=None, timeout: Optional[float] = None):
+        """Send one request and wait for its reply (caller holds the lock)"""
+        if self.conn is None:
+            raise ReplicaError(f"Replica {self.name} is not connected")
+        try:
+            self.conn.send((op, payload))
+        except (OSError, ValueError) as e:
+            raise ReplicaError(f"Replica {self.name} is unreachable: {e}")
+        waited = 0.0
+        cancelled = False
+        while not self.conn.poll(self.poll_interval):
+            waited += self.poll_interval
+            if not self._alive():
+                raise ReplicaError(f"Replica {self.name} exited with code {self.process.returncode}")
+            if timeout is not None and waited >= timeout:
+                # A late reply would answer the next request, so the worker cannot be reused
+                self.process.kill()
+                self.process.wait(5)
+                raise ReplicaError(f"Replica {self.name} did not answer within {timeout:.0f}s")
+            if control is not None and not cancelled and control.should_stop():
+                self.process.send_signal(signal.SIGUSR1)
+                cancelled = True
+        try:
+            status, value = self.conn.recv()
+        except (EOFError, OSError):
+            raise ReplicaError(f"Replica {self.name} closed its connection")
+        if status == "error":
+            raise RuntimeError(value)
+        return value
+
+    def run(self, task: str, kwargs: Dict[str, Any], control=None) -> Any:
+        payload = dict(kwargs)
+        payload["deadline"] = time.time() + control.remaining() if control is not None else None
+        timeout = control.remaining() + self.stop_grace if control is not None else None
+        while not self.lock.acquire(timeout=self.poll_interval):
+            if self.restarting:
+                raise ReplicaError(f"Replica {self.name} is restarting")
+        try:
+            if timeout is not None:
+                self.busy_until = time.monotonic() + timeout
+            results = self._call(task, payload, control, timeout)
+        finally:
+            self.busy_until = None
+            self.lock.release()
+        if control is not None:
+            # The worker stops on the same deadline; record it on the parent's control too
+            control.should_stop()
+        return results
+
+    def check(self) -> bool:
+        if self.restarting:
+            self.last_error = "Worker is restarting"
+            return False
+        if not self._alive():
+            self.last_error = "Worker process is not running"
+            return False
+        busy_until = self.busy_until
+        if busy_until is not None:
+            if time.monotonic() <= busy_until:
+                return True  # generating within its deadline
+            self.last_error = "Worker has not answered past its request deadline"
+            return False
+        if not self.lock.acquire(blocking=False):
+            return True  # a task is just starting
+        try:
+            self._call("ping", None, timeout=10.0)
+            return True
+        except ReplicaError as e:
+            self.last_error = str(e)
+            return False
+        finally:
+            self.lock.release()
+
+
+# ===============================
+# Pool
+# ===============================
+
+class ReplicaPool:
+    """
+    Routes each task to the healthy replica with the fewest queued tokens
+
+    A replica that fails `max_failures` times in a row is taken out of
+    rotation. Only faults of the replica itself (ReplicaError: dead or
+    unresponsive worker) count; request errors such as a bad input or one
+    oversized prompt running out of memory do not. The last healthy replica
+    is never taken out, so a single-replica pool keeps serving. The
+    health-check thread probes every replica periodically, restarts dead
+    worker processes, and returns replicas that pass the probe to rotation.
+    After a replica fault the task is retried once on another replica.
+    """
+
+    def __init__(self, name: str, replicas: List[ModelReplica], max_failures: int = 3, health_interval: float = 10.0):
+        self.name = name
+        self.replicas = replicas
+        self.max_failures = max_failures
+        self.health_interval = health_interval
+        self.lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self.replicas)
+
+    @contextmanager
+    def _acquire(self, estimated_tokens: int, exclude=None):
+        with self.lock:
+            candidates = [replica for replica in self.replicas if replica.healthy and replica is not exclude]
+            if not candidates:
+                raise ServiceOverloadedError(
+                    f"No healthy {self.name} replicas",
+                    retry_after=max(1, int(self.health_interval))
+                )
+            replica = min(candidates, key=lambda r: (r.queued_tokens, r.in_flight, r.requests))
+            replica.queued_tokens += estimated_tokens
+            replica.in_flight += 1
+            replica.requests += 1
+        try:
+            yield replica
+        finally:
+            with self.lock:
+                replica.queued_tokens -= estimated_tokens
+                replica.in_flight -= 1
+
+    def _record_failure(self, replica: ModelReplica, error: ReplicaError) -> None:
+        with self.lock:
+            replica.failures += 1
+            replica.last_error = str(error)
+            if replica.healthy and replica.failures >= self.max_failures:
+                others = [other for other in self.replicas if other.healthy and other is not replica]
+                if not others:
+                    logger.error(f"Replica {replica.name} keeps failing but is the last healthy one: {error}")
+                    return
+                replica.healthy = False
+                logger.error(f"Replica {replica.name} taken out of rotation: {error}")
+
+    def run(self, task: str, estimated_tokens: int, control=None, **kwargs) -> Any:
+        """Run a task (see TASKS) on the least-loaded healthy replica"""
+        failed = None
+        for attempt in range(2):
+            with self._acquire(estimated_tokens, exclude=failed) as replica:
+                try:
+                    result = replica.run(task, kwargs, control)
+                except ReplicaError as e:
+                    self._record_failure(replica, e)
+                    if attempt == 1 or len(self.replicas) == 1:
+                        raise
+                    logger.warning(f"{e}; retrying on another replica")
+                    failed = replica
+                    continue
+                replica.failures = 0
+                return result
+
+    def run_on(self, replica: ModelReplica, task: str, estimated_tokens: int, control=None, **kwargs) -> Any:
+        """Run a task on one specific replica, e.g. where a chat session's KV cache lives"""
+        if not replica.healthy:
+            raise ServiceOverloadedError(
+                f"Replica {replica.name} is out of rotation",
+                retry_after=max(1, int(self.health_interval))
+            )
+        with self.lock:
+            replica.queued_tokens += estimated_tokens
+            replica.in_flight += 1
+            replica.requests += 1
+        try:
+            return replica.run(task, kwargs, control)
+        except ReplicaError as e:
+            self._record_failure(replica, e)
+            raise
+        finally:
+            with self.lock:
+                replica.queued_tokens -= estimated_tokens
+                replica.in_flight -= 1
+
+    def check_health(self) -> None:
+        for replica in self.replicas:
+            ok = replica.check()
+            if not ok and isinstance(replica, ProcessReplica) and not replica._alive():
+                replica.restart()
+                ok = replica.healthy
+            with self.lock:
+                if ok and not replica.healthy:
+                    logger.info(f"Replica {replica.name} back in rotation")
+                if ok:
+                    replica.failures = 0
+                elif replica.healthy and not any(o.healthy for o in self.replicas if o is not replica):
+                    logger.warning(f"Replica {replica.name} failed its health check but is the last healthy one")
+                    continue
+                replica.healthy = ok
+
+    def start_health_checks(self) -> None:
+        def loop():
+            while True:
+                time.sleep(self.health_interval)
+                try:
+                    self.check_health()
+                except Exception:
+                    logger.exception(f"Health check of {self.name} replicas failed")
+
+        Thread(target=loop, name=f"{self.name}-health", daemon=True).start()
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {
+                "replicas": [replica.get_stats() for replica in self.replicas],
+                "healthy": sum(1 for replica in self.replicas if replica.healthy),
+            }
+
+
+def build_pool(name: str, primary: LocalReplica, devices: List[str], loader: str) -> ReplicaPool:
+    """
+    Pool of the already-loaded primary model plus one replica per extra device
+
+    REPLICA_MODE=process runs extra replicas as worker processes, and
+    REPLICA_MODE=local loads them into this process. Worker processes all
+    load in parallel.
+    """
+    replicas: List[ModelReplica] = [primary]
+    for number, device in enumerate(devices, 1):
+        replica_name = f"{name}-{number}"
+        if config.model.replica_mode == "process":
+            replica = ProcessReplica(replica_name, device, loader)
+            replica.start()
+        else:
+            model, preprocessor = _import_loader(loader)(device)
+            model.eval()
+            replica = LocalReplica(replica_name, device, model, preprocessor)
+        replicas.append(replica)
+    for replica in replicas:
+        if isinstance(replica, ProcessReplica):
+            replica.wait_ready()
+    pool = ReplicaPool(name, replicas, health_interval=config.model.replica_health_interval)
+    pool.start_health_checks()
+    return pool
+
+
+if __name__ == "__main__":
+    # Worker process: python -m replicas <socket address> <module:loader> <device>
+    logging.basicConfig(level=getattr(logging, config.logging.level), format="%(asctime)s [%(levelname)s] %(message)s")
+    _worker_main(*sys.argv[1:4])
@@ -0,0 +1,278 @@
+"""
+Model Residency
+Moves idle models out of accelerator memory and brings them back on demand
+"""
+import os
+import time
+import logging
+from contextlib import contextmanager
+from threading import Lock, Thread
+from typing import Dict, List, Optional
+
+import torch
+
+from config import config
+from static_decode import get_static_decoder
+
+logger = logging.getLogger(__name__)
+
+GB = 1024 ** 3
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _tensors(model) -> List[torch.Tensor]:
+    """Parameters and buffers of a model, each shared tensor once"""
+    return list(model.parameters()) + list(model.buffers())
+
+
+class _Resident:
+    """Bookkeeping for one registered model"""
+
+    def __init__(self, name: str, model, device: torch.device):
+        self.name = name
+        self.model = model
+        self.device = device
+        self.nbytes = sum(tensor.numel() * tensor.element_size() for tensor in _tensors(model))
+        self.resident = True
+        self.users = 0
+        self.last_used = time.monotonic()
+        self.lock = Lock()  # held while swapping and while a user is being admitted
+        self.swap_ins = 0
+        self.offloads = 0
+        self.swap_in_seconds: List[float] = []
+
+
+class ResidencyManager:
+    """
+    LRU residency for models that share one accelerator
+
+    A registered model that has not been used for `idle_seconds` is moved
+    to host memory: pinned RAM (`offload="pinned"`, fastest to bring back)
+    or a memory-mapped file under `offload_dir` (`offload="disk"`, no RAM
+    held while idle). The next use moves it back before generation starts.
+    With `budget_gb` set, bringing a model in first offloads the least
+    recently used idle models until the resident total fits the budget.
+    Models in use are never offloaded.
+    """
+
+    def __init__(
+        self,
+        idle_seconds: float = 300.0,
+        budget_gb: float = 0.0,
+        offload: str = "pinned",
+        offload_dir: str = "/tmp/avito-offload",
+        check_interval: float = 5.0,
+    ):
+        if offload not in ("pinned", "disk"):
+            raise ValueError(f"Unknown offload target: {offload}")
+        self.idle_seconds = idle_seconds
+        self.budget_bytes = int(budget_gb * GB)
+        self.offload = offload
+        self.offload_dir = offload_dir
+        self.check_interval = check_interval
+        self.lock = Lock()
+        self.models: Dict[int, _Resident] = {}
+        self._thread: Optional[Thread] = None
+
+    # -------------------------------
+    # Registration
+    # -------------------------------
+
+    def register(self, name: str, model) -> None:
+        """Put a loaded model under residency management"""
+        entry = _Resident(name, model, model.device)
+        if self.offload == "disk":
+            self._clear_stale_files(name)
+        with self.lock:
+            self.models[id(model)] = entry
+        logger.info(f"Residency: {name} registered ({entry.nbytes / GB:.2f} GB on {entry.device})")
+        if self._thread is None and self.idle_seconds > 0:
+            self._thread = Thread(target=self._idle_loop, name="model-residency", daemon=True)
+            self._thread.start()
+
+    def _offload_path(self, name: str) -> str:
+        # One file per process: each worker writes the weights it actually holds
+        return os.path.join(self.offload_dir, f"{name}-{os.getpid()}.pt")
+
+    def _clear_stale_files(self, name: str) -> None:
+        """Remove offload files of `name` left by exited processes (or an earlier process with this pid)"""
+        try:
+            filenames = os.listdir(self.offload_dir)
+        except FileNotFoundError:
+            return
+        for filename in filenames:
+            pid = filename[len(name) + 1:].split(".")[0]
+            if not filename.startswith(f"{name}-") or not pid.isdigit():
+                continue
+            if int(pid) != os.getpid() and _alive(int(pid)):
+                continue
+            try:
+                os.remove(os.path.join(self.offload_dir, filename))
+                logger.info(f"Residency: removed stale offload file {filename}")
+            except OSError:
+                pass
+
+    # -------------------------------
+    # Swapping
+    # -------------------------------
+
+    def _offload(self, entry: _Resident) -> None:
+        """Move an idle model to host memory (caller holds entry.lock)"""
+        start = time.monotonic()
+        decoder = get_static_decoder(entry.model)
+        if decoder is not None:
+            decoder.release_caches()
+        tensors = _tensors(entry.model)
+        if self.offload == "disk":
+            path = self._offload_path(entry.name)
+            if not os.path.exists(path):
+                # Weights never change while serving, so the file is written once per process;
+                # the rename makes a half-written file impossible to load
+                os.makedirs(self.offload_dir, exist_ok=True)
+                torch.save([tensor.detach().cpu() for tensor in tensors], f"{path}.tmp")
+                os.replace(f"{path}.tmp", path)
+            host = torch.load(path, mmap=True, weights_only=True)
+        else:
+            host = [tensor.detach().to("cpu", copy=True) for tensor in tensors]
+            if torch.cuda.is_available():
+                host = [tensor.pin_memory() for tensor in host]
+        for tensor, copy in zip(tensors, host):
+            tensor.data = copy
+        if entry.device.type == "cuda":
+            torch.cuda.empty_cache()
+        entry.resident = False
+        entry.offloads += 1
+        logger.info(
+            f"Residency: {entry.name} offloaded to {self.offload} "
+            f"({entry.nbytes / GB:.2f} GB, {time.monotonic() - start:.2f}s)"
+        )
+
+    def _swap_in(self, entry: _Resident) -> None:
+        """Move a model back to its device (caller holds entry.lock)"""
+        start = time.monotonic()
+        for tensor in _tensors(entry.model):
+            tensor.data = tensor.data.to(entry.device, non_blocking=True, copy=True)
+        if entry.device.type == "cuda":
+            torch.cuda.synchronize(entry.device)
+        elapsed = time.monotonic() - start
+        entry.resident = True
+        entry.swap_ins += 1
+        entry.swap_in_seconds = (entry.swap_in_seconds + [elapsed])[-100:]
+        logger.info(f"Residency: {entry.name} swapped in ({elapsed:.2f}s)")
+
+    def _resident_bytes(self) -> int:
+        return sum(entry.nbytes for entry in self.models.values() if entry.resident)
+
+    def _make_room(self, incoming: _Resident) -> None:
+        """Offload least recently used idle models until `incoming` fits the budget"""
+        if not self.budget_bytes:
+            return
+        with self.lock:
+            victims = sorted(
+                (entry for entry in self.models.values()
+                 if entry is not incoming and entry.resident and entry.device == incoming.device),
+                key=lambda entry: entry.last_used,
+            )
+        for victim in victims:
+            with self.lock:
+                if self._resident_bytes() + incoming.nbytes <= self.budget_bytes:
+                    return
+            self._try_offload(victim)
+        with self.lock:
+            if self._resident_bytes() + incoming.nbytes > self.budget_bytes:
+                logger.warning(f"Residency: {incoming.name} exceeds the memory budget; the other models are busy")
+
+    def _try_offload(self, entry: _Resident, idle_for: float = 0.0) -> bool:
+        """Offload `entry` unless it is busy, swapping, or used within `idle_for` seconds"""
+        if not entry.lock.acquire(blocking=False):
+            return False
+        try:
+            with self.lock:
+                idle = entry.users == 0 and time.monotonic() - entry.last_used >= idle_for
+            if not entry.resident or not idle:
+                return False
+            self._offload(entry)
+            return True
+        finally:
+            entry.lock.release()
+
+    def _idle_loop(self) -> None:
+        while True:
+            time.sleep(self.check_interval)
+            with self.lock:
+                entries = list(self.models.values())
+            for entry in entries:
+                try:
+                    self._try_offload(entry, idle_for=self.idle_seconds)
+                except Exception:
+                    logger.exception(f"Residency: offloading {entry.name} failed")
+
+    # -------------------------------
+    # Use
+    # -------------------------------
+
+    @contextmanager
+    def use(self, model):
+        """Keep `model` on its device for the duration of the block (no-op if unregistered)"""
+        entry = self.models.get(id(model))
+        if entry is None:
+            yield
+            return
+        with entry.lock:
+            if not entry.resident:
+                self._make_room(entry)
+                self._swap_in(entry)
+            with self.lock:
+                entry.users += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                entry.users -= 1
+                entry.last_used = time.monotonic()
+
+    # -------------------------------
+    # Metrics
+    # -------------------------------
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            models = {}
+            for entry in self.models.values():
+                timings = entry.swap_in_seconds
+                models[entry.name] = {
+                    "resident": entry.resident,
+                    "in_use": entry.users,
+                    "size_gb": round(entry.nbytes / GB, 2),
+                    "idle_seconds": round(time.monotonic() - entry.last_used, 1),
+                    "offloads": entry.offloads,
+                    "swap_ins": entry.swap_ins,
+                    "last_swap_in_seconds": round(timings[-1], 3) if timings else None,
+                    "avg_swap_in_seconds": round(sum(timings) / len(timings), 3) if timings else None,
+                    "max_swap_in_seconds": round(max(timings), 3) if timings else None,
+                }
+            return {
+                "offload": self.offload,
+                "idle_seconds": self.idle_seconds,
+                "budget_gb": round(self.budget_bytes / GB, 2) if self.budget_bytes else None,
+                "resident_gb": round(self._resident_bytes() / GB, 2),
+                "models": models,
+            }
+
+
+# Global manager; models join it only when RESIDENCY_ENABLED is set
+residency_manager = ResidencyManager(
+    idle_seconds=config.model.residency_idle_seconds,
+    budget_gb=config.model.residency_budget_gb,
+    offload=config.model.residency_offload,
+    offload_dir=config.model.residency_offload_dir,
+)
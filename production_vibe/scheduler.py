@@ -0,0 +1,327 @@
+"""
+Inference Scheduling
+Bounded FIFO queue in front of the models with wait estimation and load shedding
+"""
+import math
+import time
+import logging
+from collections import deque
+from contextlib import contextmanager
+from threading import Event, Lock
+from typing import Dict, Optional
+
+from config import config
+from middleware import ServiceOverloadedError
+
+logger = logging.getLogger(__name__)
+
+
+class Ticket:
+    """One admitted unit of work; the caller fills in generated_tokens"""
+
+    def __init__(self, estimated_tokens: int, pool: Optional[str] = None):
+        self.estimated_tokens = estimated_tokens
+        self.pool = pool
+        self.generated_tokens = 0
+        self.queued_at = time.monotonic()
+        self.started_at: Optional[float] = None
+        self.event = Event()
+
+    @property
+    def wait_time(self) -> float:
+        return (self.started_at or time.monotonic()) - self.queued_at
+
+
+class InferenceQueue:
+    """
+    FIFO admission control for the accelerator
+
+    At most `concurrency` tickets run at once and at most `max_depth` wait.
+    A ticket admitted for a replica pool also needs one of that pool's
+    slots (see set_slots), so requests for a model with fewer replicas wait
+    here rather than on a busy replica. The expected wait is the queued
+    token estimate divided by recent decode throughput (EWMA), taken over
+    the whole queue and over the ticket's pool. A request that cannot start
+    before its deadline is rejected right away with 503 + Retry-After
+    instead of holding its connection until the worker times out.
+    """
+
+    def __init__(self, max_depth: int, concurrency: int = 1, initial_tokens_per_sec: float = 50.0, smoothing: float = 0.2):
+        self.max_depth = max_depth
+        self.concurrency = concurrency
+        self.smoothing = smoothing
+        self.lock = Lock()
+        self.waiting: deque = deque()
+        self.running = 0
+        self.running_tokens = 0
+        self.queued_tokens = 0
+        self.tokens_per_sec = initial_tokens_per_sec
+        # Share of max_new_tokens that requests actually use; scales estimates
+        self.fill_ratio = 1.0
+        # Recent time spent waiting for a slot (EWMA over admitted tickets)
+        self.recent_wait = 0.0
+        self.admitted = 0
+        self.shed: Dict[str, int] = {"queue_full": 0, "deadline": 0}
+        # Per replica pool: slots (replicas), running tickets, queued + running token estimates
+        self.slots: Dict[str, int] = {}
+        self.pool_running: Dict[str, int] = {}
+        self.pool_tokens: Dict[str, int] = {}
+
+    def set_slots(self, pool: str, slots: int) -> None:
+        """Let at most `slots` tickets of `pool` run at once (one per replica)"""
+        with self.lock:
+            self.slots[pool] = max(1, slots)
+            self.pool_running.setdefault(pool, 0)
+            self.pool_tokens.setdefault(pool, 0)
+
+    # -------------------------------
+    # Estimates
+    # -------------------------------
+
+    def _expected_tokens(self, estimated_tokens: int) -> float:
+        return estimated_tokens * self.fill_ratio
+
+    def _can_start(self, pool: Optional[str]) -> bool:
+        """Whether a new ticket for `pool` may start without waiting (caller holds the lock)"""
+        if self.running >= self.concurrency:
+            return False
+        if pool in self.slots and self.pool_running[pool] >= self.slots[pool]:
+            return False
+        # With a free slot overall, anything still waiting is held by its own pool's slots
+        return not any(ticket.pool == pool for ticket in self.waiting)
+
+    def _estimated_wait(self, pool: Optional[str] = None) -> float:
+        """Seconds until a newly queued request for `pool` would start (caller holds the lock)"""
+        if self._can_start(pool):
+            return 0.0
+        rate = max(self.tokens_per_sec, 1e-6)
+        wait = self._expected_tokens(self.queued_tokens + self.running_tokens) / rate / self.concurrency
+        if pool in self.slots:
+            wait = max(wait, self._expected_tokens(self.pool_tokens[pool]) / rate / self.slots[pool])
+        return wait
+
+    def estimated_wait(self, pool: Optional[str] = None) -> float:
+        with self.lock:
+            return self._estimated_wait(pool)
+
+    def max_estimated_wait(self) -> float:
+        """Longest expected wait over the whole queue and every pool (caller holds the lock)"""
+        return max([self._estimated_wait()] + [self._estimated_wait(pool) for pool in self.slots])
+
+    def _shed(self, reason: str, retry_after: float, message: str):
+        self.shed[reason] += 1
+        logger.warning(f"Load shed ({reason}): {message}")
+        raise ServiceOverloadedError(message, retry_after=max(1, math.ceil(retry_after)))
+
+    # -------------------------------
+    # Admission
+    # -------------------------------
+
+    @contextmanager
+    def admit(self, estimated_tokens: int, deadline_remaining: Optional[float] = None, pool: Optional[str] = None):
+        """
+        Wait for a slot, or fail fast with ServiceOverloadedError
+
+        estimated_tokens is the request's token budget (max_new_tokens summed
+        over a batch). deadline_remaining is how many seconds the client is
+        still willing to wait for a complete answer. pool names the replica
+        pool that will run the request.
+        """
+        ticket = Ticket(estimated_tokens, pool if pool in self.slots else None)
+        with self.lock:
+            wait = self._estimated_wait(ticket.pool)
+            if wait > 0 and len(self.waiting) >= self.max_depth:
+                self._shed("queue_full", wait, f"Inference queue is full ({self.max_depth} waiting)")
+            if deadline_remaining is not None:
+                own_time = self._expected_tokens(estimated_tokens) / max(self.tokens_per_sec, 1e-6)
+                if wait + own_time > deadline_remaining:
+                    self._shed(
+                        "deadline",
+                        wait,
+                        f"Estimated completion in {wait + own_time:.1f}s exceeds the request deadline"
+                    )
+            if ticket.pool is not None:
+                self.pool_tokens[ticket.pool] += estimated_tokens
+            if self._can_start(ticket.pool):
+                self._start(ticket)
+            else:
+                self.waiting.append(ticket)
+                self.queued_tokens += estimated_tokens
+
+        if not ticket.event.is_set():
+            timeout = None if deadline_remaining is None else max(deadline_remaining, 0.0)
+            if not ticket.event.wait(timeout):
+                with self.lock:
+                    # The slot may have been handed over just as the wait timed out
+                    if not ticket.event.is_set():
+                        self.waiting.remove(ticket)
+                        self.queued_tokens -= estimated_tokens
+                        if ticket.pool is not None:
+                            self.pool_tokens[ticket.pool] -= estimated_tokens
+                        self._shed("deadline", self._estimated_wait(ticket.pool), "Request deadline passed while queued")
+
+        with self.lock:
+            self.admitted += 1
+            self.recent_wait += self.smoothing * (ticket.wait_time - self.recent_wait)
+        try:
+            yield ticket
+        finally:
+            self._finish(ticket)
+
+    def _start(self, ticket: Ticket) -> None:
+        """Mark a ticket as running (caller holds the lock)"""
+        ticket.started_at = time.monotonic()
+        self.running += 1
+        self.running_tokens += ticket.estimated_tokens
+        if ticket.pool is not None:
+            self.pool_running[ticket.pool] += 1
+        ticket.event.set()
+
+    def _finish(self, ticket: Ticket) -> None:
+        elapsed = time.monotonic() - (ticket.started_at or time.monotonic())
+        with self.lock:
+            self.running -= 1
+            self.running_tokens -= ticket.estimated_tokens
+            if ticket.pool is not None:
+                self.pool_running[ticket.pool] -= 1
+                self.pool_tokens[ticket.pool] -= ticket.estimated_tokens
+            if ticket.generated_tokens > 0 and elapsed > 0:
+                rate = ticket.generated_tokens / elapsed
+                self.tokens_per_sec += self.smoothing * (rate - self.tokens_per_sec)
+                if ticket.estimated_tokens > 0:
+                    fill = min(ticket.generated_tokens / ticket.estimated_tokens, 1.0)
+                    self.fill_ratio += self.smoothing * (fill - self.fill_ratio)
+            # FIFO, except that a ticket whose pool is busy lets later tickets of other pools go first
+            for next_ticket in list(self.waiting):
+                if self.running >= self.concurrency:
+                    break
+                pool = next_ticket.pool
+                if pool is not None and self.pool_running[pool] >= self.slots[pool]:
+                    continue
+                self.waiting.remove(next_ticket)
+                self.queued_tokens -= next_ticket.estimated_tokens
+                self._start(next_ticket)
+
+    # -------------------------------
+    # Metrics
+    # -------------------------------
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {
+                "queue_depth": len(self.waiting),
+                "max_queue_depth": self.max_depth,
+                "running": self.running,
+                "queued_tokens": self.queued_tokens,
+                "tokens_per_second": round(self.tokens_per_sec, 2),
+                "estimated_wait_seconds": round(self._estimated_wait(), 3),
+                "pools": {
+                    pool: {
+                        "slots": slots,
+                        "running": self.pool_running[pool],
+                        "waiting": sum(1 for ticket in self.waiting if ticket.pool == pool),
+                        "estimated_wait_seconds": round(self._estimated_wait(pool), 3),
+                    }
+                    for pool, slots in self.slots.items()
+                },
+                "recent_wait_seconds": round(self.recent_wait, 3),
+                "admitted_total": self.admitted,
+                "shed_total": sum(self.shed.values()),
+                "shed_queue_full": self.shed["queue_full"],
+                "shed_deadline": self.shed["deadline"],
+            }
+
+
+class AdaptiveTokenBudget:
+    """
+    Shrinks the default max_new_tokens while the queue is under pressure
+
+    Pressure means the queue holds at least `queue_threshold` requests, or
+    the estimated or recently observed queue wait is over `wait_slo`
+    seconds. Each check under pressure cuts the ratio by `step`, down to
+    `min_ratio`. Once the queue drains below half of both limits, the ratio
+    climbs back by `recover_step`. Checks are at most `interval` seconds
+    apart, so a burst of arrivals does not collapse the budget at once.
+    Only requests that did not pin max_tokens are affected.
+    """
+
+    def __init__(
+        self,
+        queue: InferenceQueue,
+        enabled: bool = True,
+        queue_threshold: int = 8,
+        wait_slo: float = 10.0,
+        min_ratio: float = 0.25,
+        step: float = 0.25,
+        recover_step: float = 0.1,
+        interval: float = 1.0,
+        min_tokens: int = 16,
+    ):
+        self.queue = queue
+        self.enabled = enabled
+        self.queue_threshold = queue_threshold
+        self.wait_slo = wait_slo
+        self.min_ratio = min_ratio
+        self.step = step
+        self.recover_step = recover_step
+        self.interval = interval
+        self.min_tokens = min_tokens
+        self.lock = Lock()
+        self.ratio = 1.0
+        self._next_check = 0.0
+        self.degraded_requests = 0
+
+    def _update(self) -> None:
+        now = time.monotonic()
+        if now < self._next_check:
+            return
+        self._next_check = now + self.interval
+        with self.queue.lock:
+            depth = len(self.queue.waiting)
+            wait = max(self.queue.max_estimated_wait(), self.queue.recent_wait)
+        if depth >= self.queue_threshold or wait > self.wait_slo:
+            ratio = max(self.min_ratio, self.ratio - self.step)
+        elif depth <= self.queue_threshold / 2 and wait <= self.wait_slo / 2:
+            ratio = min(1.0, self.ratio + self.recover_step)
+        else:
+            ratio = self.ratio
+        if ratio != self.ratio:
+            logger.warning(
+                f"Token budget ratio {self.ratio:.2f} -> {ratio:.2f} "
+                f"(queue_depth={depth}, wait={wait:.1f}s)"
+            )
+            self.ratio = ratio
+
+    def apply(self, default_tokens: int) -> int:
+        """Effective max_new_tokens for a request that left max_tokens unset"""
+        if not self.enabled:
+            return default_tokens
+        with self.lock:
+            self._update()
+            if self.ratio >= 1.0:
+                return default_tokens
+            self.degraded_requests += 1
+            return min(default_tokens, max(self.min_tokens, int(default_tokens * self.ratio)))
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {
+                "enabled": self.enabled,
+                "ratio": round(self.ratio, 2),
+                "degraded_requests": self.degraded_requests,
+            }
+
+
+# Global queue shared by all inference routes (one accelerator per process)
+inference_queue = InferenceQueue(
+    max_depth=config.server.inference_queue_depth,
+    concurrency=config.server.inference_concurrency,
+)
+
+token_budget = AdaptiveTokenBudget(
+    inference_queue,
+    enabled=config.server.adaptive_tokens,
+    queue_threshold=config.server.degrade_queue_depth,
+    wait_slo=config.server.degrade_wait_slo,
+    min_ratio=config.server.degrade_min_ratio,
+)
@@ -0,0 +1,291 @@
+"""
+Chat Sessions
+Multi-turn conversations that keep their KV cache on the server between turns
+"""
+import time
+import uuid
+import logging
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Dict, List, Optional
+
+import torch
+from transformers import DynamicCache
+
+from config import config
+from middleware import NotFoundError, ValidationError
+
+logger = logging.getLogger(__name__)
+
+
+class ChatSession:
+    """
+    One conversation: its messages plus the KV cache of the tokens seen so far
+
+    `cached_ids` are the token ids whose keys/values are in `cache`. A new
+    turn reuses the longest prefix of them that the re-rendered chat
+    template still starts with, so only the new message is prefilled.
+    """
+
+    def __init__(self, system: Optional[str] = None):
+        self.id = uuid.uuid4().hex
+        self.messages: List[Dict[str, str]] = []
+        if system:
+            self.messages.append({"role": "system", "content": system})
+        self.cached_ids: List[int] = []
+        self.cache: Optional[DynamicCache] = None
+        self.nbytes = 0
+        self.turns = 0
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+        self.lock = Lock()  # one turn at a time
+
+    def drop_cache(self) -> None:
+        self.cache = None
+        self.cached_ids = []
+        self.nbytes = 0
+
+
+def _cache_bytes(cache: Optional[DynamicCache]) -> int:
+    if cache is None:
+        return 0
+    total = 0
+    for layer in cache.layers:
+        for tensor in (getattr(layer, "keys", None), getattr(layer, "values", None)):
+            if tensor is not None:
+                total += tensor.numel() * tensor.element_size()
+    return total
+
+
+def _render(tokenizer, messages: List[Dict[str, str]]) -> List[int]:
+    text = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+    return tokenizer(text)["input_ids"]
+
+
+def _common_prefix(a: List[int], b: List[int]) -> int:
+    length = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        length += 1
+    return length
+
+
+def generate_chat_turn(
+    model,
+    tokenizer,
+    session: ChatSession,
+    message: str,
+    max_tokens: int,
+    temperature: float,
+    top_p: float,
+    repetition_penalty: float,
+    stopping_criteria=None,
+) -> Dict[str, Any]:
+    """
+    Add a user message to the session and generate the assistant's answer
+
+    The cache is cropped to the prefix shared with the new prompt (at least
+    one token is always left to prefill), then generate() continues from it.
+    A turn cut short by the stopping criteria (deadline, disconnect) is not
+    added to the history, the cache goes back to the prefix it had, and the
+    result has "stopped" set.
+    When history, message and max_tokens exceed the session's context limit,
+    the oldest exchanges are dropped (the system prompt stays).
+    Returns a result shaped like generate_text_batch's items.
+    """
+    messages = session.messages + [{"role": "user", "content": message}]
+    input_ids = _render(tokenizer, messages)
+
+    limit = config.sessions.max_context_tokens
+    first = 1 if messages[0]["role"] == "system" else 0
+    trimmed = 0
+    while len(input_ids) + max_tokens > limit and len(messages) > first + 1:
+        del messages[first:first + 2]
+        trimmed += 2
+        input_ids = _render(tokenizer, messages)
+    if len(input_ids) + max_tokens > limit:
+        raise ValidationError(
+            f"Message and max_tokens need {len(input_ids) + max_tokens} tokens, "
+            f"but a chat session holds at most {limit}"
+        )
+    if trimmed:
+        logger.info(f"Chat session {session.id}: dropped {trimmed} oldest messages to fit {limit} tokens")
+
+    reused = 0
+    if session.cache is not None:
+        reused = min(_common_prefix(session.cached_ids, input_ids), len(input_ids) - 1)
+        if reused == 0:
+            session.drop_cache()
+        elif reused < session.cache.get_seq_length():
+            session.cache.crop(reused - session.cache.get_seq_length())
+    cache = session.cache if session.cache is not None else DynamicCache()
+
+    pad_token_id = tokenizer.pad_token_id
+    if pad_token_id is None:
+        pad_token_id = tokenizer.eos_token_id
+    ids = torch.tensor([input_ids], dtype=torch.long, device=model.device)
+
+    gen_start = time.time()
+    try:
+        generated_ids = model.generate(
+            input_ids=ids,
+            attention_mask=torch.ones_like(ids),
+            past_key_values=cache,
+            pad_token_id=pad_token_id,
+            max_new_tokens=max_tokens,
+            do_sample=temperature > 0,
+            temperature=temperature if temperature > 0 else None,
+            top_p=top_p,
+            repetition_penalty=repetition_penalty,
+            use_cache=True,
+            stopping_criteria=stopping_criteria,
+        )
+    except Exception:
+        # A half-written cache cannot be trusted for the next turn
+        session.drop_cache()
+        raise
+    gen_time = time.time() - gen_start
+
+    sequence = generated_ids[0].tolist()
+    tokens = sequence[len(input_ids):]
+    if tokenizer.eos_token_id is not None and tokenizer.eos_token_id in tokens:
+        tokens = tokens[:tokens.index(tokenizer.eos_token_id) + 1]
+    answer = tokenizer.decode(tokens, skip_special_tokens=True)
+
+    # Neither EOS nor max_tokens ended the answer, so the stopping criteria did. Decided from
+    # the output: calling the criteria again would re-check the deadline after the fact
+    stopped = tokens[-1:] != [tokenizer.eos_token_id] and len(tokens) < max_tokens
+    if stopped:
+        # A partial answer must not become history the next turn builds on
+        if reused:
+            cache.crop(reused - cache.get_seq_length())
+            session.cache = cache
+            session.cached_ids = input_ids[:reused]
+            session.nbytes = _cache_bytes(cache)
+        else:
+            session.drop_cache()
+    else:
+        session.messages = messages + [{"role": "assistant", "content": answer}]
+        session.cache = cache
+        session.cached_ids = sequence[:cache.get_seq_length()]
+        session.nbytes = _cache_bytes(cache)
+        session.turns += 1
+
+    return {
+        "index": 0,
+        "success": True,
+        "stopped": stopped,
+        "data": {
+            "text": answer,
+            "generated_tokens": len(tokens),
+            "input_tokens": len(input_ids),
+        },
+        "metrics": {
+            "cached_tokens": reused,
+            "prefill_tokens": len(input_ids) - reused,
+            "generation_time": round(gen_time, 3),
+            "tokens_per_second": round(len(tokens) / gen_time, 2) if gen_time > 0 else 0.0,
+        },
+    }
+
+
+class SessionStore:
+    """
+    Live chat sessions with an idle TTL and a cap on total KV cache memory
+
+    Sessions idle for longer than `ttl` seconds are removed. When the caches
+    together exceed `max_cache_bytes`, the least recently used sessions lose
+    their cache (not their history), so their next turn prefills in full.
+    """
+
+    def __init__(self, ttl: float = 900.0, max_cache_bytes: int = 2 * 1024 ** 3, max_sessions: int = 1000):
+        self.ttl = ttl
+        self.max_cache_bytes = max_cache_bytes
+        self.max_sessions = max_sessions
+        self.lock = Lock()
+        self.sessions: "OrderedDict[str, ChatSession]" = OrderedDict()
+        self.created = 0
+        self.expired = 0
+        self.cache_evictions = 0
+        self.cached_tokens = 0
+        self.prefill_tokens = 0
+
+    def _expire(self) -> None:
+        """Drop sessions past their TTL (caller holds the lock)"""
+        cutoff = time.monotonic() - self.ttl
+        while self.sessions:
+            session = next(iter(self.sessions.values()))
+            if session.last_used > cutoff:
+                break
+            self.sessions.popitem(last=False)
+            self.expired += 1
+
+    def create(self, system: Optional[str] = None) -> ChatSession:
+        session = ChatSession(system)
+        with self.lock:
+            self._expire()
+            while len(self.sessions) >= self.max_sessions:
+                self.sessions.popitem(last=False)
+                self.expired += 1
+            self.sessions[session.id] = session
+            self.created += 1
+        return session
+
+    def get(self, session_id: str) -> ChatSession:
+        with self.lock:
+            self._expire()
+            session = self.sessions.get(session_id)
+            if session is None:
+                raise NotFoundError(f"Chat session {session_id} does not exist or has expired")
+            session.last_used = time.monotonic()
+            self.sessions.move_to_end(session_id)
+            return session
+
+    def delete(self, session_id: str) -> None:
+        with self.lock:
+            if self.sessions.pop(session_id, None) is None:
+                raise NotFoundError(f"Chat session {session_id} does not exist or has expired")
+
+    def record_turn(self, session: ChatSession, result: Dict[str, Any]) -> None:
+        """Account for a finished turn and enforce the memory cap"""
+        with self.lock:
+            session.last_used = time.monotonic()
+            self.cached_tokens += result["metrics"]["cached_tokens"]
+            self.prefill_tokens += result["metrics"]["prefill_tokens"]
+            total = sum(other.nbytes for other in self.sessions.values())
+            for other in list(self.sessions.values()):
+                if total <= self.max_cache_bytes:
+                    break
+                # Oldest first; the session that just answered goes last
+                if other is session or other.cache is None or other.lock.locked():
+                    continue
+                total -= other.nbytes
+                other.drop_cache()
+                self.cache_evictions += 1
+            if total > self.max_cache_bytes and session.cache is not None:
+                session.drop_cache()
+                self.cache_evictions += 1
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            self._expire()
+            return {
+                "sessions": len(self.sessions),
+                "cached_sessions": sum(1 for session in self.sessions.values() if session.cache is not None),
+                "cache_mb": round(sum(session.nbytes for session in self.sessions.values()) / 1024 ** 2, 1),
+                "max_cache_mb": round(self.max_cache_bytes / 1024 ** 2, 1),
+                "created_total": self.created,
+                "expired_total": self.expired,
+                "cache_evictions": self.cache_evictions,
+                "cached_tokens_total": self.cached_tokens,
+                "prefill_tokens_total": self.prefill_tokens,
+            }
+
+
+# Global store for the chat API
+session_store = SessionStore(
+    ttl=config.sessions.ttl,
+    max_cache_bytes=config.sessions.max_cache_mb * 1024 ** 2,
+    max_sessions=config.sessions.max_sessions,
+)
@@ -0,0 +1,290 @@
+"""
+Speculative Decoding
+A small draft model proposes tokens that Avibe verifies in one forward pass
+"""
+import logging
+from collections import deque
+from threading import Lock, get_ident
+from typing import Any, Dict, Optional, Tuple
+
+import torch
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+# Per-request "decoding" values: "auto" uses the draft model when one is configured
+DECODING_MODES = ("auto", "prompt_lookup")
+
+
+class _ForwardCounter:
+    """Counts forward passes of a module made by the current thread while active"""
+
+    def __init__(self, module):
+        self.module = module
+        self.calls = 0
+        self.thread = get_ident()
+        self.handle = None
+
+    def _hook(self, module, args, output):
+        if get_ident() == self.thread:
+            self.calls += 1
+
+    def __enter__(self):
+        self.handle = self.module.register_forward_hook(self._hook)
+        return self
+
+    def __exit__(self, *exc):
+        self.handle.remove()
+
+
+class SpeculativeDecoder:
+    """
+    Assisted generation for single Avibe requests
+
+    The draft model proposes up to `num_draft_tokens` tokens greedily or by
+    sampling. Avibe scores all of them in one forward pass and keeps the
+    longest prefix it agrees with, plus one token of its own. The output
+    is what Avibe alone would produce (exactly for greedy decoding, in
+    distribution for sampling). Only batch size 1 is supported, so padded
+    batches keep using the regular path.
+
+    Acceptance is the share of proposed tokens Avibe kept. It is reported
+    per request and in aggregate. When the average over the last `window`
+    speculative requests falls below `min_acceptance`, the draft costs more
+    than it saves. The next `cooldown` requests then decode without it.
+    """
+
+    def __init__(
+        self,
+        model,
+        draft,
+        draft_name: str,
+        num_draft_tokens: int = 5,
+        min_acceptance: float = 0.35,
+        window: int = 20,
+        cooldown: int = 50,
+    ):
+        self.model = model
+        self.draft = draft
+        self.draft_name = draft_name
+        self.min_acceptance = min_acceptance
+        self.cooldown = cooldown
+        self.draft.generation_config.num_assistant_tokens = num_draft_tokens
+        self.draft.generation_config.num_assistant_tokens_schedule = "constant"
+        # Rejection sampling compares both distributions token by token, which needs equal vocab sizes
+        self.sampling_supported = draft.config.vocab_size == model.config.vocab_size
+        self.recent = deque(maxlen=window)
+        self.lock = Lock()
+        self.fallback_remaining = 0
+        self.fallbacks = 0
+        self.speculative_requests = 0
+        self.plain_requests = 0
+        self.draft_tokens = 0
+        self.accepted_tokens = 0
+        self.generated_tokens = 0
+        self.verify_passes = 0
+
+    def accepts(self, batch_size: int, do_sample: bool) -> bool:
+        """Whether this call should use the draft (consumes one cooldown slot if not)"""
+        if batch_size != 1 or (do_sample and not self.sampling_supported):
+            return False
+        with self.lock:
+            if self.fallback_remaining > 0:
+                self.fallback_remaining -= 1
+                self.plain_requests += 1
+                return False
+        return True
+
+    def generate(
+        self,
+        input_ids: torch.LongTensor,
+        attention_mask: torch.LongTensor,
+        pad_token_id: int,
+        max_new_tokens: int,
+        **generate_kwargs
+    ) -> Tuple[torch.LongTensor, int, Dict[str, Any]]:
+        """generate() with the draft model; returns (sequences, prompt width, acceptance stats)"""
+        with _ForwardCounter(self.model) as verify, _ForwardCounter(self.draft) as drafted:
+            generated_ids = self.model.generate(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                assistant_model=self.draft,
+                pad_token_id=pad_token_id,
+                max_new_tokens=max_new_tokens,
+                **generate_kwargs
+            )
+        prompt_len = input_ids.shape[1]
+        new_tokens = generated_ids.shape[1] - prompt_len
+        # Every verification pass yields the accepted draft tokens plus one token of Avibe's own
+        accepted = max(new_tokens - verify.calls, 0)
+        acceptance = min(accepted / drafted.calls, 1.0) if drafted.calls else 0.0
+        stats = {
+            "mode": "draft_model",
+            "draft_tokens": drafted.calls,
+            "accepted_tokens": accepted,
+            "acceptance_rate": round(acceptance, 3),
+            "verify_passes": verify.calls,
+            "tokens_per_pass": round(new_tokens / verify.calls, 2) if verify.calls else 0.0,
+        }
+        self._record(drafted.calls, accepted, new_tokens, verify.calls, acceptance)
+        return generated_ids, prompt_len, stats
+
+    def _record(self, drafted: int, accepted: int, generated: int, passes: int, acceptance: float) -> None:
+        with self.lock:
+            self.speculative_requests += 1
+            self.draft_tokens += drafted
+            self.accepted_tokens += accepted
+            self.generated_tokens += generated
+            self.verify_passes += passes
+            if drafted:
+                self.recent.append(acceptance)
+            if len(self.recent) == self.recent.maxlen:
+                average = sum(self.recent) / len(self.recent)
+                if average < self.min_acceptance:
+                    self.fallback_remaining = self.cooldown
+                    self.fallbacks += 1
+                    self.recent.clear()
+                    logger.warning(
+                        f"Speculative decoding paused for {self.cooldown} requests: "
+                        f"acceptance {average:.2f} < {self.min_acceptance:.2f}"
+                    )
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {
+                "draft_model": self.draft_name,
+                "speculative_requests": self.speculative_requests,
+                "plain_requests": self.plain_requests,
+                "draft_tokens": self.draft_tokens,
+                "accepted_tokens": self.accepted_tokens,
+                "acceptance_rate": round(self.accepted_tokens / self.draft_tokens, 3) if self.draft_tokens else 0.0,
+                "recent_acceptance_rate": round(sum(self.recent) / len(self.recent), 3) if self.recent else None,
+                "tokens_per_pass": round(self.generated_tokens / self.verify_passes, 2) if self.verify_passes else 0.0,
+                "fallback_active": self.fallback_remaining > 0,
+                "fallbacks": self.fallbacks,
+                "sampling_supported": self.sampling_supported,
+            }
+
+
+class PromptLookupDecoder:
+    """
+    Draft-free speculation for answers that copy from their prompt
+
+    At every step the last `max_ngram` tokens (falling back to shorter
+    n-grams) are looked up in the prompt and the text generated so far.
+    Up to `num_tokens` tokens that followed the match are proposed and
+    verified in one forward pass, like draft tokens. Rewrites and field
+    extraction copy long spans, so several tokens land per pass. A step
+    with no match costs the same as plain decoding. Batch size 1 only.
+    """
+
+    def __init__(self, num_tokens: int = 10, max_ngram: int = 2):
+        self.num_tokens = num_tokens
+        self.max_ngram = max_ngram
+        self.lock = Lock()
+        self.requests = 0
+        self.generated_tokens = 0
+        self.copied_tokens = 0
+        self.verify_passes = 0
+
+    def generate(
+        self,
+        model,
+        input_ids: torch.LongTensor,
+        attention_mask: torch.LongTensor,
+        pad_token_id: int,
+        max_new_tokens: int,
+        **generate_kwargs
+    ) -> Tuple[torch.LongTensor, int, Dict[str, Any]]:
+        """generate() with prompt lookup; returns (sequences, prompt width, copy stats)"""
+        with _ForwardCounter(model) as verify:
+            generated_ids = model.generate(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                prompt_lookup_num_tokens=self.num_tokens,
+                max_matching_ngram_size=self.max_ngram,
+                pad_token_id=pad_token_id,
+                max_new_tokens=max_new_tokens,
+                **generate_kwargs
+            )
+        prompt_len = input_ids.shape[1]
+        new_tokens = generated_ids.shape[1] - prompt_len
+        copied = max(new_tokens - verify.calls, 0)
+        with self.lock:
+            self.requests += 1
+            self.generated_tokens += new_tokens
+            self.copied_tokens += copied
+            self.verify_passes += verify.calls
+        stats = {
+            "mode": "prompt_lookup",
+            "copied_tokens": copied,
+            "verify_passes": verify.calls,
+            "tokens_per_pass": round(new_tokens / verify.calls, 2) if verify.calls else 0.0,
+        }
+        return generated_ids, prompt_len, stats
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "generated_tokens": self.generated_tokens,
+                "copied_tokens": self.copied_tokens,
+                "tokens_per_pass": round(self.generated_tokens / self.verify_passes, 2) if self.verify_passes else 0.0,
+            }
+
+
+def load_draft_model(path: str, tokenizer, device, dtype):
+    """Load a draft model and check that it tokenizes exactly like the target"""
+    from transformers import AutoTokenizer, AutoModelForCausalLM
+
+    draft_tokenizer = AutoTokenizer.from_pretrained(path, local_files_only=True)
+    if draft_tokenizer.get_vocab() != tokenizer.get_vocab():
+        raise ValueError(f"draft model {path} does not share Avibe's tokenizer")
+    draft = AutoModelForCausalLM.from_pretrained(
+        path,
+        torch_dtype=dtype,
+        device_map=str(device),
+        local_files_only=True,
+        low_cpu_mem_usage=True,
+    )
+    draft.eval()
+    return draft
+
+
+# Registered decoders by model object id (only models with a draft model)
+_decoders: Dict[int, SpeculativeDecoder] = {}
+
+
+def enable_speculative_decode(model, tokenizer) -> Optional[SpeculativeDecoder]:
+    """Attach the configured draft model to a causal LM; None if it cannot be used"""
+    path = config.model.speculative_draft_model
+    try:
+        draft = load_draft_model(path, tokenizer, model.device, model.dtype)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Speculative decoding disabled: {e}")
+        return None
+    decoder = SpeculativeDecoder(
+        model,
+        draft,
+        draft_name=path,
+        num_draft_tokens=config.model.speculative_draft_tokens,
+        min_acceptance=config.model.speculative_min_acceptance,
+        window=config.model.speculative_window,
+        cooldown=config.model.speculative_cooldown,
+    )
+    if not decoder.sampling_supported:
+        logger.warning("Draft and Avibe vocab sizes differ: speculative decoding only for temperature=0")
+    _decoders[id(model)] = decoder
+    return decoder
+
+
+def get_speculative_decoder(model) -> Optional[SpeculativeDecoder]:
+    return _decoders.get(id(model))
+
+
+# Global prompt-lookup decoder (no model of its own, so one serves every replica)
+prompt_lookup = PromptLookupDecoder(
+    num_tokens=config.model.prompt_lookup_tokens,
+    max_ngram=config.model.prompt_lookup_max_ngram,
+)
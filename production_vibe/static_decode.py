@@ -0,0 +1,210 @@
+"""
+Static-Shape Decoding
+Preallocated KV caches and a compiled per-token forward for Avibe
+"""
+import time
+import logging
+from threading import Lock
+from typing import Dict, List, Optional, Tuple
+
+import torch
+from transformers import StaticCache, CompileConfig
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+
+def bucket_for(value: int, buckets: List[int]) -> Optional[int]:
+    """Smallest bucket that fits `value`, or None if it exceeds them all"""
+    for bucket in sorted(buckets):
+        if value <= bucket:
+            return bucket
+    return None
+
+
+class StaticDecoder:
+    """
+    Runs generate() on fixed shapes so the decode step can be compiled once
+
+    Prompts are left-padded to the next prompt-length bucket, and the batch
+    is filled up to the next batch-size bucket with copies of its first row
+    (dropped from the output). Each batch bucket owns one StaticCache sized
+    for the largest prompt bucket plus `max_new_tokens`. The cache is reset
+    between calls, never reallocated, so the compiled decode forward (CUDA
+    graphs with mode="reduce-overhead") is captured once per batch bucket.
+    Requests outside the buckets fall back to eager generate().
+    """
+
+    def __init__(
+        self,
+        model,
+        prompt_buckets: List[int],
+        batch_buckets: List[int],
+        max_new_tokens: int,
+        compile_mode: str = "reduce-overhead",
+    ):
+        self.model = model
+        self.prompt_buckets = sorted(prompt_buckets)
+        self.batch_buckets = sorted(batch_buckets)
+        self.max_new_tokens = max_new_tokens
+        self.max_cache_len = self.prompt_buckets[-1] + max_new_tokens
+        self.compile_config = CompileConfig(fullgraph=False, dynamic=False, mode=compile_mode)
+        if model.device.type == "cpu":
+            # transformers only auto-compiles on accelerators unless told otherwise
+            self.compile_config._compile_all_devices = True
+        self.caches: Dict[int, StaticCache] = {}
+        self.lock = Lock()
+        self.static_calls = 0
+        self.eager_calls = 0
+        self.padded_rows = 0
+
+    def _cache(self, batch_size: int) -> StaticCache:
+        cache = self.caches.get(batch_size)
+        if cache is None:
+            cache = StaticCache(
+                config=self.model.config,
+                max_batch_size=batch_size,
+                max_cache_len=self.max_cache_len,
+                device=self.model.device,
+                dtype=self.model.dtype,
+            )
+            self.caches[batch_size] = cache
+            logger.info(f"Allocated static KV cache: batch={batch_size}, length={self.max_cache_len}")
+        return cache
+
+    def shape_for(self, batch_size: int, prompt_len: int, max_new_tokens: int) -> Optional[Tuple[int, int]]:
+        """(batch bucket, prompt bucket) for a request, or None if it must run eagerly"""
+        if max_new_tokens > self.max_new_tokens:
+            return None
+        rows = bucket_for(batch_size, self.batch_buckets)
+        width = bucket_for(prompt_len, self.prompt_buckets)
+        if rows is None or width is None:
+            return None
+        return rows, width
+
+    def generate(
+        self,
+        input_ids: torch.LongTensor,
+        attention_mask: torch.LongTensor,
+        pad_token_id: int,
+        max_new_tokens: int,
+        **generate_kwargs
+    ) -> Tuple[torch.LongTensor, int]:
+        """
+        generate() for left-padded inputs; returns (sequences, prompt width)
+        Generated tokens start at the returned prompt width in every row
+        """
+        batch_size, prompt_len = input_ids.shape
+        shape = self.shape_for(batch_size, prompt_len, max_new_tokens)
+        if shape is None:
+            self.eager_calls += 1
+            generated_ids = self.model.generate(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                pad_token_id=pad_token_id,
+                max_new_tokens=max_new_tokens,
+                **generate_kwargs
+            )
+            return generated_ids, prompt_len
+
+        rows, width = shape
+        padded_ids = torch.full((rows, width), pad_token_id, dtype=input_ids.dtype, device=input_ids.device)
+        padded_mask = torch.zeros((rows, width), dtype=attention_mask.dtype, device=attention_mask.device)
+        padded_ids[:batch_size, width - prompt_len:] = input_ids
+        padded_mask[:batch_size, width - prompt_len:] = attention_mask
+        # Filler rows repeat a real prompt: an all-padding row would attend to nothing
+        padded_ids[batch_size:] = padded_ids[0]
+        padded_mask[batch_size:] = padded_mask[0]
+
+        with self.lock:
+            cache = self._cache(rows)
+            cache.reset()
+            generated_ids = self.model.generate(
+                input_ids=padded_ids,
+                attention_mask=padded_mask,
+                past_key_values=cache,
+                compile_config=self.compile_config,
+                pad_token_id=pad_token_id,
+                max_new_tokens=max_new_tokens,
+                **generate_kwargs
+            )
+            self.static_calls += 1
+            self.padded_rows += rows - batch_size
+        return generated_ids[:batch_size], width
+
+    def warmup(self, pad_token_id: int) -> List[dict]:
+        """
+        Compile and capture the decode step for every batch bucket ahead of traffic
+        Prefill runs eagerly, so one prompt bucket per batch bucket is enough
+        """
+        timings = []
+        for rows in self.batch_buckets:
+            start = time.time()
+            ids = torch.full((rows, self.prompt_buckets[0]), pad_token_id, dtype=torch.long, device=self.model.device)
+            with torch.inference_mode():
+                self.generate(ids, torch.ones_like(ids), pad_token_id, max_new_tokens=2, do_sample=False)
+            elapsed = time.time() - start
+            timings.append({"batch_size": rows, "seconds": round(elapsed, 3)})
+            logger.info(f"Static decode bucket ready: batch={rows}, {elapsed:.2f}s")
+        return timings
+
+    def release_caches(self) -> None:
+        """Free the preallocated caches (reallocated on the next static call)"""
+        with self.lock:
+            self.caches.clear()
+
+    def get_stats(self) -> dict:
+        return {
+            "static_calls": self.static_calls,
+            "eager_calls": self.eager_calls,
+            "padded_rows": self.padded_rows,
+            "cache_buckets": sorted(self.caches),
+            "max_cache_len": self.max_cache_len,
+        }
+
+
+# Registered decoders by model object id (only models with static decoding enabled)
+_decoders: Dict[int, StaticDecoder] = {}
+
+
+def enable_static_decode(model) -> StaticDecoder:
+    """Switch a causal LM to static-shape decoding with the configured buckets"""
+    decoder = StaticDecoder(
+        model,
+        prompt_buckets=config.model.static_prompt_buckets,
+        batch_buckets=config.model.static_batch_buckets,
+        max_new_tokens=config.model.static_max_new_tokens,
+        compile_mode=config.model.static_compile_mode,
+    )
+    _decoders[id(model)] = decoder
+    return decoder
+
+
+def get_static_decoder(model) -> Optional[StaticDecoder]:
+    return _decoders.get(id(model))
+
+
+def generate_padded(
+    model,
+    input_ids: torch.LongTensor,
+    attention_mask: torch.LongTensor,
+    pad_token_id: int,
+    max_new_tokens: int,
+    **generate_kwargs
+) -> Tuple[torch.LongTensor, int]:
+    """
+    generate() through the static decoder when the model has one, eagerly otherwise
+    Returns (sequences, prompt width); generated tokens start at the prompt width
+    """
+    decoder = get_static_decoder(model)
+    if decoder is not None:
+        return decoder.generate(input_ids, attention_mask, pad_token_id, max_new_tokens, **generate_kwargs)
+    generated_ids = model.generate(
+        input_ids=input_ids,
+        attention_mask=attention_mask,
+        pad_token_id=pad_token_id,
+        max_new_tokens=max_new_tokens,
+        **generate_kwargs
+    )
+    return generated_ids, input_ids.shape[1]
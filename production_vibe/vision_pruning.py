@@ -0,0 +1,177 @@
+"""
+Vision Token Pruning
+Drops redundant image-patch embeddings before they reach Avision's language model
+"""
+import math
+import logging
+from threading import Lock
+from typing import Dict, List, Optional, Tuple
+
+import torch
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+
+def redundancy_scores(features: torch.Tensor, grid: Tuple[int, int, int]) -> torch.Tensor:
+    """
+    Mean cosine similarity of every image token to its neighbours on the merged patch grid
+
+    Tokens inside flat regions (studio background, sky, a plain wall)
+    score close to 1. Object edges and details score lower.
+    """
+    frames, height, width = grid
+    x = torch.nn.functional.normalize(features.float(), dim=-1).view(frames, height, width, -1)
+    total = torch.zeros(frames, height, width, device=x.device)
+    count = torch.zeros(frames, height, width, device=x.device)
+    right = (x[:, :, :-1] * x[:, :, 1:]).sum(-1)
+    down = (x[:, :-1] * x[:, 1:]).sum(-1)
+    total[:, :, :-1] += right
+    total[:, :, 1:] += right
+    total[:, :-1] += down
+    total[:, 1:] += down
+    count[:, :, :-1] += 1
+    count[:, :, 1:] += 1
+    count[:, :-1] += 1
+    count[:, 1:] += 1
+    return (total / count.clamp(min=1)).flatten()
+
+
+class VisionTokenPruner:
+    """
+    Avision generate() that prefills only the informative image tokens
+
+    The vision encoder runs as usual. Before the language model, each
+    image keeps the `keep_ratio` share of its tokens that are least like
+    their neighbours, but at least `min_tokens`, so small images are left
+    alone. Kept tokens keep their original 3D rotary positions, so the
+    model still knows where on the photo each one came from. Prefill work
+    and KV cache shrink with the dropped tokens.
+
+    Needs a Qwen2-VL style model (get_image_features, get_rope_index and
+    an image token id in its config).
+    """
+
+    def __init__(self, model, keep_ratio: float, min_tokens: int = 64):
+        self.model = model
+        self.keep_ratio = keep_ratio
+        self.min_tokens = min_tokens
+        self.image_token_id = model.config.image_token_id
+        self.merge_size = model.config.vision_config.spatial_merge_size
+        self.lock = Lock()
+        self.requests = 0
+        self.vision_tokens = 0
+        self.kept_tokens = 0
+
+    @staticmethod
+    def supports(model) -> bool:
+        return (
+            hasattr(model, "get_image_features")
+            and hasattr(getattr(model, "model", None), "get_rope_index")
+            and getattr(model.config, "image_token_id", None) is not None
+        )
+
+    def select(self, features: torch.Tensor, grid: Tuple[int, int, int]) -> torch.Tensor:
+        """Indices (ascending) of one image's tokens to keep"""
+        count = features.shape[0]
+        keep = min(count, max(self.min_tokens, math.ceil(count * self.keep_ratio)))
+        if keep == count:
+            return torch.arange(count, device=features.device)
+        scores = redundancy_scores(features, grid)
+        return scores.topk(keep, largest=False).indices.sort().values
+
+    @torch.inference_mode()
+    def generate(self, inputs, **generate_kwargs) -> Tuple[torch.LongTensor, int, List[int]]:
+        """generate() on pruned embeddings; returns (new tokens, prompt width 0, kept image tokens per row)"""
+        model = self.model
+        input_ids = inputs["input_ids"]
+        attention_mask = inputs["attention_mask"]
+        image_grid_thw = inputs["image_grid_thw"]
+
+        features = model.get_image_features(inputs["pixel_values"], image_grid_thw)
+        features = getattr(features, "pooler_output", features)
+        rope_kwargs = {"mm_token_type_ids": inputs["mm_token_type_ids"]} if "mm_token_type_ids" in inputs else {}
+        position_ids, _ = model.model.get_rope_index(
+            input_ids, image_grid_thw=image_grid_thw, attention_mask=attention_mask, **rope_kwargs
+        )
+
+        embeds = model.get_input_embeddings()(input_ids)
+        image_mask = input_ids == self.image_token_id
+        embeds[image_mask] = torch.cat(features).to(embeds.device, embeds.dtype)
+
+        # Images appear in batch order, each as one run of image tokens in its row
+        keep = attention_mask.bool().clone()
+        kept_per_row, image_index = [], 0
+        for row in range(input_ids.shape[0]):
+            positions = image_mask[row].nonzero().squeeze(1)
+            kept, start = 0, 0
+            while start < len(positions):
+                frames, height, width = image_grid_thw[image_index].tolist()
+                grid = (frames, height // self.merge_size, width // self.merge_size)
+                block = positions[start:start + features[image_index].shape[0]]
+                keep[row, block] = False
+                chosen = block[self.select(features[image_index], grid)]
+                keep[row, chosen] = True
+                kept += len(chosen)
+                start += len(block)
+                image_index += 1
+            kept_per_row.append(kept)
+
+        # Left-pad the shortened rows again
+        lengths = keep.sum(dim=1).tolist()
+        width = max(lengths)
+        pruned_embeds = embeds.new_zeros(input_ids.shape[0], width, embeds.shape[-1])
+        pruned_mask = attention_mask.new_zeros(input_ids.shape[0], width)
+        pruned_positions = position_ids.new_ones(3, input_ids.shape[0], width)
+        for row, length in enumerate(lengths):
+            columns = keep[row].nonzero().squeeze(1)
+            pruned_embeds[row, width - length:] = embeds[row, columns]
+            pruned_mask[row, width - length:] = 1
+            pruned_positions[:, row, width - length:] = position_ids[:, row, columns]
+
+        generated_ids = model.generate(
+            inputs_embeds=pruned_embeds,
+            attention_mask=pruned_mask,
+            position_ids=pruned_positions,
+            **generate_kwargs
+        )
+        with self.lock:
+            self.requests += len(kept_per_row)
+            self.vision_tokens += int(image_mask.sum())
+            self.kept_tokens += sum(kept_per_row)
+        # With inputs_embeds, generate() returns only the new tokens
+        return generated_ids, 0, kept_per_row
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {
+                "keep_ratio": self.keep_ratio,
+                "min_tokens": self.min_tokens,
+                "images": self.requests,
+                "vision_tokens": self.vision_tokens,
+                "kept_tokens": self.kept_tokens,
+                "kept_share": round(self.kept_tokens / self.vision_tokens, 3) if self.vision_tokens else 1.0,
+            }
+
+
+# Registered pruners by model object id
+_pruners: Dict[int, VisionTokenPruner] = {}
+
+
+def enable_vision_pruning(model) -> Optional[VisionTokenPruner]:
+    """Prune image tokens of an Avision model with the configured keep ratio; None if unsupported"""
+    if not VisionTokenPruner.supports(model):
+        logger.warning("Vision token pruning disabled: model has no Qwen2-VL style image features / rope index")
+        return None
+    pruner = VisionTokenPruner(
+        model,
+        keep_ratio=config.model.vision_keep_ratio,
+        min_tokens=config.model.vision_prune_min_tokens,
+    )
+    _pruners[id(model)] = pruner
+    return pruner
+
+
+def get_vision_pruner(model) -> Optional[VisionTokenPruner]:
+    return _pruners.get(id(model))
@@ -0,0 +1,152 @@
+"""
+Model Warmup
+Runs representative generations at startup so the first real request does not pay for them
+"""
+import time
+import logging
+from threading import Thread
+from typing import Callable, List
+
+import torch
+from PIL import Image
+
+from config import config
+from batching import (
+    TextItem,
+    ImageItem,
+    tokenize_chat_prompt,
+    generate_text_batch,
+    generate_image_batch
+)
+from health import warmup_status
+from static_decode import get_static_decoder
+from scheduler import inference_queue
+from residency import residency_manager
+
+logger = logging.getLogger(__name__)
+
+WARMUP_PROMPT = "Подскажи, как лучше описать товар в объявлении, чтобы его быстрее купили?"
+WARMUP_IMAGE_PROMPT = "Опиши изображение."
+
+
+def _prompt_ids(tokenizer, length: int) -> List[int]:
+    """Chat-formatted prompt tiled to exactly `length` tokens"""
+    ids = tokenize_chat_prompt(tokenizer, WARMUP_PROMPT)
+    return (ids * (length // len(ids) + 1))[:length]
+
+
+def _run_step(name: str, model, batch_size: int, shape: str, estimated_tokens: int, fn: Callable[[], list]) -> None:
+    """Run one warmup generation through the inference queue and record its timing"""
+    start = time.time()
+    with inference_queue.admit(estimated_tokens, pool=name) as ticket, residency_manager.use(model):
+        results = fn()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        ticket.generated_tokens = sum(result["data"]["generated_tokens"] for result in results)
+    elapsed = time.time() - start
+    warmup_status.steps.append({
+        "model": name,
+        "batch_size": batch_size,
+        "shape": shape,
+        "seconds": round(elapsed, 3),
+    })
+    logger.info(f"🔥 Warmup {name}: batch={batch_size}, shape={shape}, {elapsed:.2f}s")
+
+
+def run_warmup(model_avibe, tokenizer_avibe, model_avision, processor_avision) -> None:
+    """
+    Generate a few tokens at every configured (batch size, prompt length / image size)
+
+    This pays for CUDA kernel selection, allocator growth and lazy module
+    initialization before traffic arrives. Batch sizes above the configured
+    maximum, and text shapes over the prefill budget, are skipped because
+    the server never runs them.
+    """
+    warmup_status.state = "running"
+    warmup_status.started_at = time.time()
+    new_tokens = config.model.warmup_new_tokens
+    try:
+        decoder = get_static_decoder(model_avibe)
+        if decoder is not None:
+            pad_token_id = tokenizer_avibe.pad_token_id
+            if pad_token_id is None:
+                pad_token_id = tokenizer_avibe.eos_token_id
+            with inference_queue.admit(0, pool="avibe"), residency_manager.use(model_avibe):
+                for timing in decoder.warmup(pad_token_id):
+                    warmup_status.steps.append({"model": "avibe", "shape": "static decode", **timing})
+
+        for batch_size in config.model.warmup_batch_sizes:
+            if batch_size > config.model.max_batch_size:
+                continue
+            for length in config.model.warmup_prompt_tokens:
+                prefill_budget = config.model.max_batch_prefill_tokens
+                if prefill_budget and batch_size * length > prefill_budget:
+                    continue
+                items = [
+                    TextItem(
+                        index=i,
+                        prompt=WARMUP_PROMPT,
+                        max_tokens=new_tokens,
+                        temperature=config.model.temperature,
+                        input_ids=_prompt_ids(tokenizer_avibe, length),
+                    )
+                    for i in range(batch_size)
+                ]
+                _run_step(
+                    "avibe", model_avibe, batch_size, f"{length} tokens", new_tokens * batch_size,
+                    lambda: generate_text_batch(
+                        model_avibe,
+                        tokenizer_avibe,
+                        items,
+                        top_p=config.model.top_p,
+                        repetition_penalty=config.model.repetition_penalty,
+                    )
+                )
+
+        for batch_size in config.model.warmup_batch_sizes:
+            if batch_size > config.model.max_image_batch_size:
+                continue
+            for width, height in config.model.warmup_image_sizes:
+                items = [
+                    ImageItem(
+                        index=i,
+                        prompt=WARMUP_IMAGE_PROMPT,
+                        image=Image.new("RGB", (width, height), (128, 128, 128)),
+                        decode_time=0.0,
+                    )
+                    for i in range(batch_size)
+                ]
+                _run_step(
+                    "avision", model_avision, batch_size, f"{width}x{height}", new_tokens * batch_size,
+                    lambda: generate_image_batch(
+                        model_avision,
+                        processor_avision,
+                        items,
+                        max_new_tokens=new_tokens,
+                        temperature=config.model.temperature,
+                        top_p=config.model.top_p,
+                        repetition_penalty=config.model.repetition_penalty,
+                    )
+                )
+
+        warmup_status.state = "done"
+        logger.info(f"✅ Warmup finished in {time.time() - warmup_status.started_at:.2f}s")
+    except Exception as e:
+        logger.exception("Warmup failed")
+        warmup_status.error = str(e)
+        warmup_status.state = "failed"
+    finally:
+        warmup_status.finished_at = time.time()
+
+
+def start_warmup(model_avibe, tokenizer_avibe, model_avision, processor_avision) -> None:
+    """Run the warmup in a background thread so health endpoints answer meanwhile"""
+    if not config.model.warmup_enabled:
+        warmup_status.state = "disabled"
+        return
+    Thread(
+        target=run_warmup,
+        args=(model_avibe, tokenizer_avibe, model_avision, processor_avision),
+        name="model-warmup",
+        daemon=True,
+    ).start()